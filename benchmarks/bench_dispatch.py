@@ -0,0 +1,138 @@
+# Benchmark: end-to-end throughput of sequential vs. keyed concurrent dispatch
+# under a synthetic mixed-command load with a slow fake Bot API. Then checks
+# that a user flooding a full queue has every shed button press answered
+# and gets one notice for shed messages, and that chat-wide commands run one
+# at a time per chat while other commands in the chat keep running.
+# Usage: python benchmarks/bench_dispatch.py [updates] [bot latency ms]
+import asyncio
+import functools
+import os
+import random
+import sys
+import time
+
+from fakes import FakeBot, callback_update, command_update, import_bot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from dispatch import BUSY_TEXT, update_keys
+
+CHAT_ID = -100
+N_USERS = 500
+
+
+def make_load(bot, n_updates):
+    """[(update, context, handler name)] mixing the bot's commands and buttons"""
+    load = []
+    for _ in range(n_updates):
+        uid = random.randint(1, N_USERS)
+        kind = random.random()
+        if kind < 0.15:
+            load.append(command_update(bot, uid, CHAT_ID, "/razione_giornaliera") + ('razione_giornaliera',))
+        elif kind < 0.30:
+            load.append(command_update(bot, uid, CHAT_ID, "/elemosina") + ('elemosina',))
+        elif kind < 0.45:
+            load.append(command_update(bot, uid, CHAT_ID, f"/coinflip {random.randint(1, 5)}") + ('coinflip',))
+            load.append(callback_update(bot, uid, CHAT_ID, f"coinflip:{uid}:cannone") + ('handle_coinflip_callback',))
+        elif kind < 0.60:
+            load.append(command_update(bot, uid, CHAT_ID, f"/duello_pisello {random.randint(1, 5)}") + ('duello_pisello',))
+            rival = random.randint(1, N_USERS)
+            load.append(callback_update(bot, rival, CHAT_ID, f"duel:accept:{uid}") + ('handle_duel_callback',))
+        elif kind < 0.75:
+            load.append(command_update(bot, uid, CHAT_ID, f"/schedina {random.randint(1, 10)} 1") + ('schedina',))
+        elif kind < 0.85:
+            load.append(command_update(bot, uid, CHAT_ID, "/superenalotto") + ('superenalotto',))
+        else:
+            load.append(command_update(bot, uid, CHAT_ID, "/classifica") + ('leaderboard',))
+    return load
+
+
+async def run(main, n_updates, latency, concurrency):
+    bot = FakeBot(latency)
+    load = make_load(bot, n_updates)
+    started = time.perf_counter()
+    if concurrency <= 1:
+        for update, context, handler in load:
+            await getattr(main, handler)(update, context)
+    else:
+        processor = main.KeyedUpdateProcessor(concurrency, main.MAX_QUEUE_PER_KEY)
+        await processor.initialize()
+        # Same shape as PTB's update fetcher: one task per update
+        await asyncio.gather(*(
+            processor.process_update(update, getattr(main, handler)(update, context))
+            for update, context, handler in load
+        ))
+    elapsed = time.perf_counter() - started
+    print(f"concurrency={concurrency:<4} {n_updates / elapsed:9.1f} updates/s  ({elapsed:.2f}s, {len(bot.calls)} API calls)")
+
+
+async def check_shedding(main, max_queue=5):
+    """Problems with how a flooded user's updates are shed"""
+    bot = FakeBot()
+    processor = main.KeyedUpdateProcessor(4, max_queue)
+    await processor.initialize()
+    release = asyncio.Event()
+
+    async def blocked():
+        await release.wait()
+
+    presses = [callback_update(bot, 1, CHAT_ID, f"coinflip:c{i}:0") for i in range(3 * max_queue)]
+    commands = [command_update(bot, 1, CHAT_ID, "/razione_giornaliera") for _ in range(3 * max_queue)]
+    tasks = [asyncio.create_task(processor.process_update(update, blocked())) for update, _ in presses + commands]
+    await asyncio.sleep(0.05)
+    release.set()
+    await asyncio.gather(*tasks)
+
+    problems = []
+    answered = len(bot.texts('answer_callback_query'))
+    notices = bot.texts('send_message').count(BUSY_TEXT)
+    shed_presses = len(presses) - max_queue
+    if processor.dropped != len(presses) + len(commands) - max_queue:
+        problems.append(f"{processor.dropped} updates shed, expected {len(presses) + len(commands) - max_queue}")
+    if answered != shed_presses:
+        problems.append(f"{answered} of {shed_presses} shed button presses answered")
+    if notices != 1:
+        problems.append(f"{notices} notices for the shed messages instead of 1")
+    return problems
+
+
+async def check_chat_order(main):
+    """Problems with the ordering of chat-wide commands"""
+    bot = FakeBot()
+    key_func = functools.partial(update_keys, chat_commands=main.CHAT_COMMANDS)
+    processor = main.KeyedUpdateProcessor(8, 20, key_func)
+    await processor.initialize()
+    log = []
+
+    async def handler(name):
+        log.append(('start', name))
+        await asyncio.sleep(0.01)
+        log.append(('end', name))
+
+    load = [(command_update(bot, uid, CHAT_ID, f"/schedina {uid} 1")[0], f"schedina {uid}") for uid in range(1, 6)]
+    load.append((command_update(bot, 99, CHAT_ID, "/razione_giornaliera")[0], "razione"))
+    await asyncio.gather(*(processor.process_update(update, handler(name)) for update, name in load))
+
+    problems = []
+    bets = [entry for entry in log if entry[1].startswith('schedina')]
+    expected = [(event, f"schedina {uid}") for uid in range(1, 6) for event in ('start', 'end')]
+    if bets != expected:
+        problems.append(f"/schedina in one chat ran out of order or overlapping: {bets}")
+    if log.index(('start', 'razione')) > log.index(('end', 'schedina 1')):
+        problems.append("/razione_giornaliera waited behind the chat's /schedina")
+    return problems
+
+
+def cli():
+    n_updates = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 20) / 1000
+    main = import_bot()
+    for concurrency in (1, 8, main.CONCURRENT_UPDATES, 128):
+        random.seed(42)
+        asyncio.run(run(main, n_updates, latency, concurrency))
+    problems = asyncio.run(check_shedding(main)) + asyncio.run(check_chat_order(main))
+    print("\n".join(f"FAILED: {problem}" for problem in problems) if problems else "OK: shedding and chat order")
+    raise SystemExit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,59 @@
+# Benchmark: /superenalotto status and settlement totals with many open bets,
+# running aggregates vs. a full scan of the bets, for both storage backends.
+# Usage: python benchmarks/bench_lottery.py [open bets]
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from storage import JsonStorage, SqliteStorage
+
+CHAT_ID = -100
+
+
+def scan_totals(bets):
+    """What superenalotto() did before: regroup every bet"""
+    totals = {}
+    for b in bets.values():
+        total, count = totals.get(b['number'], (0, 0))
+        totals[b['number']] = (total + b['amount'], count + 1)
+    return totals
+
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def bench(name, store, n_bets):
+    started = time.perf_counter()
+    for uid in range(n_bets):
+        store.apply_delta(uid, values={'length': 1000})
+        store.place_bet(CHAT_ID, uid, random.randint(1, 10), random.randint(1, 100))
+    print(f"{name}: placed {n_bets} bets in {time.perf_counter() - started:.1f}s")
+
+    bets = store.lottery_bets(CHAT_ID)
+    print(f"  scan of raw bets:   {timed(lambda: scan_totals(bets), 5) * 1e3:10.2f} ms")
+    print(f"  bet_totals():       {timed(lambda: store.bet_totals(CHAT_ID), 1000) * 1e6:10.2f} us")
+    print(f"  place_bet (top-up): {timed(lambda: store.place_bet(CHAT_ID, 7, bets['7']['number'], 1), 1000) * 1e6:10.2f} us")
+    problems = store.check_lottery_aggregates(CHAT_ID)
+    print(f"  consistency check:  {'ok' if not problems else problems}")
+
+
+def main():
+    n_bets = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as workdir:
+        json_store = JsonStorage(
+            os.path.join(workdir, 'bench.json'), os.path.join(workdir, 'bench.journal'),
+            shard_dir=os.path.join(workdir, 'chats')
+        )
+        bench("json", json_store, n_bets)
+        bench("sqlite", SqliteStorage(os.path.join(workdir, 'bench.db')), n_bets)
+
+
+if __name__ == '__main__':
+    main()
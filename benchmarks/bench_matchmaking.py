@@ -0,0 +1,94 @@
+# Benchmark: duel matchmaking throughput with a deep order book. The book
+# is filled with N open orders at random stakes, then duels arrive: each one
+# is paired with the closest order in its tolerance band, or rests in the
+# book if there is none. A new order replaces each paired one outside the
+# timing, so every arrival sees a book of at least N orders. A linear scan of
+# the open orders, what pairing without the stake index costs, runs on a
+# few arrivals for comparison.
+# Usage: python benchmarks/bench_matchmaking.py [--orders 100000] [--arrivals 200000] [--max-stake 10000]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from matchmaking import OrderBook, stake_band
+
+
+def fill(book, orders, users, max_stake, rng):
+    open_orders = {}
+    for number in range(orders):
+        challenge_id, owner, stake = f"c{number}", rng.randrange(users), rng.randint(1, max_stake)
+        book.add(challenge_id, owner, stake)
+        open_orders[challenge_id] = (owner, stake)
+    return open_orders
+
+
+def arrivals(count, users, max_stake, rng):
+    return [(rng.randrange(users), rng.randint(1, max_stake)) for _ in range(count)]
+
+
+def play(book, duels, tolerance, first_id, users, max_stake, rng):
+    """Pair or rest every arrival; (latencies, matched)"""
+    timings = []
+    matched = 0
+    for number, (owner, stake) in enumerate(duels, first_id):
+        started = time.perf_counter()
+        low, high = stake_band(stake, tolerance)
+        order = book.match(owner, low, high, stake)
+        if order is None:
+            book.add(f"c{number}", owner, stake)
+        else:
+            book.remove(order[0])
+            matched += 1
+        timings.append(time.perf_counter() - started)
+        if order is not None:
+            book.add(f"r{number}", rng.randrange(users), rng.randint(1, max_stake))
+    return timings, matched
+
+
+def linear_match(open_orders, owner, low, high, target):
+    best = None
+    for challenge_id, (order_owner, stake) in open_orders.items():
+        if order_owner != owner and low <= stake <= high and (best is None or abs(stake - target) < best[0]):
+            best = (abs(stake - target), challenge_id)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Duel matchmaking throughput with a deep order book")
+    parser.add_argument('--orders', type=int, default=100_000, help="open orders before the arrivals")
+    parser.add_argument('--arrivals', type=int, default=200_000)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--max-stake', type=int, default=10_000)
+    parser.add_argument('--tolerance', type=float, nargs='*', default=[0, 0.01, 0.1, 0.5])
+    args = parser.parse_args()
+
+    print(f"{args.orders} open orders, stakes 1-{args.max_stake}, {args.arrivals} arrivals")
+    print(f"{'tolerance':>9} {'matched %':>9} {'duels/s':>9} {'p50 us':>7} {'p99 us':>7} {'open after':>10}")
+    for tolerance in args.tolerance:
+        rng = random.Random(1)
+        book = OrderBook()
+        fill(book, args.orders, args.users, args.max_stake, rng)
+        duels = arrivals(args.arrivals, args.users, args.max_stake, rng)
+        timings, matched = play(book, duels, tolerance, args.orders, args.users, args.max_stake, rng)
+        elapsed = sum(timings)
+        timings.sort()
+        print(f"{tolerance:>9} {100 * matched / len(duels):>9.1f} {len(duels) / elapsed:>9.0f} "
+              f"{timings[len(timings) // 2] * 1e6:>7.1f} {timings[int(len(timings) * 0.99)] * 1e6:>7.1f} {len(book):>10}")
+
+    rng = random.Random(1)
+    open_orders = fill(OrderBook(), args.orders, args.users, args.max_stake, rng)
+    duels = arrivals(20, args.users, args.max_stake, rng)
+    started = time.perf_counter()
+    for owner, stake in duels:
+        low, high = stake_band(stake, 0.1)
+        linear_match(open_orders, owner, low, high, stake)
+    per_duel = (time.perf_counter() - started) / len(duels)
+    print(f"\nlinear scan of {args.orders} orders, tolerance 0.1: {per_duel * 1e3:.1f} ms per arrival "
+          f"({1 / per_duel:.0f} duels/s)")
+
+
+if __name__ == '__main__':
+    main()
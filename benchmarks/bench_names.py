@@ -0,0 +1,115 @@
+# Check of the name cache's batch lookup against a fake Bot that records
+# and delays get_chat_member: misses are fetched with at most `concurrency`
+# calls in flight, the lookup returns by its deadline even when some calls
+# hang, and users whose lookup fails or times out keep their stale cached
+# name, or get the placeholder if they never had one.
+# Usage: python benchmarks/bench_names.py [--users 50] [--latency 0.05]
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from fakes import FakeBot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from names import NameCache
+
+
+class SlowBot(FakeBot):
+    """FakeBot whose get_chat_member hangs for some users and fails for
+    others, and that tracks how many calls were in flight at once"""
+
+    def __init__(self, latency, slow=(), failing=(), slow_latency=10.0):
+        super().__init__(latency)
+        self.slow = {str(user_id) for user_id in slow}
+        self.failing = {str(user_id) for user_id in failing}
+        self.slow_latency = slow_latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if str(user_id) in self.slow:
+                await asyncio.sleep(self.slow_latency)
+            if str(user_id) in self.failing:
+                await self._call('get_chat_member', chat_id=chat_id, user_id=user_id)
+                raise RuntimeError("Bad Request: user not found")
+            return await super().get_chat_member(chat_id, user_id)
+        finally:
+            self.in_flight -= 1
+
+
+def format_name(user):
+    return f"@{user.username}"
+
+
+async def check_concurrency(users, latency, concurrency):
+    bot = SlowBot(latency)
+    cache = NameCache(format_name)
+    started = time.perf_counter()
+    names = await cache.resolve_many(bot, -1, range(users), concurrency, deadline=60)
+    elapsed = time.perf_counter() - started
+    sequential = users * latency
+    print(f"{users} misses, {concurrency} at a time: {elapsed * 1e3:.0f} ms "
+          f"(one by one: {sequential * 1e3:.0f} ms), at most {bot.max_in_flight} calls in flight")
+    again = await cache.resolve_many(bot, -1, range(users), concurrency, deadline=60)
+    return (bot.max_in_flight == concurrency and len(bot.calls) == users
+            and all(names[str(uid)] == f"@user{uid}" for uid in range(users)) and again == names)
+
+
+async def check_deadline(users, latency, concurrency, deadline):
+    slow = range(0, users, 5)
+    bot = SlowBot(latency, slow=slow)
+    cache = NameCache(format_name)
+    started = time.perf_counter()
+    names = await cache.resolve_many(bot, -1, range(users), concurrency, deadline)
+    elapsed = time.perf_counter() - started
+    placeholders = sum(1 for uid in range(users) if names[str(uid)] == f"User {uid}")
+    print(f"{len(slow)} of {users} lookups hang: returned in {elapsed * 1e3:.0f} ms "
+          f"(deadline {deadline * 1e3:.0f} ms), {placeholders} placeholders")
+    # Hanging calls keep their slot, so the users queued behind them miss the
+    # deadline too: they get the placeholder, and the hanging calls are cancelled
+    await asyncio.sleep(0)
+    return (elapsed < deadline + 0.1 and bot.in_flight == 0 and placeholders < users
+            and all(names[str(uid)] == f"User {uid}" for uid in slow)
+            and all(names[str(uid)] in (f"@user{uid}", f"User {uid}") for uid in range(users)))
+
+
+async def check_stale(latency, concurrency):
+    # 1 and 2 are cached but expired; 1 and 3 fail, 2 hangs
+    bot = SlowBot(latency, slow=[2], failing=[1, 3])
+    cache = NameCache(format_name, ttl=0.01)
+    cache.put(1, "@vecchio1")
+    cache.put(2, "@vecchio2")
+    await asyncio.sleep(0.02)
+    names = await cache.resolve_many(bot, -1, [1, 2, 3, 4], concurrency, deadline=0.2)
+    print(f"expired, failed and hanging lookups: {names}")
+    return names == {'1': "@vecchio1", '2': "@vecchio2", '3': "User 3", '4': "@user4"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Name cache batch lookup against a slow fake Bot API")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05, help="get_chat_member latency in seconds")
+    parser.add_argument('--concurrency', type=int, default=5)
+    parser.add_argument('--deadline', type=float, default=0.5)
+    args = parser.parse_args()
+
+    checks = {
+        'concurrency bound': check_concurrency(args.users, args.latency, args.concurrency),
+        'deadline': check_deadline(args.users, args.latency, args.concurrency, args.deadline),
+        'stale fallback': check_stale(args.latency, args.concurrency),
+    }
+    ok = True
+    for name, check in checks.items():
+        passed = asyncio.run(check)
+        print(f"  {name}: {'OK' if passed else 'FAILED'}")
+        ok &= passed
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+# Benchmark: a burst of outgoing calls against a local fake Bot API that
+# enforces Telegram's flood limits with 429 + retry_after, sent straight
+# through python-telegram-bot and through outbox.OutboundQueue. Reports
+# 429s, calls that failed, merged edits and latency per kind of call, and
+# fails unless the queue got no 429, lost no call, merged the edits down to
+# the newest text and split the long announcement into chunks of at most
+# 4096 characters.
+# Usage: python benchmarks/bench_outbox.py [private chats] [answers]
+import asyncio
+import collections
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+
+from bench_webhook import TOKEN, FakeTelegram
+from outbox import BROADCAST, MAX_MESSAGE_LENGTH, OutboundQueue, split_text
+from webhook import format_response, read_request
+
+GROUP_ID = -100
+EDITS = 10
+BOARD = "\n".join(f"- User {i} ha vinto {i}cm" for i in range(600))
+
+
+class LimitedTelegram(FakeTelegram):
+    """Answers 429 like Telegram when a chat or the whole bot sends too fast"""
+
+    def __init__(self, global_per_second=30, chat_per_second=1, group_per_minute=20):
+        super().__init__()
+        self.limits = {'global': (global_per_second, 1.0)}
+        self.chat_limit = (chat_per_second, 1.0)
+        self.group_limit = (group_per_minute, 60.0)
+        self.history = collections.defaultdict(collections.deque)
+        self.rejected = 0
+        self.accepted = 0
+        self.texts = collections.defaultdict(list)
+        self._message_ids = iter(range(1, 10 ** 9))
+
+    def _retry_after(self, key, count, window, now):
+        sent = self.history[key]
+        while sent and sent[0] <= now - window:
+            sent.popleft()
+        return int(sent[0] + window - now) + 1 if len(sent) >= count else 0
+
+    def check(self, params):
+        """0 if the call is allowed (and counted), else the retry_after to answer"""
+        now = time.monotonic()
+        windows = [('global', self.limits['global'])]
+        chat_id = params.get('chat_id')
+        if chat_id is not None:
+            windows.append((chat_id, self.group_limit if int(chat_id) < 0 else self.chat_limit))
+        for key, (count, window) in windows:
+            retry = self._retry_after(key, count, window, now)
+            if retry:
+                return retry
+        for key, _ in windows:
+            self.history[key].append(now)
+        return 0
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                _, target, headers, body = request
+                method = target.split('?', 1)[0].rsplit('/', 1)[-1]
+                params = self._params(headers, body)
+                retry = self.check(params) if method != 'getMe' else 0
+                if retry:
+                    self.rejected += 1
+                    writer.write(format_response(429, {
+                        'ok': False, 'error_code': 429,
+                        'description': f"Too Many Requests: retry after {retry}",
+                        'parameters': {'retry_after': retry},
+                    }))
+                else:
+                    self.accepted += 1
+                    writer.write(format_response(200, {'ok': True, 'result': await self.call(method, params)}))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def call(self, method, params):
+        if method in ('sendMessage', 'editMessageText'):
+            self.texts[method].append(params.get('text'))
+            return {
+                'message_id': params.get('message_id') or next(self._message_ids), 'date': 0,
+                'chat': {'id': params['chat_id'], 'type': 'group' if int(params['chat_id']) < 0 else 'private'},
+                'text': params.get('text'),
+            }
+        return await super().call(method, params)
+
+
+async def workload(bot, chats, answers):
+    """{kind: [seconds]} and failures for one burst of mixed traffic"""
+    latencies = collections.defaultdict(list)
+    failures = collections.Counter()
+
+    async def timed(kind, call):
+        started = time.perf_counter()
+        try:
+            await call
+        except RetryAfter:
+            failures[kind] += 1
+            return
+        latencies[kind].append(time.perf_counter() - started)
+
+    calls = []
+    # A lottery announcement long enough to need splitting
+    calls.append(timed('broadcast', bot.send_message(GROUP_ID, BOARD, rate_limit_args=BROADCAST)
+                       if bot.rate_limiter else bot.send_message(GROUP_ID, BOARD[:4096])))
+    # Several users pressing buttons on the same duel message
+    for i in range(EDITS):
+        calls.append(timed('edit', bot.edit_message_text(f"Duello aggiornato {i}", chat_id=GROUP_ID, message_id=7)))
+    # Commands answered in the same group
+    for i in range(8):
+        calls.append(timed('group', bot.send_message(GROUP_ID, f"Risposta nel gruppo {i}")))
+    for i in range(answers):
+        calls.append(timed('answer', bot.answer_callback_query(str(i), text="ok")))
+    for chat in range(chats):
+        for i in range(4):
+            calls.append(timed('reply', bot.send_message(1000 + chat, f"Risposta {i}")))
+    started = time.perf_counter()
+    await asyncio.gather(*calls)
+    return latencies, failures, time.perf_counter() - started
+
+
+async def run_case(name, limiter, chats, answers):
+    telegram = LimitedTelegram()
+    await telegram.start()
+    bot = ExtBot(TOKEN, base_url=telegram.base_url, rate_limiter=limiter)
+    await bot.initialize()
+    latencies, failures, elapsed = await workload(bot, chats, answers)
+    await bot.shutdown()
+    await telegram.stop()
+
+    print(f"\n{name}: {elapsed:.1f}s, {telegram.accepted - 1} calls accepted, {telegram.rejected} x 429")
+    for kind in ('answer', 'edit', 'group', 'reply', 'broadcast'):
+        values = sorted(latencies[kind])
+        if values:
+            print(f"  {kind:<10} ok {len(values):>4}  failed {failures[kind]:>4}  "
+                  f"p50 {statistics.median(values) * 1e3:7.0f} ms  max {values[-1] * 1e3:7.0f} ms")
+        else:
+            print(f"  {kind:<10} ok    0  failed {failures[kind]:>4}")
+    if limiter is None:
+        return []
+    edits = telegram.texts['editMessageText']
+    print(f"  edits merged: {limiter.coalesced}, messages split: {limiter.split}, retried: {limiter.retried}, "
+          f"last edit text: {edits[-1]!r}")
+
+    problems = []
+    if telegram.rejected:
+        problems.append(f"{telegram.rejected} x 429 from the fake API")
+    if sum(failures.values()):
+        problems.append(f"failed calls: {dict(failures)}")
+    if not limiter.coalesced or len(edits) + limiter.coalesced != EDITS or edits[-1] != f"Duello aggiornato {EDITS - 1}":
+        problems.append(f"{len(edits)} edits sent and {limiter.coalesced} merged, last {edits[-1]!r}")
+    chunks = [text for text in telegram.texts['sendMessage'] if text.startswith("- User")]
+    if len(chunks) < 2 or "\n".join(chunks) != BOARD:
+        problems.append(f"the announcement did not arrive whole in {len(chunks)} chunks")
+    longest = max(len(text) for text in telegram.texts['sendMessage'])
+    if longest > MAX_MESSAGE_LENGTH:
+        problems.append(f"a {longest}-character message was sent")
+    return problems
+
+
+def check_split():
+    """split_text on texts with few or no line breaks to cut at"""
+    problems = []
+    for text in ("x" * 10000, "a\n" + "y" * 9000, ("riga\n" * 2000).rstrip(), "z" * MAX_MESSAGE_LENGTH):
+        chunks = split_text(text)
+        # Only the line breaks at the cuts may go
+        if "".join(chunks).replace("\n", "") != text.replace("\n", ""):
+            problems.append(f"split_text lost text of a {len(text)}-character message")
+        if max(len(chunk) for chunk in chunks) > MAX_MESSAGE_LENGTH:
+            problems.append(f"split_text left a chunk over {MAX_MESSAGE_LENGTH} characters")
+    return problems
+
+
+async def main():
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    answers = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    await run_case("Direct", None, chats, answers)
+    problems = await run_case("OutboundQueue", OutboundQueue(), chats, answers) + check_split()
+    print("\n" + "\n".join(f"FAILED: {problem}" for problem in problems) if problems else "\nOK")
+    return not problems
+
+
+if __name__ == '__main__':
+    raise SystemExit(0 if asyncio.run(main()) else 1)
@@ -0,0 +1,63 @@
+# Benchmark: full-file save_data() rewrite vs. journal append per mutation
+# Usage: python benchmarks/bench_persistence.py [user counts...]
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from journal import Journal
+
+
+def make_data(n_users):
+    users = {}
+    for i in range(n_users):
+        users[str(100000000 + i)] = {
+            "length": 20 + i % 500,
+            "last_daily": 0,
+            "last_hourly": 0,
+            "stats": {
+                "daily_used": 0, "hourly_used": 0, "daily_collected": 0, "begs": 0,
+                "won": 0, "lost": 0, "length_won": 0, "length_lost": 0, "bet_total": 0,
+            },
+        }
+    return {'users': users, 'duels': {}, 'lottery': {'bets': {}, 'history': [], 'end_time': 0}}
+
+
+def bench_rewrite(data, path, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+    return (time.perf_counter() - started) / repeat
+
+
+def bench_journal(data, workdir, repeat):
+    journal = Journal(os.path.join(workdir, 'bench.journal'), os.path.join(workdir, 'bench.json'))
+    journal.open()
+    uid = next(iter(data['users']))
+    started = time.perf_counter()
+    for _ in range(repeat):
+        journal.record(['inc', ['users', uid, 'length'], 5])
+        journal.record(['inc', ['users', uid, 'stats', 'daily_used'], 1])
+        journal.record(['set', ['users', uid, 'last_daily'], time.time()])
+        journal.commit()
+    elapsed = (time.perf_counter() - started) / repeat
+    journal.close()
+    return elapsed
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    print(f"{'users':>10} {'rewrite ms':>12} {'journal us':>12} {'speedup':>10}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in sizes:
+            data = make_data(n)
+            rewrite = bench_rewrite(data, os.path.join(workdir, 'rewrite.json'), max(1, 100_000 // n))
+            append = bench_journal(data, workdir, 10_000)
+            print(f"{n:>10} {rewrite * 1e3:>12.2f} {append * 1e6:>12.2f} {rewrite / append:>9.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+# Benchmark: /classifica top-10 via full sort vs. the incremental RankIndex
+# Usage: python benchmarks/bench_ranking.py [user count]
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ranking import RankIndex
+from users import User
+
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    users = {str(100000000 + i): User(random.randint(0, 10_000)) for i in range(n)}
+    uids = list(users)
+
+    started = time.perf_counter()
+    index = RankIndex.build(users)
+    print(f"build ({n} users): {time.perf_counter() - started:.2f}s")
+
+    sort_top = timed(lambda: sorted(users.items(), key=lambda x: x[1].length, reverse=True)[:10], 3)
+    print(f"sorted()[:10]:     {sort_top * 1e3:10.2f} ms")
+    print(f"index.top(10):     {timed(lambda: index.top(10), 10_000) * 1e6:10.2f} us")
+    print(f"index.rank(uid):   {timed(lambda: index.rank(random.choice(uids)), 10_000) * 1e6:10.2f} us")
+    print(f"index.range(page): {timed(lambda: index.range(n // 2, n // 2 + 10), 10_000) * 1e6:10.2f} us")
+
+    def move():
+        uid = random.choice(uids)
+        users[uid].length += random.randint(-20, 20)
+        index.update(uid, users[uid].length)
+    print(f"index.update():    {timed(move, 10_000) * 1e6:10.2f} us")
+
+
+if __name__ == '__main__':
+    main()
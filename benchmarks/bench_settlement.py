@@ -0,0 +1,104 @@
+# Benchmark: settling one huge lottery round. Compares the old per-bet
+# loop (float shares, one line per bettor) with settlement.settle() on
+# NumPy columns and on plain lists, then applies the credit batches to
+# both storage backends. Reports time and how many cm each method leaks.
+# Usage: python benchmarks/bench_settlement.py [bets] [bets stored]
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import settlement
+from settlement import bet_columns, settle
+from storage import JsonStorage, SqliteStorage
+
+CHAT_ID = -100
+WINNING_NUMBER = 7
+
+
+def make_bets(n_bets):
+    return {str(uid): {'number': random.randint(1, 10), 'amount': random.randint(1, 1000)}
+            for uid in range(n_bets)}
+
+
+def old_settlement(bets, winning_number):
+    """What draw_lottery did before: float shares, one string per bettor"""
+    total_pot = sum(b['amount'] for b in bets.values())
+    total_winning = sum(b['amount'] for b in bets.values() if b['number'] == winning_number)
+    credits, winners, losers = {}, [], []
+    for uid, b in bets.items():
+        if b['number'] == winning_number:
+            share = int(total_pot * (b['amount'] / total_winning))
+            credits[uid] = {'length': share, 'stats.length_won': share}
+            winners.append(f"- User {uid} ha vinto {share}cm")
+        else:
+            credits[uid] = {'stats.length_lost': b['amount']}
+            losers.append(f"- User {uid} ha perso {b['amount']}cm")
+    message = "\n".join(winners) + "\n\n" + "\n".join(losers)
+    paid = sum(c.get('length', 0) for c in credits.values())
+    return total_pot - paid, len(message)
+
+
+def paid_out(result):
+    return sum(sum(columns.get('length', ())) for _, columns in result.credits)
+
+
+def timed(fn):
+    started = time.perf_counter()
+    value = fn()
+    return time.perf_counter() - started, value
+
+
+def bench_engine(bets):
+    print(f"{len(bets)} bets, pot {sum(b['amount'] for b in bets.values())}cm")
+    elapsed, (leaked, length) = timed(lambda: old_settlement(bets, WINNING_NUMBER))
+    print(f"  old per-bet loop:  {elapsed * 1e3:9.0f} ms  leaked {leaked:>6} cm  message {length / 1e6:.1f} MB")
+
+    if settlement.np is not None:
+        elapsed, columns = timed(lambda: bet_columns(bets))
+        print(f"  bet_columns:       {elapsed * 1e3:9.0f} ms")
+        elapsed, result = timed(lambda: settle(*columns, WINNING_NUMBER))
+        print(f"  settle (numpy):    {elapsed * 1e3:9.0f} ms  leaked {result.pot - paid_out(result):>6} cm")
+    else:
+        print("  settle (numpy):    NumPy not installed")
+
+    user_ids = list(bets)
+    numbers = [b['number'] for b in bets.values()]
+    amounts = [b['amount'] for b in bets.values()]
+    elapsed, pure = timed(lambda: settle(user_ids, numbers, amounts, WINNING_NUMBER))
+    print(f"  settle (python):   {elapsed * 1e3:9.0f} ms  leaked {pure.pot - paid_out(pure):>6} cm")
+    if settlement.np is not None:
+        same = result.credits[0][1]['length'] == pure.credits[0][1]['length'] and result.top == pure.top
+        print(f"  numpy == python:   {same}")
+
+
+def bench_storage(name, store, bets):
+    for uid in bets:
+        store.apply_delta(uid, values={'length': 0})
+    result = settle(*bet_columns(bets), WINNING_NUMBER)
+    elapsed, _ = timed(lambda: store.settle_lottery(CHAT_ID, result.credits, WINNING_NUMBER))
+    total = sum(store.get_user(uid).length for uid in bets)
+    print(f"  {name:<7} settle_lottery: {elapsed * 1e3:9.0f} ms  credited {total} of {result.pot} cm")
+
+
+def main():
+    n_bets = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    n_stored = int(sys.argv[2]) if len(sys.argv) > 2 else 100_000
+    random.seed(1)
+    bench_engine(make_bets(n_bets))
+
+    stored = make_bets(n_stored)
+    print(f"\nApplying a {n_stored}-bet round:")
+    with tempfile.TemporaryDirectory() as workdir:
+        json_store = JsonStorage(
+            os.path.join(workdir, 'bench.json'), os.path.join(workdir, 'bench.journal'),
+            shard_dir=os.path.join(workdir, 'chats')
+        )
+        bench_storage('json', json_store, stored)
+        bench_storage('sqlite', SqliteStorage(os.path.join(workdir, 'bench.db')), stored)
+
+
+if __name__ == '__main__':
+    main()
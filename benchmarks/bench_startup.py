@@ -0,0 +1,89 @@
+# Benchmark: time from process start to serving the first commands, JSON
+# data file vs. binary snapshot. Each run is a fresh subprocess, so the
+# peak RSS (VmHWM, Linux only) is that of one bot process opening the state.
+# Usage: python benchmarks/bench_startup.py [user counts...]
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from storage import import_snapshot
+from users import STAT_FIELDS
+
+# Runs in the subprocess: open the store, then time the first commands
+PROBE = """
+import sys, time
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+from storage import JsonStorage
+store = JsonStorage('bench.json', 'bench.journal', shard_dir='chats', snapshot_path={snapshot!r})
+opened = time.perf_counter()
+store.apply_delta('{user}', {{'length': 5}})
+first_user = time.perf_counter()
+store.range(0, 10), store.rank('{user}')
+leaderboard = time.perf_counter()
+with open('/proc/self/status') as f:
+    peak = next(int(line.split()[1]) for line in f if line.startswith('VmHWM'))
+print(opened - started, first_user - opened, leaderboard - first_user, peak // 1024)
+"""
+
+
+def make_data(n_users, rng):
+    users = {
+        str(100000000 + i): {
+            'length': rng.randint(0, 5000),
+            'last_daily': int(time.time()) - rng.randint(0, 10 ** 6),
+            'last_hourly': int(time.time()) - rng.randint(0, 10 ** 5),
+            'stats': {field: rng.randint(0, 1000) for field in STAT_FIELDS},
+        }
+        for i in range(n_users)
+    }
+    return {'users': users, 'open_rounds': {}, 'open_challenges': {}}
+
+
+def probe(workdir, snapshot, user):
+    code = PROBE.format(root=ROOT, snapshot=snapshot, user=user)
+    output = subprocess.run([sys.executable, '-c', code], cwd=workdir, check=True,
+                            capture_output=True, text=True).stdout
+    opened, first_user, leaderboard, rss = output.split()
+    return float(opened), float(first_user), float(leaderboard), int(rss)
+
+
+def import_main():
+    """Seconds to import main.py with no token and no data files"""
+    env = {key: value for key, value in os.environ.items() if key != 'BOT_TOKEN'}
+    with tempfile.TemporaryDirectory() as workdir:
+        code = f"import sys, time; s = time.perf_counter(); sys.path.insert(0, {ROOT!r}); " \
+               f"import main; print(time.perf_counter() - s, main.store)"
+        output = subprocess.run([sys.executable, '-c', code], cwd=workdir, env=env, check=True,
+                                capture_output=True, text=True).stdout
+    return output.strip()
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [100_000, 1_000_000]
+    rng = random.Random(1)
+    print(f"import main (no BOT_TOKEN, no data): {import_main()}")
+    print(f"{'users':>9} {'format':>7} {'file MB':>8} {'open ms':>9} {'1st user ms':>12} "
+          f"{'1st board ms':>13} {'RSS MB':>7}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            json_path = os.path.join(workdir, 'bench.json')
+            snapshot_path = os.path.join(workdir, 'bench.snap')
+            with open(json_path, 'w') as f:
+                json.dump(make_data(n, rng), f, separators=(',', ':'))
+            import_snapshot(json_path, snapshot_path, os.path.join(workdir, 'chats'))
+            user = str(100000000 + n // 2)
+            for name, path, snapshot in (('json', json_path, None), ('binary', snapshot_path, 'bench.snap')):
+                opened, first_user, leaderboard, rss = probe(workdir, snapshot, user)
+                print(f"{n:>9} {name:>7} {os.path.getsize(path) / 1e6:>8.1f} {opened * 1e3:>9.0f} "
+                      f"{first_user * 1e3:>12.2f} {leaderboard * 1e3:>13.0f} {rss:>7}")
+
+
+if __name__ == '__main__':
+    main()
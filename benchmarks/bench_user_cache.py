@@ -0,0 +1,98 @@
+# Benchmark: memory and latency of the user cache against the size of the
+# active set. A binary snapshot of N users is opened with USER_CACHE_SIZE
+# unbounded and bounded; each run plays balance changes on a random active
+# set of users, then a leaderboard query, which builds the rank index.
+# Each run is a fresh subprocess and memory is its anonymous RSS (Linux
+# only), so mapped snapshot pages that the kernel can drop are not counted.
+# Usage: python benchmarks/bench_user_cache.py [--users 1000000] [--cache 100000] [--ops 500000]
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import snapshot
+from journal import write_snapshot
+from users import User
+
+PROBE = """
+import random, sys, time
+sys.path.insert(0, {root!r})
+from storage import JsonStorage
+
+def rss():
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('RssAnon')) // 1024
+
+store = JsonStorage('bench.json', 'bench.journal', snapshot_path='bench.snap', user_cache_size={cache})
+rng = random.Random(1)
+active = [str(100000000 + i) for i in rng.sample(range({users}), {active})]
+timings = []
+for i in range({ops}):
+    user_id = rng.choice(active)
+    started = time.perf_counter()
+    store.apply_delta(user_id, {{'length': rng.randint(-3, 5), 'stats.won': 1}})
+    timings.append(time.perf_counter() - started)
+    if i % 1000 == 999:
+        store.journal.commit()
+played = rss()
+started = time.perf_counter()
+store.range(0, 10), store.rank(active[0])
+board = time.perf_counter() - started
+timings.sort()
+users = store.data['users']
+cold = len(users.cold) if users.cold is not None else 0
+print(timings[len(timings) // 2], timings[int(len(timings) * 0.99)], board, played, rss(),
+      users.decoded, cold, users.hits, users.misses, users.evictions, users.writebacks)
+"""
+
+
+def make_snapshot(path, n_users, rng):
+    users = {}
+    for i in range(n_users):
+        user = User(rng.randint(0, 5000), int(time.time()) - rng.randint(0, 10 ** 6))
+        user.won = rng.randint(0, 1000)
+        users[str(100000000 + i)] = user
+    write_snapshot(path, snapshot.dump({'users': users, 'open_rounds': {}, 'open_challenges': {}}))
+
+
+def probe(workdir, users, cache, active, ops):
+    code = PROBE.format(root=ROOT, users=users, cache=cache, active=active, ops=ops)
+    output = subprocess.run([sys.executable, '-c', code], cwd=workdir, check=True,
+                            capture_output=True, text=True).stdout
+    fields = output.split()
+    return [float(value) for value in fields[:3]] + [int(value) for value in fields[3:]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="User cache memory and latency against the active set")
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--cache', type=int, default=100_000, help="bounded USER_CACHE_SIZE to compare")
+    parser.add_argument('--ops', type=int, default=500_000)
+    parser.add_argument('--active', type=int, nargs='*', help="active set sizes (default 10k to all users)")
+    args = parser.parse_args()
+    actives = args.active or [n for n in (10_000, 100_000, 300_000, args.users) if n <= args.users]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        make_snapshot(os.path.join(workdir, 'bench.snap'), args.users, random.Random(1))
+        print(f"{args.users} users, {args.ops} balance changes per run")
+        print(f"{'active':>9} {'cache':>8} {'p50 us':>7} {'p99 us':>7} {'board ms':>9} {'RSS MB':>7} {'+board':>7} "
+              f"{'decoded':>8} {'cold':>8} {'hit %':>6} {'evicted':>8} {'written':>8}")
+        for active in actives:
+            for cache in (0, args.cache):
+                for name in ('bench.journal', 'bench.snap.cold'):
+                    if os.path.exists(os.path.join(workdir, name)):
+                        os.remove(os.path.join(workdir, name))
+                (p50, p99, board, rss, board_rss, decoded, cold, hits, misses, evictions,
+                 writebacks) = probe(workdir, args.users, cache, active, args.ops)
+                print(f"{active:>9} {cache or 'off':>8} {p50 * 1e6:>7.1f} {p99 * 1e6:>7.1f} {board * 1e3:>9.0f} "
+                      f"{rss:>7} {board_rss:>7} {decoded:>8} {cold:>8} {100 * hits / (hits + misses):>6.1f} "
+                      f"{evictions:>8} {writebacks:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Benchmark: memory of the in-memory user table, nested dicts (the JSON
+# layout) vs. users.User records, plus load/dump time of the same file.
+# Usage: python benchmarks/bench_users.py [user count]
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from journal import dump_data
+from users import STAT_FIELDS, user_hook
+
+
+def make_user_json(rng):
+    """A realistic user: non-trivial balance, cooldown timestamps and counters"""
+    return {
+        'length': rng.randint(0, 5000),
+        'last_daily': time.time() - rng.randint(0, 10 ** 6),
+        'last_hourly': time.time() - rng.randint(0, 10 ** 5),
+        'stats': {field: rng.randint(0, 1000) for field in STAT_FIELDS},
+    }
+
+
+def measure(build):
+    """(result, bytes allocated, seconds); timed separately since tracing is slow"""
+    gc.collect()
+    started = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    table = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return table, size, elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rng = random.Random(1)
+    text = json.dumps({'users': {str(100000000 + i): make_user_json(rng) for i in range(n)}})
+    print(f"{n} users, JSON file {len(text) / 2 ** 20:.0f} MiB")
+
+    dicts, dict_bytes, dict_load = measure(lambda: json.loads(text))
+    print(f"  nested dicts: {dict_bytes / 2 ** 20:8.0f} MiB  {dict_bytes / n:6.0f} B/user  load {dict_load:5.2f}s")
+    del dicts
+
+    records, record_bytes, record_load = measure(lambda: json.loads(text, object_hook=user_hook))
+    print(f"  User records: {record_bytes / 2 ** 20:8.0f} MiB  {record_bytes / n:6.0f} B/user  load {record_load:5.2f}s")
+    print(f"  saving:       {1 - record_bytes / dict_bytes:8.0%}")
+
+    started = time.perf_counter()
+    dumped = dump_data(records)
+    print(f"  dump_data():  {time.perf_counter() - started:8.2f}s, same layout: {json.loads(dumped) == json.loads(text)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+# Benchmark: update-to-handler latency with long polling vs. the webhook
+# server, both talking to a local fake Telegram Bot API (no network, no real
+# token). Each update is timestamped when "Telegram" receives it and again
+# when the bot's handler runs. Then main.run_webhook itself serves /start
+# updates from many private chats through the real handler table: a wrong
+# secret token must get 403, the health route 200, and every other update
+# its handler's reply, or the check fails.
+# Usage: python benchmarks/bench_webhook.py [updates] [updates per second] [app updates]
+import asyncio
+import itertools
+import json
+import os
+import signal
+import socket
+import statistics
+import sys
+import time
+from urllib.parse import parse_qsl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+from fakes import import_bot
+from webhook import SECRET_HEADER, WebhookServer, format_response, read_request
+
+TOKEN = '123:bench'
+SECRET = 'bench-secret'
+WEBHOOK_CONNECTIONS = 4
+PRIVATE_USERS = 5000   # user ids of the private chats start past this
+BOT_USER = {
+    'id': 123, 'is_bot': True, 'first_name': 'Zucchini', 'username': 'zucchini_bench_bot',
+    'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False,
+}
+
+
+def make_update(update_id, private=False, text='/superenalotto'):
+    """A command message as Telegram would deliver it, in the bench group or
+    in the private chat of a user of its own"""
+    if private:
+        user_id = PRIVATE_USERS + update_id
+        chat = {'id': user_id, 'type': 'private', 'first_name': 'bench'}
+    else:
+        user_id = 1000 + update_id % 50
+        chat = {'id': -100, 'type': 'group', 'title': 'bench'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': chat,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+        },
+    }
+
+
+class FakeTelegram:
+    """The Bot API methods PTB calls, plus Telegram's side of a webhook"""
+
+    def __init__(self):
+        self.port = None
+        self.sent_at = {}
+        self.replied_at = {}   # chat_id -> time of its first sendMessage
+        self._reply_ids = itertools.count(1)
+        self._pending = []
+        self._new_updates = asyncio.Event()
+        self._deliveries = asyncio.Queue()
+        self._workers = []
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        self._server.close()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    # --- Bot API ---
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                _, target, headers, body = request
+                method = target.split('?', 1)[0].rsplit('/', 1)[-1]
+                result = await self.call(method, self._params(headers, body))
+                writer.write(format_response(200, {'ok': True, 'result': result}))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Cancelled: a long poll still open when the benchmark ends
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _params(headers, body):
+        if not body:
+            return {}
+        if headers.get('content-type', '').startswith('application/json'):
+            return json.loads(body)
+        params = {}
+        for key, value in parse_qsl(body.decode()):
+            try:
+                params[key] = json.loads(value)
+            except json.JSONDecodeError:
+                params[key] = value
+        return params
+
+    async def call(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            offset = params.get('offset') or 0
+            self._pending = [u for u in self._pending if u['update_id'] >= offset]
+            if not self._pending:
+                self._new_updates.clear()
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), params.get('timeout') or 0)
+                except asyncio.TimeoutError:
+                    pass
+            return self._pending[:params.get('limit') or 100]
+        if method == 'sendMessage':
+            chat_id = int(params['chat_id'])
+            self.replied_at.setdefault(chat_id, time.perf_counter())
+            return {
+                'message_id': next(self._reply_ids), 'date': int(time.time()), 'text': params.get('text'),
+                'chat': {'id': chat_id, 'type': 'group' if chat_id < 0 else 'private'},
+            }
+        return True
+
+    # --- Update delivery ---
+    def push(self, update):
+        """Hand an update to the bot, whichever way it is listening"""
+        self.sent_at[update['update_id']] = time.perf_counter()
+        if self._workers:
+            self._deliveries.put_nowait(update)
+        else:
+            self._pending.append(update)
+            self._new_updates.set()
+
+    def deliver_to(self, port, path, secret):
+        """Switch to webhook mode: POST updates over a few keep-alive connections"""
+        self._workers = [
+            asyncio.create_task(self._deliver(port, path, secret)) for _ in range(WEBHOOK_CONNECTIONS)
+        ]
+
+    async def _deliver(self, port, path, secret):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        while True:
+            body = json.dumps(await self._deliveries.get()).encode()
+            writer.write(
+                f"POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n{SECRET_HEADER}: {secret}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            await read_response(reader)
+
+
+async def read_response(reader):
+    """(status, payload) of one HTTP response from the webhook server"""
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        if line.lower().startswith(b'content-length:'):
+            length = int(line.split(b':', 1)[1])
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def request(port, method, path, payload=None, secret=None):
+    """(status, payload) of one request on a fresh connection"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = json.dumps(payload).encode() if payload is not None else b''
+    head = f"{method} {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\nContent-Length: {len(body)}\r\n"
+    if payload is not None:
+        head += "Content-Type: application/json\r\n"
+    if secret is not None:
+        head += f"{SECRET_HEADER}: {secret}\r\n"
+    writer.write((head + "\r\n").encode() + body)
+    await writer.drain()
+    try:
+        return await read_response(reader)
+    finally:
+        writer.close()
+
+
+async def measure(mode, n_updates, rate):
+    telegram = FakeTelegram()
+    await telegram.start()
+    latencies = []
+    done = asyncio.Event()
+
+    async def record(update, context):
+        latencies.append(time.perf_counter() - telegram.sent_at[update.update_id])
+        if len(latencies) == n_updates:
+            done.set()
+
+    builder = ApplicationBuilder().token(TOKEN).base_url(telegram.base_url).concurrent_updates(True)
+    if mode == 'webhook':
+        builder = builder.updater(None)
+    app = builder.build()
+    app.add_handler(TypeHandler(Update, record))
+
+    server = None
+    async with app:
+        if mode == 'webhook':
+            server = WebhookServer(
+                lambda data: app.update_queue.put(Update.de_json(data, app.bot)),
+                '/telegram', SECRET, '127.0.0.1', 0
+            )
+            await server.start()
+            telegram.deliver_to(server.port, '/telegram', SECRET)
+        else:
+            await app.updater.start_polling(poll_interval=0, timeout=10)
+        await app.start()
+
+        started = time.perf_counter()
+        for update_id in range(1, n_updates + 1):
+            telegram.push(make_update(update_id))
+            await asyncio.sleep(1 / rate)
+        await asyncio.wait_for(done.wait(), timeout=60)
+        elapsed = time.perf_counter() - started
+
+        if server is not None:
+            await server.stop()
+        else:
+            await app.updater.stop()
+        await app.stop()
+    await telegram.stop()
+
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1e3
+    print(f"{mode:8} {n_updates / elapsed:8.0f} updates/s  "
+          f"p50 {pct(0.50):7.2f} ms  p95 {pct(0.95):7.2f} ms  p99 {pct(0.99):7.2f} ms  "
+          f"mean {statistics.mean(latencies) * 1e3:7.2f} ms")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def check_app(n_updates):
+    """Problems found serving updates through main.run_webhook"""
+    telegram = FakeTelegram()
+    await telegram.start()
+    port = free_port()
+    main = import_bot(UPDATE_MODE='webhook', WEBHOOK_PORT=port, WEBHOOK_SECRET=SECRET,
+                      BOT_API_URL=telegram.base_url)
+    serving = asyncio.create_task(main.run_webhook(main.build_application()))
+    problems = []
+    try:
+        for _ in range(100):
+            try:
+                status, health = await request(port, 'GET', main.HEALTH_PATH)
+                break
+            except ConnectionError:
+                await asyncio.sleep(0.1)
+        else:
+            return [f"the webhook never listened on port {port}"]
+        if status != 200 or 'queued' not in health:
+            problems.append(f"health route answered {status} {health}")
+
+        # Update 0 comes with a wrong secret, then without one: neither may run
+        for secret in ('wrong', None):
+            status, _ = await request(port, 'POST', main.WEBHOOK_PATH, make_update(0, True, '/start'), secret)
+            if status != 403:
+                problems.append(f"{status} instead of 403 with secret {secret!r}")
+
+        started = time.perf_counter()
+        for update_id in range(1, n_updates + 1):
+            telegram.sent_at[PRIVATE_USERS + update_id] = time.perf_counter()
+            status, _ = await request(port, 'POST', main.WEBHOOK_PATH, make_update(update_id, True, '/start'), SECRET)
+            if status != 200:
+                problems.append(f"update {update_id} answered {status}")
+        expected = {PRIVATE_USERS + update_id for update_id in range(1, n_updates + 1)}
+        deadline = time.monotonic() + 60
+        while not expected <= telegram.replied_at.keys() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        missing = expected - telegram.replied_at.keys()
+        if missing:
+            problems.append(f"{len(missing)} of {n_updates} /start updates got no reply")
+        if PRIVATE_USERS in telegram.replied_at:
+            problems.append("the update with a wrong secret was handled")
+        latencies = sorted(telegram.replied_at[chat] - telegram.sent_at[chat] for chat in expected - missing)
+        if latencies:
+            print(f"{'app':8} {len(latencies) / elapsed:8.0f} updates/s  "
+                  f"p50 {latencies[len(latencies) // 2] * 1e3:7.2f} ms  max {latencies[-1] * 1e3:7.2f} ms  "
+                  f"(main.run_webhook, /start to the reply)")
+    finally:
+        # run_webhook stops on SIGTERM, like under a service manager
+        os.kill(os.getpid(), signal.SIGTERM)
+        try:
+            await asyncio.wait_for(serving, timeout=30)
+        except asyncio.TimeoutError:
+            problems.append("run_webhook did not stop on SIGTERM")
+        await telegram.stop()
+    return problems
+
+
+def main():
+    n_updates = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    app_updates = int(sys.argv[3]) if len(sys.argv) > 3 else 100
+    for mode in ('polling', 'webhook'):
+        asyncio.run(measure(mode, n_updates, rate))
+    problems = asyncio.run(check_app(app_updates))
+    print("\n".join(f"FAILED: {problem}" for problem in problems) if problems else "OK")
+    raise SystemExit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
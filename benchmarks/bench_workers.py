@@ -0,0 +1,212 @@
+# Conservation check for WORKERS > 1: N processes play duels and lottery
+# rounds on one shared SQLite database. Each handles the chats
+# main.owns_chat() gives it, and every user plays in every chat, so the
+# same balances are hit from all processes at once. The workers elect the
+# lottery leader through the lease table; halfway through the leader
+# stalls and another one takes over. At the end the cm held by users, open
+# bets and escrowed challenges must add up to what the users started with,
+# and no round may have been settled twice.
+# Usage: python benchmarks/bench_workers.py [--workers 4] [--chats 16] [--users 200] [--seconds 20]
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+START_LENGTH = 1000
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+def chat_ids(chats):
+    return [-1000 - i for i in range(chats)]
+
+
+# === Worker process ===
+async def play(main, args):
+    from fakes import FakeBot, button_data, callback_update, command_update
+
+    bot = FakeBot(args.latency)
+    app = type('App', (), {'bot': bot})()
+    chats = [chat_id for chat_id in chat_ids(args.chats) if main.owns_chat(chat_id)]
+    users = list(range(1, args.users + 1))
+    settled = []
+    settle_lottery = main.store.settle_lottery
+
+    def record_settlement(chat_id, credits, winning_number=None, totals=None):
+        # Rounds are told apart by the deadline they were drawn at
+        end_time = main.store.lottery_end_time(chat_id)
+        done = settle_lottery(chat_id, credits, winning_number, totals)
+        if done:
+            settled.append([str(chat_id), end_time])
+        return done
+
+    main.store.settle_lottery = record_settlement
+    await main.post_init(app)
+
+    counts = {'duels': 0, 'accepted': 0, 'bets': 0}
+    # Staggered stops, so the leader hands over to the workers still running
+    deadline = time.time() + args.seconds * (1 + args.index / (2 * args.workers))
+
+    async def send(callback, update, context):
+        await main.remember_user(update, context)
+        await callback(update, context)
+
+    async def session(user_id):
+        while time.time() < deadline and chats:
+            chat_id = random.choice(chats)
+            if random.random() < 0.5:
+                number = 1 + random.randrange(10)
+                await send(main.schedina, *command_update(bot, user_id, chat_id, f"/schedina {number} {random.randint(1, 10)}"))
+                counts['bets'] += 1
+            else:
+                command = command_update(bot, user_id, chat_id, f"/duello_pisello {random.randint(1, 20)}")
+                await send(main.duello_pisello, *command)
+                counts['duels'] += 1
+                data = button_data(command[0])
+                # Some duels are left open: they expire and refund the stake
+                if data is not None and random.random() < 0.8:
+                    rival = random.choice(users)
+                    await send(main.handle_duel_callback, *callback_update(bot, rival, chat_id, data))
+                    counts['accepted'] += 1
+            await asyncio.sleep(0)
+
+    async def stall_leader():
+        # Halfway through, the leader stops renewing its lease for two TTLs
+        # but keeps drawing, as if it hung: another worker takes over and
+        # both draw until the old one notices, so only settle_lottery()'s
+        # bet check keeps a round from being paid twice
+        await asyncio.sleep(args.seconds / 2)
+        election = main.lottery_election
+        if election.leader:
+            await election.stop_renewing()
+            counts['stalled'] = 1
+            await asyncio.sleep(2 * args.lease)
+            election.start()
+
+    counts['stalled'] = 0
+    started = time.perf_counter()
+    await asyncio.gather(stall_leader(), *(session(user_id) for user_id in users))
+    elapsed = time.perf_counter() - started
+    elections = main.lottery_election.elections
+    await main.post_shutdown(app)
+    return {'worker': args.index, 'chats': len(chats), 'elapsed_s': elapsed, **counts,
+            'elections': elections, 'settled': settled}
+
+
+def run_worker(args):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fakes import import_bot
+
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    random.seed(args.index)
+    main = import_bot(
+        STORAGE_BACKEND='sqlite', SQLITE_FILE=args.db, WORKERS=args.workers, WORKER_INDEX=args.index,
+        LEADER_LEASE_TTL=args.lease, CHALLENGE_TTL=args.challenge_ttl,
+        THROTTLE_USER_RATE=0, THROTTLE_CHAT_RATE=0, LOOP_LAG_THRESHOLD=0,
+    )
+    main.LOTTERY_INTERVAL = args.lottery_interval
+    result = asyncio.run(play(main, args))
+    result['errors'] = errors.count
+    print(json.dumps(result))
+
+
+# === Parent ===
+def held_cm(db):
+    """cm on balances, in open bets and in escrowed challenges"""
+    conn = sqlite3.connect(db)
+    users = conn.execute("SELECT COALESCE(SUM(length), 0), COUNT(*) FROM users").fetchone()
+    bets = conn.execute("SELECT COALESCE(SUM(amount), 0) FROM chat_bets").fetchone()[0]
+    escrow = conn.execute(
+        "SELECT COALESCE(SUM(json_extract(record, '$.bet')), 0) FROM chat_duels "
+        "WHERE json_extract(record, '$.escrowed')"
+    ).fetchone()[0]
+    conn.close()
+    return users[0], bets, escrow, users[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared-state conservation check with several worker processes")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chats', type=int, default=16)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seconds', type=float, default=20, help="play time of the first worker")
+    parser.add_argument('--latency', type=float, default=0.01, help="fake Bot API latency in seconds")
+    parser.add_argument('--lottery-interval', type=float, default=2)
+    parser.add_argument('--lease', type=float, default=3, help="LEADER_LEASE_TTL in seconds")
+    parser.add_argument('--challenge-ttl', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=60, help="seconds a worker may take past --seconds to exit")
+    parser.add_argument('--worker', dest='index', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--db', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.index is not None:
+        run_worker(args)
+        return
+
+    sys.path.insert(0, ROOT)
+    from storage import SqliteStorage
+
+    with tempfile.TemporaryDirectory() as workdir:
+        db = os.path.join(workdir, 'shared.db')
+        store = SqliteStorage(db)
+        for user_id in range(1, args.users + 1):
+            store.apply_delta(user_id, values={'length': START_LENGTH})
+        store.conn.close()
+        expected = args.users * START_LENGTH
+
+        command = [sys.executable, os.path.abspath(__file__), '--db', db] + sys.argv[1:]
+        env = dict(os.environ, BOT_TOKEN='123:bench')
+        processes = [
+            subprocess.Popen(command + ['--worker', str(index)], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, text=True, env=env)
+            for index in range(args.workers)
+        ]
+        deadline = time.monotonic() + args.seconds + args.timeout
+        results = []
+        for index, process in enumerate(processes):
+            try:
+                output = process.communicate(timeout=max(deadline - time.monotonic(), 0))[0]
+            except subprocess.TimeoutExpired:
+                for stuck in processes:
+                    stuck.kill()
+                    stuck.wait()
+                print(f"FAILED: worker {index} still running {args.timeout:.0f}s after the end of play")
+                raise SystemExit(1)
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        balances, bets, escrow, user_count = held_cm(db)
+
+    print(f"{'worker':>6} {'chats':>6} {'duels':>7} {'accepted':>9} {'bets':>7} {'ops/s':>7} "
+          f"{'elected':>8} {'stalled':>8} {'draws':>6} {'errors':>7}")
+    for r in results:
+        ops = r['duels'] + r['accepted'] + r['bets']
+        print(f"{r['worker']:>6} {r['chats']:>6} {r['duels']:>7} {r['accepted']:>9} {r['bets']:>7} "
+              f"{ops / r['elapsed_s']:>7.0f} {r['elections']:>8} {r['stalled']:>8} {len(r['settled']):>6} "
+              f"{r['errors']:>7}")
+
+    rounds = [tuple(round_) for r in results for round_ in r['settled']]
+    held = balances + bets + escrow
+    print(f"\n{user_count} users: {balances} cm on balances + {bets} in open bets + {escrow} escrowed = {held} cm "
+          f"(started with {expected})")
+    print(f"Rounds settled: {len(rounds)}, settled twice: {len(rounds) - len(set(rounds))}")
+    ok = held == expected and len(rounds) == len(set(rounds)) and user_count == args.users
+    print("OK: length conserved" if ok else "FAILED: length not conserved")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
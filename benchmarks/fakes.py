@@ -0,0 +1,134 @@
+# Local stand-ins for the Telegram objects the handlers touch.
+# FakeBot records every outgoing call and can add latency to each one.
+import asyncio
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+from types import SimpleNamespace
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def import_bot(seed=None, **env):
+    """Import main.py inside a scratch directory so benchmarks never touch real data
+
+    seed maps names in the scratch directory to files or directories copied
+    there first, e.g. {'zucchini_data.json': '/srv/bot/zucchini_data.json'}.
+    """
+    os.environ.setdefault('BOT_TOKEN', '123:bench')
+    for key, value in env.items():
+        os.environ[key] = str(value)
+    workdir = tempfile.mkdtemp(prefix='zucchini-bench-')
+    for name, source in (seed or {}).items():
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(workdir, name))
+        else:
+            shutil.copy2(source, os.path.join(workdir, name))
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import main
+    main.startup()
+    return main
+
+
+class FakeBot:
+    """Records outgoing Bot API calls, each delayed by latency seconds"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+
+    async def _call(self, method, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls.append((method, kwargs))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call('send_message', chat_id=chat_id, text=text)
+
+    async def edit_message_text(self, text, **kwargs):
+        await self._call('edit_message_text', text=text)
+
+    async def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        await self._call('answer_callback_query', text=text)
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self._call('get_chat_member', chat_id=chat_id, user_id=user_id)
+        return SimpleNamespace(user=make_user(user_id))
+
+    def texts(self, method):
+        return [kwargs.get('text') for name, kwargs in self.calls if name == method]
+
+
+def make_user(user_id):
+    return SimpleNamespace(id=int(user_id), username=f"user{user_id}", first_name=None, is_bot=False)
+
+
+_update_ids = itertools.count(1)
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id, text):
+        self._bot = bot
+        self.chat = SimpleNamespace(id=chat_id, type='group')
+        self.chat_id = chat_id
+        self.text = text
+        self.message_id = next(_update_ids)
+        self.replies = []   # (text, reply_markup), so scenarios can press the buttons
+
+    async def reply_text(self, text, **kwargs):
+        await self._bot.send_message(self.chat_id, text, **kwargs)
+        self.replies.append((text, kwargs.get('reply_markup')))
+        return self
+
+
+class FakeCallbackQuery:
+    def __init__(self, bot, user, chat_id, data):
+        self._bot = bot
+        self.id = str(next(_update_ids))
+        self.from_user = user
+        self.data = data
+        self.message = FakeMessage(bot, chat_id, None)
+
+    async def answer(self, text=None, **kwargs):
+        await self._bot.answer_callback_query(self.id, text, **kwargs)
+
+    async def edit_message_text(self, text, **kwargs):
+        await self._bot.edit_message_text(text, **kwargs)
+
+
+def command_update(bot, user_id, chat_id, text):
+    """(update, context) for a /command message"""
+    user = make_user(user_id)
+    update = SimpleNamespace(
+        update_id=next(_update_ids),
+        effective_user=user,
+        effective_chat=SimpleNamespace(id=chat_id, type='group'),
+        message=FakeMessage(bot, chat_id, text),
+        callback_query=None,
+    )
+    return update, SimpleNamespace(args=text.split()[1:], bot=bot)
+
+
+def button_data(update, row=0):
+    """callback_data of a button in the handler's last reply, None if it had none"""
+    replies = update.message.replies
+    markup = replies[-1][1] if replies else None
+    if markup is None:
+        return None
+    return markup.inline_keyboard[row][0].callback_data
+
+
+def callback_update(bot, user_id, chat_id, data):
+    """(update, context) for an inline button press"""
+    user = make_user(user_id)
+    update = SimpleNamespace(
+        update_id=next(_update_ids),
+        effective_user=user,
+        effective_chat=SimpleNamespace(id=chat_id, type='group'),
+        message=None,
+        callback_query=FakeCallbackQuery(bot, user, chat_id, data),
+    )
+    return update, SimpleNamespace(args=[], bot=bot)
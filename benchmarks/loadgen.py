@@ -0,0 +1,269 @@
+# Offline load generator: simulated users send commands and press buttons
+# through the same handler table main() registers, against a FakeBot with
+# configurable latency. Reports throughput and per-command latency
+# percentiles and saves them as JSON to compare across commits.
+#
+#   python benchmarks/loadgen.py --users 500 --requests 20000 --latency 0.05
+#   python benchmarks/loadgen.py --mix coinflip=5,classifica=1 --compare old.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import time
+
+from telegram.ext import ApplicationHandlerStop
+
+from fakes import FakeBot, button_data, callback_update, command_update, import_bot
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CHAT_ID = -100
+START_LENGTH = 1000
+
+# Relative weight of each scenario; a scenario may send several updates
+DEFAULT_MIX = {
+    'start': 1,
+    'razione_giornaliera': 2,
+    'elemosina': 2,
+    'coinflip': 4,
+    'duello_pisello': 3,
+    'schedina': 3,
+    'superenalotto': 2,
+    'classifica': 2,
+    'tessera_del_pane': 1,
+    'grazie_mosca': 1,
+}
+
+
+def scenario(bot, name, user_id, users):
+    """[(label, make)] run one after the other by one user; make() builds the
+    (update, context) to send, or None to end the scenario early"""
+    if name == 'coinflip':
+        command = command_update(bot, user_id, CHAT_ID, f"/coinflip {random.randint(1, 20)}")
+        return [
+            ('coinflip', lambda: command),
+            ('coinflip:press', lambda: press(bot, user_id, command[0], random.randint(0, 1))),
+        ]
+    if name == 'duello_pisello':
+        rival = random.choice(users)
+        command = command_update(bot, user_id, CHAT_ID, f"/duello_pisello {random.randint(1, 20)}")
+        return [
+            ('duello_pisello', lambda: command),
+            ('duel:accept', lambda: press(bot, rival, command[0])),
+        ]
+    if name == 'schedina':
+        number = 1 + user_id % 10
+        return [('schedina', lambda: command_update(bot, user_id, CHAT_ID, f"/schedina {number} {random.randint(1, 10)}"))]
+    if name == 'classifica':
+        return [
+            ('classifica', lambda: command_update(bot, user_id, CHAT_ID, "/classifica")),
+            ('classifica:page', lambda: callback_update(bot, user_id, CHAT_ID, f"classifica:{random.randint(1, 5)}")),
+        ]
+    return [(name, lambda: command_update(bot, user_id, CHAT_ID, f"/{name}"))]
+
+
+def press(bot, user_id, command, row=0):
+    """Button press on the reply to command, None if it came without buttons"""
+    data = button_data(command, row)
+    return callback_update(bot, user_id, CHAT_ID, data) if data is not None else None
+
+
+def route(main, update):
+    """The callback main.register_handlers() dispatches an update to"""
+    if update.callback_query is not None:
+        for pattern, callback in main.CALLBACKS.items():
+            if re.match(pattern, update.callback_query.data):
+                return callback
+        return None
+    command = update.message.text.split()[0][1:].split('@')[0]
+    return main.COMMANDS.get(command)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.throttled = {}
+
+    def add(self, label, seconds):
+        self.latencies.setdefault(label, []).append(seconds)
+
+    def error(self, label):
+        self.errors[label] = self.errors.get(label, 0) + 1
+
+    def throttle(self, label):
+        self.throttled[label] = self.throttled.get(label, 0) + 1
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def summarize(values, elapsed):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'throughput': len(values) / elapsed,
+        'p50_ms': percentile(values, 0.50) * 1e3,
+        'p95_ms': percentile(values, 0.95) * 1e3,
+        'p99_ms': percentile(values, 0.99) * 1e3,
+        'max_ms': values[-1] * 1e3,
+    }
+
+
+async def run(main, args, mix):
+    bot = FakeBot(args.latency)
+    users = list(range(1, args.users + 1))
+    for uid in users:
+        main.update_user(uid, values={'length': START_LENGTH})
+
+    processor = None
+    if args.concurrency > 1:
+        processor = main.KeyedUpdateProcessor(args.concurrency, main.MAX_QUEUE_PER_KEY)
+        await processor.initialize()
+
+    # Without a processor updates run one at a time, like CONCURRENT_UPDATES=1
+    sequential = asyncio.Lock() if processor is None else None
+    recorder = Recorder()
+    names, weights = list(mix), list(mix.values())
+    remaining = [args.requests]
+
+    async def dispatch(label, update, context):
+        callback = route(main, update)
+
+        async def handle():
+            # Groups -2 and -1 first, like PTB
+            await main.remember_user(update, context)
+            try:
+                await main.throttle_update(update, context)
+            except ApplicationHandlerStop:
+                recorder.throttle(label)
+                return
+            await callback(update, context)
+
+        started = time.perf_counter()
+        try:
+            if processor is not None:
+                await processor.process_update(update, handle())
+            else:
+                async with sequential:
+                    await handle()
+        except Exception:
+            recorder.error(label)
+        recorder.add(label, time.perf_counter() - started)
+
+    async def session(user_id):
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            name = random.choices(names, weights)[0]
+            for label, make in scenario(bot, name, user_id, users):
+                fake = make()
+                if fake is None:
+                    break
+                await dispatch(label, *fake)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(session(uid) for uid in users))
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [s for values in recorder.latencies.values() for s in values]
+    return {
+        'total': {**summarize(all_latencies, elapsed), 'elapsed_s': elapsed,
+                  'bot_calls': len(bot.calls), 'errors': sum(recorder.errors.values()),
+                  'throttled': sum(recorder.throttled.values())},
+        'commands': {
+            label: {**summarize(values, elapsed), 'errors': recorder.errors.get(label, 0),
+                    'throttled': recorder.throttled.get(label, 0)}
+            for label, values in sorted(recorder.latencies.items())
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def parse_mix(text):
+    if not text:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in DEFAULT_MIX:
+            raise SystemExit(f"Scenario sconosciuto: {name} (disponibili: {', '.join(DEFAULT_MIX)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def print_report(result, baseline=None):
+    print(f"{'command':<22} {'count':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7} "
+          f"{'throttled':>9}")
+    rows = list(result['commands'].items()) + [('TOTAL', result['total'])]
+    for label, row in rows:
+        line = (f"{label:<22} {row['count']:>7} {row['throughput']:>9.0f} {row['p50_ms']:>9.2f} "
+                f"{row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['errors']:>7} {row.get('throttled', 0):>9}")
+        old = (baseline or {}).get('commands', {}).get(label) if label != 'TOTAL' else (baseline or {}).get('total')
+        if old:
+            line += f"   p99 {row['p99_ms'] - old['p99_ms']:+.2f} ms, req/s {row['throughput'] / old['throughput'] - 1:+.0%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the bot's handlers")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=5000, help="scenarios to run in total")
+    parser.add_argument('--mix', help="scenario weights, e.g. coinflip=3,schedina=1")
+    parser.add_argument('--latency', type=float, default=0.02, help="fake Bot API latency in seconds")
+    parser.add_argument('--concurrency', type=int, default=32, help="KeyedUpdateProcessor slots, 1 = sequential")
+    parser.add_argument('--throttle', action='store_true',
+                        help="apply the per-user and per-chat rate limits (cooldowns always apply)")
+    parser.add_argument('--backend', default='json', choices=('json', 'sqlite'))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="JSON results file (default benchmarks/results/loadgen-<commit>.json)")
+    parser.add_argument('--compare', help="earlier results file to diff against")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    commit = git_commit()
+    output = os.path.abspath(args.output or os.path.join(ROOT, 'benchmarks', 'results', f"loadgen-{commit}.json"))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    random.seed(args.seed)
+    # Simulated users fire as fast as they can: without --throttle only measure the handlers
+    limits = {} if args.throttle else {'THROTTLE_USER_RATE': 0, 'THROTTLE_CHAT_RATE': 0}
+    bot_main = import_bot(STORAGE_BACKEND=args.backend, CONCURRENT_UPDATES=args.concurrency, **limits)
+    result = asyncio.run(run(bot_main, args, mix))
+    result['meta'] = {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'users': args.users,
+        'requests': args.requests,
+        'mix': mix,
+        'latency_s': args.latency,
+        'concurrency': args.concurrency,
+        'backend': args.backend,
+        'throttle': args.throttle,
+        'seed': args.seed,
+    }
+
+    print_report(result, baseline)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"\nRisultati salvati in {output}")
+
+
+if __name__ == '__main__':
+    main()
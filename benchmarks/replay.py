@@ -0,0 +1,224 @@
+# Replays a capture recorded with CAPTURE_FILE through the real handler table
+# against a FakeBot and a copy of zucchini_data.json. Time runs at the
+# capture's pace (--speed 1), N times faster, or as fast as possible (max);
+# handlers and lottery deadlines see the capture's clock either way.
+# Reports per-command latency percentiles and how the users' state changed.
+#
+#   python benchmarks/replay.py captures/updates.jsonl.gz --data zucchini_data.json --speed 10
+#   python benchmarks/replay.py updates.jsonl.gz --data before.json --expect after.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+from telegram.ext import ApplicationHandlerStop
+
+from fakes import FakeBot, callback_update, command_update, import_bot
+from loadgen import Recorder, print_report, route, summarize
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from capture import read_capture
+from storage import load_data
+
+
+def to_fake(bot, data):
+    """(label, update, context) from a recorded Update dict; None if no handler cares"""
+    query = data.get('callback_query')
+    if query is not None and query.get('message'):
+        label = query['data'].split(':')[0] + ':press'
+        return (label, *callback_update(bot, query['from']['id'], query['message']['chat']['id'], query['data']))
+    message = data.get('message')
+    if message is not None and (message.get('text') or '').startswith('/') and message.get('from'):
+        label = message['text'].split()[0][1:].split('@')[0]
+        return (label, *command_update(bot, message['from']['id'], message['chat']['id'], message['text']))
+    return None
+
+
+def user_state(store):
+    return {uid: store.get_user(uid).to_json() for uid, _ in store.range(0, store.user_count())}
+
+
+def diff_states(before, after, top=5):
+    changed = {uid: after[uid]['length'] - before.get(uid, {}).get('length', 0)
+               for uid in after if after[uid] != before.get(uid)}
+    movers = sorted(changed.items(), key=lambda item: abs(item[1]), reverse=True)[:top]
+    return {
+        'users_before': len(before),
+        'users_after': len(after),
+        'users_new': len(after.keys() - before.keys()),
+        'users_changed': len(changed),
+        'length_before': sum(u['length'] for u in before.values()),
+        'length_after': sum(u['length'] for u in after.values()),
+        'top_movers': movers,
+    }
+
+
+def compare_expected(after, expected, limit=10):
+    """Users whose replayed length differs from the expected file"""
+    mismatches = []
+    for uid in sorted(after.keys() | expected.keys()):
+        got = after.get(uid, {}).get('length')
+        want = expected.get(uid, {}).get('length')
+        if got != want:
+            mismatches.append((uid, got, want))
+    return {'mismatches': len(mismatches), 'first': mismatches[:limit]}
+
+
+async def replay(main, records, args):
+    bot = FakeBot(args.latency)
+    speed = None if args.speed == 'max' else float(args.speed)
+    capture_start = records[0][0]
+    # The handlers' clock follows the capture
+    clock = {'now': capture_start}
+    started = time.perf_counter()
+
+    def virtual_now():
+        if speed is None:
+            return clock['now']
+        return capture_start + (time.perf_counter() - started) * speed
+    main.now = virtual_now
+
+    processor = None
+    if args.concurrency > 1:
+        processor = main.KeyedUpdateProcessor(args.concurrency, main.MAX_QUEUE_PER_KEY)
+        await processor.initialize()
+    sequential = asyncio.Lock() if processor is None else None
+    recorder = Recorder()
+    draws = [0]
+
+    main.restore_challenges()
+
+    async def run_due_draws():
+        # Stands in for the DeadlineSchedulers, which run on the real clock
+        for chat_id, end_time in list(main.store.open_rounds().items()):
+            if end_time <= virtual_now():
+                await main.draw_lottery(bot_app, chat_id)
+                draws[0] += 1
+        for key in main.pending_challenges.scheduler.pop_due(virtual_now()):
+            await main.expire_challenge(bot_app, key)
+
+    async def dispatch(label, update, context, due):
+        callback = route(main, update)
+        if callback is None:
+            return
+
+        async def handle():
+            await main.remember_user(update, context)
+            try:
+                await main.throttle_update(update, context)
+            except ApplicationHandlerStop:
+                recorder.throttle(label)
+                return
+            await callback(update, context)
+
+        try:
+            if processor is not None:
+                await processor.process_update(update, handle())
+            else:
+                async with sequential:
+                    await handle()
+        except Exception:
+            recorder.error(label)
+        # Measured from when the update was due, so falling behind shows up
+        recorder.add(label, time.perf_counter() - due)
+
+    bot_app = type('App', (), {'bot': bot})()
+    tasks = []
+    skipped = 0
+    for arrival, data in records:
+        fake = to_fake(bot, data)
+        if fake is None:
+            skipped += 1
+            continue
+        due = time.perf_counter()
+        if speed is not None:
+            due = started + (arrival - capture_start) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            clock['now'] = arrival
+        await run_due_draws()
+        tasks.append(asyncio.create_task(dispatch(*fake, due)))
+        if speed is None:
+            # Give the task a chance to start, like a real arrival gap would
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [s for values in recorder.latencies.values() for s in values]
+    return {
+        'total': {**summarize(all_latencies or [0.0], elapsed), 'elapsed_s': elapsed,
+                  'captured_s': records[-1][0] - capture_start, 'skipped': skipped,
+                  'draws': draws[0], 'bot_calls': len(bot.calls), 'errors': sum(recorder.errors.values()),
+                  'throttled': sum(recorder.throttled.values())},
+        'commands': {
+            label: {**summarize(values, elapsed), 'errors': recorder.errors.get(label, 0),
+                    'throttled': recorder.throttled.get(label, 0)}
+            for label, values in sorted(recorder.latencies.items())
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a captured update stream against the handlers")
+    parser.add_argument('capture', help="CAPTURE_FILE path; rotated .1, .2, ... files are read too")
+    parser.add_argument('--data', help="zucchini_data.json to start from (copied, never modified); "
+                                       "its binary snapshot, journal and chats/ directory are copied too if present")
+    parser.add_argument('--speed', default='max', help="1 = real time, N = N times faster, max = no waiting")
+    parser.add_argument('--latency', type=float, default=0.02, help="fake Bot API latency in seconds")
+    parser.add_argument('--concurrency', type=int, default=32, help="KeyedUpdateProcessor slots, 1 = sequential")
+    parser.add_argument('--expect', help="zucchini_data.json taken after the capture, to diff the end state against")
+    parser.add_argument('--seed', type=int, default=1, help="random seed for coinflips, duels and draws")
+    parser.add_argument('--output', help="write the report as JSON")
+    args = parser.parse_args()
+    # import_bot() changes directory
+    expect = os.path.abspath(args.expect) if args.expect else None
+    output = os.path.abspath(args.output) if args.output else None
+
+    records = sorted(read_capture(args.capture), key=lambda record: record[0])
+    if not records:
+        raise SystemExit(f"Nessun update in {args.capture}")
+
+    seed = {}
+    if args.data:
+        seed['zucchini_data.json'] = args.data
+        directory = os.path.dirname(os.path.abspath(args.data))
+        for name in ('zucchini_data.snap', 'zucchini_data.journal', 'chats'):
+            if os.path.exists(os.path.join(directory, name)):
+                seed[name] = os.path.join(directory, name)
+
+    random.seed(args.seed)
+    bot_main = import_bot(seed, STORAGE_BACKEND='json', CONCURRENT_UPDATES=args.concurrency)
+    before = user_state(bot_main.store)
+    result = asyncio.run(replay(bot_main, records, args))
+    after = user_state(bot_main.store)
+    result['state'] = diff_states(before, after)
+    if expect:
+        expected = {uid: u.to_json() for uid, u in load_data(expect)['users'].items()}
+        result['expected'] = compare_expected(after, expected)
+
+    total, state = result['total'], result['state']
+    print(f"{len(records)} update registrati in {total['captured_s']:.0f}s, "
+          f"riprodotti in {total['elapsed_s']:.1f}s (speed {args.speed}), {total['skipped']} ignorati, "
+          f"{total['draws']} estrazioni\n")
+    print_report(result)
+    print(f"\nUtenti: {state['users_before']} -> {state['users_after']} "
+          f"({state['users_new']} nuovi, {state['users_changed']} modificati)")
+    print(f"Lunghezza totale: {state['length_before']} -> {state['length_after']} cm")
+    for uid, delta in state['top_movers']:
+        print(f"  {uid}: {delta:+d} cm")
+    if 'expected' in result:
+        print(f"Differenze rispetto a {args.expect}: {result['expected']['mismatches']} utenti")
+        for uid, got, want in result['expected']['first']:
+            print(f"  {uid}: replay {got}, atteso {want}")
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# Zucchini Telegram Bot - Update capture
+# Opt-in recording of every incoming update, with its arrival time, as
+# gzip-compressed JSON lines rotated by size. benchmarks/replay.py feeds a
+# capture back through the handlers.
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+# Callback data fields that hold a challenge id, which older buttons set to
+# the owner's user id ("duel:accept:123456789"); other fields (pages,
+# coinflip sides) and command arguments such as bet amounts are kept as-is
+CALLBACK_ID_FIELDS = {'coinflip': 1, 'duel': 2}
+NAME_FIELDS = ('first_name', 'last_name', 'username', 'title')
+
+
+class Anonymizer:
+    """Replaces user and chat ids with stable keyed pseudonyms and drops names"""
+
+    def __init__(self, key):
+        self.key = key.encode()
+
+    def pseudonym(self, value):
+        value = int(value)
+        digest = hmac.new(self.key, str(abs(value)).encode(), hashlib.sha256).digest()
+        # Same sign and still 10 digits, so group chats stay negative
+        pseudo = 1_000_000_000 + int.from_bytes(digest[:8], 'big') % 1_000_000_000
+        return -pseudo if value < 0 else pseudo
+
+    def _callback_data(self, data):
+        fields = data.split(':')
+        index = CALLBACK_ID_FIELDS.get(fields[0])
+        if index is not None and index < len(fields) and re.fullmatch(r'-?\d+', fields[index]):
+            fields[index] = str(self.pseudonym(fields[index]))
+        return ':'.join(fields)
+
+    def update(self, data):
+        """Anonymised deep copy of an Update dict"""
+        if isinstance(data, list):
+            return [self.update(item) for item in data]
+        if not isinstance(data, dict):
+            return data
+        result = {}
+        for key, value in data.items():
+            if key in ('id', 'user_id', 'chat_id') and isinstance(value, int) and abs(value) >= 10_000:
+                result[key] = self.pseudonym(value)
+            elif key in NAME_FIELDS and isinstance(value, str):
+                result[key] = 'anon'
+            elif key == 'data' and isinstance(value, str):
+                result[key] = self._callback_data(value)
+            elif key == 'text' and isinstance(value, str):
+                # Keep commands and their arguments, never free text; users
+                # mentioned in it are only ids in its entities
+                result[key] = value if value.startswith('/') else ''
+            else:
+                result[key] = self.update(value)
+        return result
+
+
+def capture_files(path):
+    """Existing files of a capture, oldest first"""
+    rotated = []
+    i = 1
+    while os.path.exists(f"{path}.{i}"):
+        rotated.append(f"{path}.{i}")
+        i += 1
+    files = rotated[::-1]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_capture(path):
+    """Yield (arrival time, update dict) from a capture and its rotated files"""
+    for file in capture_files(path):
+        with gzip.open(file, 'rt') as f:
+            try:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    yield record['t'], record['u']
+            except EOFError:
+                # The bot stopped without closing the file; earlier lines are fine
+                logger.warning(f"Capture {file} troncata")
+
+
+class UpdateRecorder:
+    """Buffers updates on the loop and appends them to the capture off the loop"""
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, backups=5, anonymize_key=None,
+                 flush_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.anonymizer = Anonymizer(anonymize_key) if anonymize_key else None
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self._buffer = []
+        self._file = None
+        self._task = None
+        self._flush_lock = asyncio.Lock()
+
+    def record(self, update, arrival=None):
+        """Queue one update dict for writing"""
+        if self.anonymizer is not None:
+            update = self.anonymizer.update(update)
+        self._buffer.append(json.dumps(
+            {'t': round(arrival or time.time(), 3), 'u': update}, separators=(',', ':')
+        ))
+        self.recorded += 1
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.error("Errore nella registrazione degli update:\n" + traceback.format_exc())
+
+    async def flush(self):
+        async with self._flush_lock:
+            if self._buffer:
+                lines, self._buffer = self._buffer, []
+                await asyncio.to_thread(self._write, lines)
+
+    def _write(self, lines):
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # A restart appends a new gzip member, which readers handle
+            self._file = gzip.open(self.path, 'ab')
+        self._file.write(('\n'.join(lines) + '\n').encode())
+        self._file.flush()
+        if self._file.fileobj.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self._file is not None:
+            await asyncio.to_thread(self._file.close)
+            self._file = None
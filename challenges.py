@@ -0,0 +1,95 @@
+# Zucchini Telegram Bot - Pending challenges
+# Coinflips and duels waiting for a button press are typed records with a
+# creation time and an expiry. One deadline heap expires them in
+# O(expired) and a per-owner index caps how many each user keeps open.
+import collections
+
+from scheduler import DeadlineScheduler
+
+COINFLIP = 'coinflip'
+DUEL = 'duel'
+
+
+def new_challenge(kind, owner, bet, created, ttl):
+    """Record of a challenge whose stake was already taken from the owner"""
+    return {
+        'type': kind,
+        'owner': str(owner),
+        'bet': bet,
+        'created': created,
+        'expires': created + ttl,
+        'escrowed': True,
+        # Set once the message with the buttons is sent, for the expiry edit
+        'message_id': None,
+    }
+
+
+def challenge_type(record):
+    # Records saved before challenges were typed only marked coinflips
+    return record.get('type', DUEL)
+
+
+def challenge_owner(record, challenge_id):
+    # ...and were keyed by the owner's user id
+    return record.get('owner', str(challenge_id))
+
+
+def challenge_key(chat_id, challenge_id):
+    return f"{chat_id}/{challenge_id}"
+
+
+def split_key(key):
+    """(chat_id, challenge_id) of a scheduler key"""
+    chat_id, challenge_id = key.split('/', 1)
+    return chat_id, challenge_id
+
+
+class PendingChallenges:
+    """Expiry deadlines of every open challenge plus a count per owner.
+
+    `await callback(key)` runs once a challenge's expiry passes; keys come
+    from challenge_key(). The caller removes a challenge as soon as it is
+    claimed, by a button press or by the expiry itself.
+    """
+
+    def __init__(self, callback=None):
+        self.scheduler = DeadlineScheduler(callback)
+        self._owners = {}                                # key -> owner
+        self._by_owner = collections.defaultdict(set)    # owner -> keys
+
+    def __len__(self):
+        return len(self._owners)
+
+    @property
+    def expired(self):
+        return self.scheduler.fired
+
+    def set_callback(self, callback):
+        self.scheduler.callback = callback
+
+    def count(self, owner):
+        keys = self._by_owner.get(str(owner))
+        return len(keys) if keys else 0
+
+    def add(self, chat_id, challenge_id, owner, expires):
+        key = challenge_key(chat_id, challenge_id)
+        owner = str(owner)
+        self._owners[key] = owner
+        self._by_owner[owner].add(key)
+        self.scheduler.arm(key, expires)
+
+    def remove(self, chat_id, challenge_id):
+        key = challenge_key(chat_id, challenge_id)
+        owner = self._owners.pop(key, None)
+        if owner is not None:
+            keys = self._by_owner[owner]
+            keys.discard(key)
+            if not keys:
+                del self._by_owner[owner]
+        self.scheduler.disarm(key)
+
+    def start(self):
+        return self.scheduler.start()
+
+    async def stop(self):
+        await self.scheduler.stop()
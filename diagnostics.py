@@ -0,0 +1,156 @@
+# Zucchini Telegram Bot - Live diagnostics
+# On-demand tools for a running bot: a sampling profiler writing collapsed
+# stacks (flamegraph.pl / speedscope input), a dump of every asyncio task
+# with its await chain, and a heartbeat that notices event-loop stalls and
+# captures the stack of the code blocking the loop.
+import asyncio
+import collections
+import io
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _collapse(frame):
+    """Root-first 'a;b;c' stack of a frame, without line numbers so samples merge"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+# === Sampling profiler ===
+def sample_stacks(thread_id, seconds, interval=0.005):
+    """Counter of collapsed stacks of one thread, sampled from another thread"""
+    samples = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            samples[_collapse(frame)] += 1
+        time.sleep(interval)
+    return samples
+
+
+def write_collapsed(samples, path):
+    """One 'stack count' line per stack, the format flamegraph.pl reads"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def top_functions(samples, limit=10):
+    """[(leaf function, share of samples)] of the hottest leaves"""
+    leaves = collections.Counter()
+    for stack, count in samples.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    total = sum(leaves.values()) or 1
+    return [(name, count / total) for name, count in leaves.most_common(limit)]
+
+
+# === Task dump ===
+def await_chain(task):
+    """Frames from the task's coroutine down to the innermost await point"""
+    chain = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        chain.append(_frame_label(frame))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return chain
+
+
+def dump_tasks():
+    """Text listing of every pending task on the running loop"""
+    tasks = sorted(asyncio.all_tasks(), key=lambda t: t.get_name())
+    out = io.StringIO()
+    out.write(f"{len(tasks)} task\n")
+    for task in tasks:
+        coro = task.get_coro()
+        out.write(f"\n{task.get_name()}: {getattr(coro, '__qualname__', coro)}\n")
+        for label in await_chain(task):
+            out.write(f"    {label}\n")
+    return out.getvalue()
+
+
+# === Event-loop lag ===
+class LagMonitor:
+    """Heartbeat on the loop plus a watchdog thread that catches stalls.
+
+    The heartbeat task stamps the time every interval. When the stamp is
+    older than threshold, the watchdog grabs the loop thread's stack once
+    per stall, so the log shows what was blocking rather than what ran after.
+    """
+
+    def __init__(self, threshold=0.5, interval=0.1, history=20):
+        self.threshold = threshold
+        self.interval = interval
+        self.max_lag = 0.0
+        self.stalls = collections.deque(maxlen=history)   # [when, seconds, stack]
+        self._beat = time.monotonic()
+        self._thread_id = None
+        self._task = None
+        self._stopping = threading.Event()
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.create_task(self.heartbeat())
+        threading.Thread(target=self.watchdog, name='lag-watchdog', daemon=True).start()
+        return self._task
+
+    async def heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self._beat = time.monotonic()
+            self.max_lag = max(self.max_lag, self._beat - expected)
+
+    def watchdog(self):
+        reported = None
+        while not self._stopping.wait(self.interval):
+            beat = self._beat
+            if reported is not None and beat != reported:
+                # The loop is back: record how long the stall really lasted
+                self.stalls[-1][1] = beat - reported
+                reported = None
+            lag = time.monotonic() - beat
+            if lag < self.threshold or beat == reported:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            self.stalls.append([time.time(), lag, stack])
+            logger.warning(f"Event loop bloccato da almeno {lag:.2f}s:\n{stack}")
+
+    def report(self):
+        lines = [f"Lag massimo: {self.max_lag * 1e3:.0f} ms, blocchi oltre {self.threshold}s: {len(self.stalls)}"]
+        for when, lag, stack in list(self.stalls)[-3:]:
+            lines.append(f"\n{time.strftime('%H:%M:%S', time.localtime(when))}, bloccato da {lag:.2f}s in:")
+            # Innermost three frames, two lines each
+            lines.extend(stack.rstrip().split('\n')[-6:])
+        return '\n'.join(lines)
+
+    async def stop(self):
+        self._stopping.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
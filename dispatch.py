@@ -0,0 +1,127 @@
+# Zucchini Telegram Bot - Concurrent update dispatch
+# Updates from different users run in parallel; updates sharing a key
+# (same user, same inline message, same chat for chat-wide commands) keep
+# their arrival order.
+import asyncio
+import logging
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Sent instead of running an update shed by a full queue
+BUSY_TEXT = "⏳ Troppe richieste in coda, riprova tra poco."
+
+
+def command_name(message):
+    """'schedina' for '/schedina@bot 3 10', None for anything but a command"""
+    text = getattr(message, 'text', None)
+    if not text or not text.startswith('/'):
+        return None
+    return text.split()[0][1:].split('@')[0]
+
+
+def update_keys(update, chat_commands=()):
+    """Ordering keys of an update: its user, for button presses its message,
+    and for the commands in chat_commands (the ones that change chat-wide
+    state, like the lottery round) its chat"""
+    keys = []
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        keys.append(f"user:{user.id}")
+    query = getattr(update, 'callback_query', None)
+    if query is not None and query.message is not None:
+        # Every press on the same duel/coinflip message is serialized
+        keys.append(f"msg:{query.message.chat.id}:{query.message.message_id}")
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None and (not keys or command_name(getattr(update, 'message', None)) in chat_commands):
+        keys.append(f"chat:{chat.id}")
+    if not keys:
+        keys.append("global")
+    return keys
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Keyed serial executor for python-telegram-bot's concurrent_updates.
+
+    Each update waits for the earlier updates that share one of its keys,
+    then runs under a global concurrency limit. A key with more than
+    max_queue_per_key waiting updates sheds new ones instead of queueing
+    them forever: a shed button press is still answered, so its spinner
+    stops, and a shed message gets one notice per backlog of its key.
+    """
+
+    def __init__(self, max_concurrent_updates, max_queue_per_key=20, key_func=update_keys):
+        # Waiting for a key must not occupy a running slot, so PTB's own
+        # semaphore only bounds queued tasks and _running bounds execution
+        super().__init__(max_concurrent_updates * max_queue_per_key)
+        self.max_running = max_concurrent_updates
+        self.max_queue_per_key = max_queue_per_key
+        self.key_func = key_func
+        self.processed = 0
+        self.dropped = 0
+        self._running = None
+        self._tails = {}   # key -> Event set when the latest update of that key is done
+        self._depth = {}   # key -> number of queued or running updates
+        # Full keys already logged, and whose sender already got a notice for
+        # a shed message, since they last emptied
+        self._logged = set()
+        self._told = set()
+
+    async def initialize(self):
+        self._running = asyncio.Semaphore(self.max_running)
+
+    async def shutdown(self):
+        pass
+
+    def queue_depth(self, key):
+        return self._depth.get(key, 0)
+
+    async def do_process_update(self, update, coroutine):
+        keys = self.key_func(update)
+        full = [key for key in keys if self._depth.get(key, 0) >= self.max_queue_per_key]
+        if full:
+            self.dropped += 1
+            coroutine.close()
+            await self._shed(update, full)
+            return
+
+        # Registration happens before the first await, i.e. in arrival order
+        previous = [self._tails[key] for key in keys if key in self._tails]
+        done = asyncio.Event()
+        for key in keys:
+            self._tails[key] = done
+            self._depth[key] = self._depth.get(key, 0) + 1
+
+        try:
+            for event in previous:
+                await event.wait()
+            if self._running is None:
+                await self.initialize()
+            async with self._running:
+                await coroutine
+            self.processed += 1
+        finally:
+            done.set()
+            for key in keys:
+                self._depth[key] -= 1
+                if not self._depth[key]:
+                    del self._depth[key]
+                    del self._tails[key]
+                    self._logged.discard(key)
+                    self._told.discard(key)
+
+    async def _shed(self, update, full):
+        if not self._logged.intersection(full):
+            logger.warning(f"Coda piena per {full}, nuovi update scartati finché non si svuota")
+        self._logged.update(full)
+        query = getattr(update, 'callback_query', None)
+        message = getattr(update, 'message', None)
+        try:
+            if query is not None:
+                await query.answer(BUSY_TEXT)
+            elif message is not None and not self._told.intersection(full):
+                self._told.update(full)
+                await message.reply_text(BUSY_TEXT)
+        except Exception as e:
+            logger.warning(f"Avviso di coda piena non inviato: {e}")
@@ -0,0 +1,178 @@
+# Zucchini Telegram Bot - Write-ahead journal
+# Every mutation is appended as one compact line instead of rewriting the
+# whole data file; a periodic compaction folds the journal into a snapshot.
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# === Journal Operations ===
+# An op is a list: ['set', path, value], ['inc', path, amount] or ['del', path]
+# where path is the list of keys leading from the root of the data dict.
+def apply_op(data, op):
+    """Apply a single journal op to the data dict"""
+    kind, path = op[0], op[1]
+    target = data
+    for key in path[:-1]:
+        target = target.setdefault(key, {})
+    key = path[-1]
+    if kind == 'set':
+        target[key] = op[2]
+    elif kind == 'inc':
+        target[key] = target.get(key, 0) + op[2]
+    elif kind == 'del':
+        target.pop(key, None)
+    else:
+        raise ValueError(f"Unknown journal op: {kind}")
+
+
+def dump_data(data):
+    """Serialize the data dict; compact records (users.User) encode via to_json()"""
+    return json.dumps(data, separators=(',', ':'), default=lambda record: record.to_json())
+
+
+def write_snapshot(path, snapshot, fsync=False):
+    """Atomically replace path with snapshot via a temp file and rename.
+
+    snapshot is text, bytes, or a function returning either, called here
+    so the encoding happens on the writing thread. Returns its size.
+    """
+    if callable(snapshot):
+        snapshot = snapshot()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb' if isinstance(snapshot, bytes) else 'w') as f:
+        f.write(snapshot)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(snapshot)
+
+
+class Journal:
+    """Append-only mutation log with snapshot compaction"""
+
+    def __init__(self, path, snapshot_path, max_bytes=4 * 1024 * 1024, interval=600, fsync=False,
+                 dump=dump_data):
+        self.path = path
+        self.rotated_path = path + '.1'
+        self.snapshot_path = snapshot_path
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.fsync = fsync
+        # Serializer of the snapshot format, e.g. snapshot.dump for the binary one
+        self.dump = dump
+        self.seq = 0
+        self.pending = []
+        self.size = 0
+        self.last_compaction = time.time()
+        self._file = None
+
+    # --- Recovery ---
+    def replay(self, data, route=None):
+        """Apply journal records newer than the snapshot's journal_seq to data.
+
+        route(op), when given, sees each op first and returns True for the
+        ones it applied somewhere else.
+        """
+        self.seq = data.get('journal_seq', 0)
+        replayed = 0
+        for path in (self.rotated_path, self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Only the tail of a segment can be torn by a crash
+                        logger.warning(f"Record journal troncato in {path}, replay interrotto")
+                        break
+                    if record['s'] <= self.seq:
+                        continue
+                    for op in record['o']:
+                        if route is None or not route(op):
+                            apply_op(data, op)
+                    self.seq = record['s']
+                    replayed += 1
+        logger.info(f"Journal replay: {replayed} record applicati, seq={self.seq}")
+        return replayed
+
+    def open(self):
+        self._file = open(self.path, 'a')
+        self.size = self._file.tell()
+
+    def close(self):
+        if self._file is not None:
+            self.commit()
+            self._file.close()
+            self._file = None
+
+    # --- Writing ---
+    def record(self, op):
+        """Buffer an op until the next commit()"""
+        # Serialize now: the value may be a live dict that is mutated later
+        self.pending.append(json.dumps(op, separators=(',', ':')))
+
+    def seal(self):
+        """Turn the buffered ops into the next journal record line (None if empty)"""
+        if not self.pending:
+            return None
+        self.seq += 1
+        line = f'{{"s":{self.seq},"t":{time.time():.3f},"o":[{",".join(self.pending)}]}}\n'
+        self.pending = []
+        return line
+
+    def commit(self):
+        """Append all buffered ops as a single journal record"""
+        line = self.seal()
+        return self.write(line) if line else 0
+
+    def write(self, line):
+        """Append a sealed record; records must be written in seal() order"""
+        self._file.write(line)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.size += len(line)
+        return len(line)
+
+    # --- Compaction ---
+    def should_compact(self):
+        if self.size == 0:
+            return False
+        return self.size >= self.max_bytes or time.time() - self.last_compaction >= self.interval
+
+    def prepare_compaction(self, data):
+        """Freeze the current state and start a new journal segment.
+
+        Must run on the thread that mutates data; returns the serialized
+        snapshot to pass to finish_compaction().
+        """
+        self.commit()
+        data['journal_seq'] = self.seq
+        snapshot = self.dump(data)
+
+        self._file.close()
+        if os.path.exists(self.rotated_path):
+            # A previous compaction did not finish: keep its records
+            with open(self.path, 'r') as src, open(self.rotated_path, 'a') as dst:
+                dst.write(src.read())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.rotated_path)
+        self.open()
+        self.last_compaction = time.time()
+        return snapshot
+
+    def finish_compaction(self, snapshot):
+        """Write the snapshot and drop the folded segment (safe to run in a thread)"""
+        size = write_snapshot(self.snapshot_path, snapshot, fsync=True)
+        os.remove(self.rotated_path)
+        return size
+
+    def compact(self, data):
+        self.finish_compaction(self.prepare_compaction(data))
@@ -0,0 +1,422 @@
+# Zucchini Telegram Bot - Transaction ledger
+# Every credit and debit is appended as a typed entry: who, which game, what
+# kind of move, how much, against whom and in which round. Entries are
+# buffered as columns and written as zlib-compressed blocks; per-user
+# rollups are updated as entries come in, so /tessera_del_pane never scans.
+#
+#   python ledger.py verify zucchini_data.snap zucchini.ledger
+#   python ledger.py dump zucchini.ledger --user 123456789
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import struct
+import sys
+import time
+import traceback
+import zlib
+from array import array
+
+from journal import write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# --- Entry types ---
+# Games: where the cm moved. 'account' only holds the opening balance a
+# user had when the ledger first saw them.
+ACCOUNT, DAILY, HOURLY, THANKS, COINFLIP, DUEL, LOTTERY = GAMES = (
+    'account', 'daily', 'hourly', 'thanks', 'coinflip', 'duel', 'lottery'
+)
+# Kinds: how they moved. A stake is taken when a challenge or bet is
+# placed; a refund returns it, unplayed or won back; the win books only
+# the net gain on top, and the loss moves nothing and only records the
+# outcome. Games settled by a transfer book the net gain and loss directly.
+OPEN, BONUS, STAKE, WIN, LOSS, REFUND = KINDS = ('open', 'bonus', 'stake', 'win', 'loss', 'refund')
+GAME_CODES = {game: code for code, game in enumerate(GAMES)}
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+
+# --- Block layout ---
+# magic, entry count, payload size, payload crc32; the payload is each
+# column in this order as a u32 size plus its zlib-compressed array.
+# Times are milliseconds, stored as deltas from the previous entry.
+MAGIC = b'ZUCL'
+BLOCK = struct.Struct('<4sIII')
+SIZE = struct.Struct('<I')
+COLUMNS = (('ts', 'q'), ('user', 'q'), ('game', 'B'), ('kind', 'B'), ('amount', 'q'),
+           ('counterparty', 'q'), ('chat', 'q'), ('round', 'q'))
+
+# --- Rollups ---
+# One row of int64 per user: net cm, wins and losses for each game, then
+# the current streak (positive wins, negative losses), the best winning
+# streak and the biggest single net gain
+NET, WINS, LOSSES = range(3)
+STREAK, BEST_STREAK, BIGGEST_WIN = range(3 * len(GAMES), 3 * len(GAMES) + 3)
+ROW = BIGGEST_WIN + 1
+ROLLUP_MAGIC = b'ZUCR'
+# magic, row size, ledger offset covered, user count; then ids and rows
+ROLLUP_HEADER = struct.Struct('<4sIQQ')
+
+
+def encode_block(columns):
+    """One block of bytes from the column lists, in COLUMNS order"""
+    count = len(columns[0])
+    parts = []
+    for (name, code), values in zip(COLUMNS, columns):
+        if name == 'ts':
+            values = [b - a for a, b in zip([0] + values, values)]
+        packed = zlib.compress(array(code, values).tobytes())
+        parts += [SIZE.pack(len(packed)), packed]
+    payload = b''.join(parts)
+    return BLOCK.pack(MAGIC, count, len(payload), zlib.crc32(payload)) + payload
+
+
+def _decode_payload(payload):
+    columns = {}
+    offset = 0
+    for name, code in COLUMNS:
+        size, = SIZE.unpack_from(payload, offset)
+        offset += SIZE.size
+        values = array(code)
+        values.frombytes(zlib.decompress(payload[offset:offset + size]))
+        offset += size
+        columns[name] = list(itertools.accumulate(values)) if name == 'ts' else values
+    return columns
+
+
+def read_blocks(path, start=0):
+    """Yield (end offset, {column: values}) of each intact block from start;
+    stops at the first torn or corrupt one"""
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        while True:
+            header = f.read(BLOCK.size)
+            if len(header) < BLOCK.size:
+                return
+            magic, count, size, crc = BLOCK.unpack(header)
+            payload = f.read(size)
+            if magic != MAGIC or len(payload) < size or zlib.crc32(payload) != crc:
+                logger.warning(f"Blocco del ledger troncato o corrotto in {path} a {offset}, lettura interrotta")
+                return
+            offset += BLOCK.size + size
+            yield offset, _decode_payload(payload)
+
+
+def entries(columns):
+    """The rows of a decoded block as (ts, user, game, kind, amount, counterparty, chat, round)"""
+    games = [GAMES[code] for code in columns['game']]
+    kinds = [KINDS[code] for code in columns['kind']]
+    return zip(columns['ts'], columns['user'], games, kinds, columns['amount'],
+               columns['counterparty'], columns['chat'], columns['round'])
+
+
+class Rollups:
+    """Per-user totals kept up to date entry by entry, in one flat array"""
+
+    def __init__(self):
+        self._slots = {}        # user id (int) -> row number
+        self._values = array('q')
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, user):
+        return user in self._slots
+
+    def apply(self, user, game, kind, amount):
+        slot = self._slots.get(user)
+        if slot is None:
+            slot = self._slots[user] = len(self._slots)
+            self._values.extend(itertools.repeat(0, ROW))
+        row = self._values
+        base = slot * ROW
+        game_base = base + 3 * GAME_CODES[game]
+        row[game_base + NET] += amount
+        if kind == WIN:
+            row[game_base + WINS] += 1
+            streak = row[base + STREAK]
+            streak = row[base + STREAK] = streak + 1 if streak > 0 else 1
+            row[base + BEST_STREAK] = max(row[base + BEST_STREAK], streak)
+            row[base + BIGGEST_WIN] = max(row[base + BIGGEST_WIN], amount)
+        elif kind == LOSS:
+            row[game_base + LOSSES] += 1
+            streak = row[base + STREAK]
+            row[base + STREAK] = streak - 1 if streak < 0 else -1
+
+    def summary(self, user):
+        """{'games': {game: (net, wins, losses)}, 'opening', 'streak',
+        'best_streak', 'biggest_win'} of a user, None if never seen"""
+        slot = self._slots.get(int(user))
+        if slot is None:
+            return None
+        row = self._values[slot * ROW:(slot + 1) * ROW]
+        games = {game: tuple(row[3 * code:3 * code + 3]) for code, game in enumerate(GAMES) if game != ACCOUNT}
+        return {
+            'games': games,
+            'opening': row[3 * GAME_CODES[ACCOUNT] + NET],
+            'streak': row[STREAK],
+            'best_streak': row[BEST_STREAK],
+            'biggest_win': row[BIGGEST_WIN],
+        }
+
+    def freeze(self):
+        """Copy the rollups now; returns encode(offset), the checkpoint bytes
+        for the ledger up to offset, which is safe to call from any thread"""
+        ids = array('q', self._slots).tobytes()
+        values = self._values.tobytes()
+        count = len(self._slots)
+
+        def encode(offset):
+            return ROLLUP_HEADER.pack(ROLLUP_MAGIC, ROW, offset, count) + ids + values
+        return encode
+
+    @classmethod
+    def decode(cls, blob):
+        """(rollups, ledger offset) of a checkpoint"""
+        magic, row, offset, count = ROLLUP_HEADER.unpack_from(blob, 0)
+        if magic != ROLLUP_MAGIC or row != ROW:
+            raise ValueError("not a rollup checkpoint of this version")
+        rollups = cls()
+        ids = array('q')
+        ids.frombytes(blob[ROLLUP_HEADER.size:ROLLUP_HEADER.size + 8 * count])
+        rollups._slots = {user: slot for slot, user in enumerate(ids)}
+        rollups._values.frombytes(blob[ROLLUP_HEADER.size + 8 * count:])
+        return rollups, offset
+
+    def replay(self, path, start=0):
+        """Apply the blocks of a ledger file from start; returns the end of the last intact one"""
+        end = start
+        for end, columns in read_blocks(path, start):
+            for _, user, game, kind, amount, *_ in entries(columns):
+                self.apply(user, game, kind, amount)
+        return end
+
+    def __eq__(self, other):
+        return all(self.summary(user) == other.summary(user) for user in self._slots.keys() | other._slots.keys())
+
+
+def load_rollups(path, checkpoint_path):
+    """Rollups of a ledger file from its checkpoint plus the blocks after it:
+    (rollups, offset of the end of the last intact block)"""
+    rollups, offset = Rollups(), 0
+    if os.path.exists(checkpoint_path):
+        try:
+            with open(checkpoint_path, 'rb') as f:
+                rollups, offset = Rollups.decode(f.read())
+        except (ValueError, struct.error) as e:
+            logger.warning(f"Checkpoint {checkpoint_path} ignorato ({e}), rilettura dell'intero ledger")
+            rollups, offset = Rollups(), 0
+    if offset > (os.path.getsize(path) if os.path.exists(path) else 0):
+        logger.warning(f"Checkpoint {checkpoint_path} oltre la fine del ledger, rilettura dell'intero ledger")
+        rollups, offset = Rollups(), 0
+    return rollups, rollups.replay(path, offset)
+
+
+class Ledger:
+    """Append-only ledger file plus the rollups of its entries.
+
+    record() buffers an entry and applies it to the rollups at once. A
+    background task appends the buffer as one block every flush_interval
+    seconds, or as soon as block_entries are waiting, and checkpoints the
+    rollups every checkpoint_interval seconds, so a restart only replays
+    the blocks written since.
+    """
+
+    def __init__(self, path, flush_interval=2.0, block_entries=4096, checkpoint_interval=600):
+        self.path = path
+        self.checkpoint_path = path + '.rollups'
+        self.flush_interval = flush_interval
+        self.block_entries = block_entries
+        self.checkpoint_interval = checkpoint_interval
+        self.rollups, self.size = load_rollups(path, self.checkpoint_path)
+        if os.path.exists(path) and os.path.getsize(path) > self.size:
+            # Drop a block torn by a crash, so new ones follow the last good one
+            os.truncate(path, self.size)
+        self.entries = 0
+        self.blocks = 0
+        self.last_checkpoint = time.time()
+        self._columns = [[] for _ in COLUMNS]
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def summary(self, user_id):
+        return self.rollups.summary(user_id)
+
+    def record(self, user_id, game, kind, amount, chat_id=0, counterparty=0, round_id=0, balance_of=None):
+        """Append one entry. balance_of(user_id) is the user's length after
+        this change; it opens the account of a user seen for the first time"""
+        user = int(user_id)
+        if user not in self.rollups and balance_of is not None:
+            self._append(user, ACCOUNT, OPEN, balance_of(user_id) - amount, chat_id, 0, 0)
+        self._append(user, game, kind, amount, chat_id, int(counterparty), round_id)
+
+    def record_many(self, user_ids, game, kind, amounts, chat_id=0, round_id=0, balance_of=None):
+        """record() for a batch of users, e.g. every bettor of a round"""
+        for user_id, amount in zip(user_ids, amounts):
+            self.record(user_id, game, kind, amount, chat_id, 0, round_id, balance_of)
+
+    def record_payout(self, user_id, game, stake, gain, chat_id=0, counterparty=0, round_id=0, balance_of=None):
+        """Append a won stake as its refund plus the net gain as the win, so
+        wins compare across games; a first entry opens the account net of both"""
+        user = int(user_id)
+        if user not in self.rollups and balance_of is not None:
+            self._append(user, ACCOUNT, OPEN, balance_of(user_id) - stake - gain, chat_id, 0, 0)
+        self._append(user, game, REFUND, stake, chat_id, int(counterparty), round_id)
+        self._append(user, game, WIN, gain, chat_id, int(counterparty), round_id)
+
+    def record_payouts(self, user_ids, game, stakes, gains, chat_id=0, round_id=0, balance_of=None):
+        """record_payout() for a batch of users, e.g. every winner of a round"""
+        for user_id, stake, gain in zip(user_ids, stakes, gains):
+            self.record_payout(user_id, game, stake, gain, chat_id, 0, round_id, balance_of)
+
+    def _append(self, user, game, kind, amount, chat_id, counterparty, round_id):
+        values = (int(time.time() * 1000), user, GAME_CODES[game], KIND_CODES[kind], amount,
+                  counterparty, int(chat_id), round_id)
+        for column, value in zip(self._columns, values):
+            column.append(value)
+        self.rollups.apply(user, game, kind, amount)
+        self.entries += 1
+        if len(self._columns[0]) >= self.block_entries:
+            self._full.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.error("Errore nella scrittura del ledger:\n" + traceback.format_exc())
+
+    async def flush(self, checkpoint=False):
+        async with self._flush_lock:
+            columns = self._columns
+            if not columns[0] and not checkpoint:
+                return
+            self._columns = [[] for _ in COLUMNS]
+            encode_rollups = None
+            if checkpoint or time.time() - self.last_checkpoint >= self.checkpoint_interval:
+                # Frozen with the buffer just emptied, so it covers exactly the blocks on disk
+                encode_rollups = self.rollups.freeze()
+                self.last_checkpoint = time.time()
+            await asyncio.to_thread(self._write, columns, encode_rollups)
+
+    def _write(self, columns, encode_rollups):
+        if columns[0]:
+            block = encode_block(columns)
+            with open(self.path, 'ab') as f:
+                f.write(block)
+            self.size += len(block)
+            self.blocks += 1
+        if encode_rollups is not None:
+            write_snapshot(self.checkpoint_path, encode_rollups(self.size), fsync=True)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush(checkpoint=True)
+
+
+# === Offline tools ===
+def ledger_files(path):
+    """A ledger and the per-worker ledgers next to it (path.0, path.1, ...)"""
+    files = [path] if os.path.exists(path) else []
+    i = 0
+    while os.path.exists(f"{path}.{i}"):
+        files.append(f"{path}.{i}")
+        i += 1
+    return files
+
+
+def verify(balances, paths):
+    """Replay ledgers against {user_id: length}: (checked users, problems).
+
+    A user's expected length is the opening balance of their earliest
+    account entry plus every other amount, across all the files.
+    """
+    opening = {}        # user -> (ts, balance)
+    moved = {}
+    problems = []
+    for path in paths:
+        replayed = Rollups()
+        end = 0
+        for end, columns in read_blocks(path):
+            for ts, user, game, kind, amount, *_ in entries(columns):
+                replayed.apply(user, game, kind, amount)
+                if kind == OPEN:
+                    if user not in opening or ts < opening[user][0]:
+                        opening[user] = (ts, amount)
+                else:
+                    moved[user] = moved.get(user, 0) + amount
+        if end < os.path.getsize(path):
+            problems.append(f"{path}: {os.path.getsize(path) - end} byte illeggibili in coda")
+        checkpoint_path = path + '.rollups'
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'rb') as f:
+                saved, offset = Rollups.decode(f.read())
+            saved.replay(path, offset)
+            if saved != replayed:
+                problems.append(f"{checkpoint_path}: le statistiche salvate non corrispondono al ledger")
+
+    for user in opening.keys() | moved.keys():
+        if user not in opening:
+            problems.append(f"utente {user}: movimenti senza saldo iniziale")
+            continue
+        expected = opening[user][1] + moved.get(user, 0)
+        actual = balances.get(str(user))
+        if actual != expected:
+            problems.append(f"utente {user}: saldo {actual}, ledger {expected}")
+    return len(opening), problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Zucchini ledger tools")
+    commands = parser.add_subparsers(dest='command', required=True)
+    check = commands.add_parser('verify', help="replay the ledger against the saved balances, with the bot stopped")
+    check.add_argument('state', help="zucchini_data.snap, zucchini_data.json or an SQLite database")
+    check.add_argument('ledger', help="ledger file; its per-worker files are read too")
+    dump = commands.add_parser('dump', help="print ledger entries as tab-separated rows")
+    dump.add_argument('ledger')
+    dump.add_argument('--user', type=int)
+    args = parser.parse_args()
+
+    paths = ledger_files(args.ledger)
+    if not paths:
+        raise SystemExit(f"Nessun ledger in {args.ledger}")
+    if args.command == 'dump':
+        print("\t".join(name for name, _ in COLUMNS))
+        for path in paths:
+            for _, columns in read_blocks(path):
+                for entry in entries(columns):
+                    if args.user is None or entry[1] == args.user:
+                        print("\t".join(map(str, entry)))
+        return
+
+    from storage import read_balances
+    checked, problems = verify(read_balances(args.state), paths)
+    print("\n".join(problems[:50]))
+    if len(problems) > 50:
+        print(f"...e altri {len(problems) - 50} problemi")
+    print(f"{checked} utenti verificati su {len(paths)} file: "
+          + (f"{len(problems)} problemi" if problems else "ok"))
+    raise SystemExit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s - %(message)s', stream=sys.stderr)
+    main()
@@ -0,0 +1,60 @@
+# Zucchini Telegram Bot - Keyed async locks
+# Balance mutations serialize per user instead of on one global lock.
+import asyncio
+import time
+import zlib
+from contextlib import asynccontextmanager
+
+from metrics import metrics
+
+LOCK_WAIT = metrics.histogram('zucchini_lock_wait_seconds', "Time spent waiting for keyed locks", ('scope',))
+LOCK_HOLD = metrics.histogram('zucchini_lock_hold_seconds', "Time keyed locks were held", ('scope',))
+
+
+class KeyedLocks:
+    """Striped asyncio locks: each key maps to one of a fixed set of locks"""
+
+    def __init__(self, stripes=64):
+        self._locks = [asyncio.Lock() for _ in range(stripes)]
+        self.contended = 0
+
+    def _stripe(self, key):
+        return zlib.crc32(str(key).encode()) % len(self._locks)
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        """Hold the locks of all keys at once.
+
+        Stripes are taken in ascending order, so two operations on
+        overlapping keys (e.g. both sides of a duel) can never deadlock.
+        """
+        stripes = sorted({self._stripe(key) for key in keys})
+        async with self._hold_stripes(stripes, 'keys'):
+            yield
+
+    def hold_all(self):
+        """Exclusive access to every key (e.g. settling a lottery round)"""
+        return self._hold_stripes(range(len(self._locks)), 'all')
+
+    @asynccontextmanager
+    async def _hold_stripes(self, stripes, scope):
+        held = []
+        timed = metrics.enabled
+        if timed:
+            started = time.perf_counter()
+        try:
+            for i in stripes:
+                lock = self._locks[i]
+                if lock.locked():
+                    self.contended += 1
+                await lock.acquire()
+                held.append(lock)
+            if timed:
+                acquired = time.perf_counter()
+                LOCK_WAIT.observe(acquired - started, scope)
+            yield
+        finally:
+            for lock in reversed(held):
+                lock.release()
+            if timed and len(held) == len(stripes):
+                LOCK_HOLD.observe(time.perf_counter() - acquired, scope)
@@ -4,16 +4,34 @@
 import logging
 import random
 import time
-import threading
-import json
 import os
 import asyncio
-import traceback
-from collections import defaultdict
-from datetime import datetime, timedelta
+import functools
+import signal
+import sys
+import threading
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, CallbackQueryHandler
+from telegram.ext import (ApplicationBuilder, ApplicationHandlerStop, CommandHandler, ContextTypes,
+                          CallbackQueryHandler, TypeHandler)
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
+from names import NameCache
+from storage import JsonStorage, SqliteStorage
+from locks import KeyedLocks
+from dispatch import KeyedUpdateProcessor, update_keys
+from scheduler import DeadlineScheduler
+from throttle import COOLDOWN, Throttle
+from settlement import bet_columns, settle
+from ledger import BONUS, DAILY, HOURLY, LOSS, LOTTERY, REFUND, STAKE, THANKS, WIN, Ledger
+from challenges import (COINFLIP, DUEL, PendingChallenges, challenge_owner, challenge_type,
+                        new_challenge, split_key)
+from matchmaking import EXPIRED, MATCHED, QUEUED, Matchmaker, stake_band
+from webhook import WebhookServer
+from capture import UpdateRecorder
+from metrics import SIZE_BUCKETS, metrics, serve_metrics
+from outbox import BROADCAST, OutboundQueue
+from workers import LeaderElection, WorkerPool, read_updates, worker_for
+from diagnostics import LagMonitor, dump_tasks, sample_stacks, top_functions, write_collapsed
 
 
 # Load environment variables
@@ -21,12 +39,57 @@ load_dotenv()
 
 # === Configurations ===
 TOKEN = os.getenv('BOT_TOKEN')
-FIXED_GROUP_CHAT_ID = -4951349977
-if not TOKEN:
-    raise ValueError("BOT_TOKEN environment variable is required")
+# Chat that inherits the lottery and duels saved before state was split per chat
+LEGACY_CHAT_ID = int(os.getenv('LEGACY_CHAT_ID', -4951349977))
 
 DATA_FILE = 'zucchini_data.json'
 LOTTERY_INTERVAL = 1 * 45  # 6 hours in seconds
+# Winners named in the draw announcement; the rest are only counted
+LOTTERY_TOP_WINNERS = 10
+LEADERBOARD_PAGE_SIZE = 10
+
+# Display names learned from updates, used instead of get_chat_member calls
+NAME_CACHE_SIZE = 50_000
+NAME_CACHE_TTL = 6 * 60 * 60
+NAME_LOOKUP_CONCURRENCY = 5
+NAME_LOOKUP_DEADLINE = 2.0  # seconds per leaderboard render
+
+# 'json' keeps everything in memory and in DATA_FILE, 'sqlite' uses SQLITE_FILE
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+SQLITE_FILE = os.getenv('SQLITE_FILE', 'zucchini.db')
+
+# 'journal' appends one record per mutation, 'snapshot' rewrites the whole file
+PERSISTENCE_MODE = os.getenv('PERSISTENCE_MODE', 'journal')
+JOURNAL_FILE = 'zucchini_data.journal'
+JOURNAL_COMPACT_BYTES = int(os.getenv('JOURNAL_COMPACT_BYTES', 4 * 1024 * 1024))
+JOURNAL_COMPACT_INTERVAL = int(os.getenv('JOURNAL_COMPACT_INTERVAL', 10 * 60))
+# 'binary' maps SNAPSHOT_FILE and decodes users on demand, importing DATA_FILE
+# the first time; 'json' loads and rewrites DATA_FILE as before
+SNAPSHOT_FORMAT = os.getenv('SNAPSHOT_FORMAT', 'binary')
+SNAPSHOT_FILE = os.getenv('SNAPSHOT_FILE', 'zucchini_data.snap')
+# With the binary format at most this many users stay decoded in memory; the
+# least recently active ones are evicted to SNAPSHOT_FILE.cold (0 = no limit)
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 100_000))
+# Saves requested within this many seconds are coalesced into a single write
+SAVE_COALESCE_WINDOW = float(os.getenv('SAVE_COALESCE_WINDOW', 0.2))
+
+# Lottery rounds and pending duels of each chat live in SHARD_DIR/<chat_id>.json
+SHARD_DIR = os.getenv('SHARD_DIR', 'chats')
+SHARD_IDLE_TIMEOUT = int(os.getenv('SHARD_IDLE_TIMEOUT', 10 * 60))
+
+# === Challenges ===
+# Coinflips and duels take their stake when created and refund it if
+# nobody plays them within CHALLENGE_TTL seconds
+CHALLENGE_TTL = int(os.getenv('CHALLENGE_TTL', 10 * 60))
+MAX_PENDING_CHALLENGES = int(os.getenv('MAX_PENDING_CHALLENGES', 3))
+# With MATCHMAKING=1 a duel posts no button: it waits in the chat's order
+# book and is paired with the next duel whose stake is within
+# MATCHMAKING_TOLERANCE (a fraction of that stake, 0 = same stake). The
+# results are posted once every MATCHMAKING_SUMMARY_INTERVAL seconds
+MATCHMAKING = bool(int(os.getenv('MATCHMAKING', 0)))
+MATCHMAKING_TOLERANCE = float(os.getenv('MATCHMAKING_TOLERANCE', 0.1))
+MATCHMAKING_SUMMARY_INTERVAL = float(os.getenv('MATCHMAKING_SUMMARY_INTERVAL', 30))
+MATCHMAKING_SUMMARY_LINES = 20
 
 # === Logging Setup ===
 logging.basicConfig(
@@ -34,69 +97,177 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# httpx logs every Bot API request at INFO; the metrics cover those calls
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# === Concurrency ===
+# Every balance mutation runs under the locks of the users it touches;
+# a chat's lottery lock guards its open round against a concurrent settlement.
+LOCK_STRIPES = int(os.getenv('LOCK_STRIPES', 64))
+user_locks = KeyedLocks(LOCK_STRIPES)
+
+def lottery_lock(chat_id):
+    return f"lottery:{chat_id}"
+
+# Updates handled in parallel (1 = one at a time); updates of the same user
+# or on the same inline message always run in arrival order
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', 32))
+MAX_QUEUE_PER_KEY = int(os.getenv('MAX_QUEUE_PER_KEY', 20))
+
+# === Workers ===
+# WORKERS > 1 runs that many bot processes sharing SQLITE_FILE (sqlite
+# backend only); this process then only receives updates and routes each
+# chat to its worker. The worker holding the lease draws the lotteries.
+WORKERS = int(os.getenv('WORKERS', 1))
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', 15))
+# Set by the router in each worker process
+WORKER_INDEX = int(os.getenv('WORKER_INDEX')) if os.getenv('WORKER_INDEX') else None
+
+def owns_chat(chat_id):
+    """Whether this process handles the updates of a chat"""
+    return WORKER_INDEX is None or worker_for(chat_id, WORKERS) == WORKER_INDEX
+
+# === Throttling ===
+# Checked before any handler runs: each user and each chat has a token
+# bucket (rate per second, burst size; rate 0 disables it)
+THROTTLE_USER_RATE = float(os.getenv('THROTTLE_USER_RATE', 1))
+THROTTLE_USER_BURST = int(os.getenv('THROTTLE_USER_BURST', 5))
+THROTTLE_CHAT_RATE = float(os.getenv('THROTTLE_CHAT_RATE', 5))
+THROTTLE_CHAT_BURST = int(os.getenv('THROTTLE_CHAT_BURST', 30))
+# Rejected users get one notice per interval, further updates are dropped silently
+THROTTLE_NOTICE_INTERVAL = float(os.getenv('THROTTLE_NOTICE_INTERVAL', 30))
+# Tokens charged per command or button prefix; the leaderboard sorts and fetches names
+THROTTLE_COSTS = {'classifica': 3, 'classifica:': 2}
+DAILY_COOLDOWN = 24 * 60 * 60
+HOURLY_COOLDOWN = 60 * 60
+
+# === Update Source ===
+# 'polling' long-polls getUpdates; 'webhook' lets Telegram POST updates to
+# WEBHOOK_PATH on WEBHOOK_LISTEN:WEBHOOK_PORT (behind a TLS proxy)
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Public https URL registered with setWebhook on startup; unset = register it yourself
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+HEALTH_PATH = '/healthz'
+# Bot API endpoint, e.g. a local Bot API server (default: api.telegram.org)
+BOT_API_URL = os.getenv('BOT_API_URL')
+
+# === Outbound Limits ===
+# Telegram allows ~30 messages/s overall, ~1/s per private chat and 20/min per group
+OUTBOX_GLOBAL_PER_SECOND = float(os.getenv('OUTBOX_GLOBAL_PER_SECOND', 30))
+if WORKER_INDEX is not None:
+    # The limit is per bot token: workers split it
+    OUTBOX_GLOBAL_PER_SECOND /= WORKERS
+OUTBOX_CHAT_PER_SECOND = float(os.getenv('OUTBOX_CHAT_PER_SECOND', 1))
+OUTBOX_GROUP_PER_MINUTE = float(os.getenv('OUTBOX_GROUP_PER_MINUTE', 20))
+
+# === Update Capture ===
+# Set CAPTURE_FILE to record every update for benchmarks/replay.py; with
+# CAPTURE_ANONYMIZE_KEY set, ids become keyed pseudonyms and names are dropped
+CAPTURE_FILE = os.getenv('CAPTURE_FILE')
+CAPTURE_MAX_BYTES = int(os.getenv('CAPTURE_MAX_BYTES', 64 * 1024 * 1024))
+CAPTURE_BACKUPS = int(os.getenv('CAPTURE_BACKUPS', 5))
+CAPTURE_ANONYMIZE_KEY = os.getenv('CAPTURE_ANONYMIZE_KEY')
+
+# === Ledger ===
+# Every credit and debit is appended to LEDGER_FILE (see ledger.py); empty = off.
+# Workers write LEDGER_FILE.<index>, which `ledger.py verify` reads together.
+LEDGER_FILE = os.getenv('LEDGER_FILE', 'zucchini.ledger')
+if LEDGER_FILE and WORKER_INDEX is not None:
+    LEDGER_FILE = f"{LEDGER_FILE}.{WORKER_INDEX}"
+LEDGER_FLUSH_INTERVAL = float(os.getenv('LEDGER_FLUSH_INTERVAL', 2))
+
+# === Metrics ===
+# Set METRICS_PORT to serve Prometheus metrics on METRICS_LISTEN:METRICS_PORT/metrics
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+if METRICS_PORT and WORKER_INDEX is not None:
+    # Worker N serves its own metrics on METRICS_PORT + N
+    METRICS_PORT = str(int(METRICS_PORT) + WORKER_INDEX)
+if METRICS_PORT:
+    metrics.enable()
+
+HANDLER_SECONDS = metrics.histogram('zucchini_handler_seconds', "Handler latency per command and button", ('handler',))
+HANDLER_ERRORS = metrics.counter('zucchini_handler_errors_total', "Exceptions raised by handlers", ('handler',))
+BOT_API_SECONDS = metrics.histogram('zucchini_bot_api_seconds', "Bot API call latency", ('method',))
+BOT_API_ERRORS = metrics.counter('zucchini_bot_api_errors_total', "Failed Bot API calls", ('method', 'reason'))
+LOTTERY_BETS = metrics.histogram('zucchini_lottery_round_bets', "Bets per settled lottery round", buckets=SIZE_BUCKETS)
+LOTTERY_POT = metrics.histogram(
+    'zucchini_lottery_round_pot_cm', "Pot of each settled lottery round",
+    buckets=(10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+)
+LOTTERY_SETTLE = metrics.histogram('zucchini_lottery_settle_seconds', "Time to settle a lottery round")
+
+# === Diagnostics ===
+# Telegram user ids allowed to run /diagnostica, comma separated
+ADMIN_IDS = {int(uid) for uid in os.getenv('ADMIN_IDS', '').split(',') if uid.strip()}
+DIAG_DIR = os.getenv('DIAG_DIR', 'diagnostics')
+DIAG_PROFILE_SECONDS = int(os.getenv('DIAG_PROFILE_SECONDS', 10))
+DIAG_PROFILE_MAX_SECONDS = 120
+# Event-loop stalls longer than this (seconds) are logged with the blocking stack; 0 = off
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', 0.5))
+
+# === Storage ===
+def open_storage():
+    """Build the configured storage backend"""
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteStorage(SQLITE_FILE, LEGACY_CHAT_ID)
+    return JsonStorage(
+        DATA_FILE, JOURNAL_FILE, PERSISTENCE_MODE,
+        JOURNAL_COMPACT_BYTES, JOURNAL_COMPACT_INTERVAL, SAVE_COALESCE_WINDOW,
+        SHARD_DIR, SHARD_IDLE_TIMEOUT, LEGACY_CHAT_ID,
+        SNAPSHOT_FILE if SNAPSHOT_FORMAT == 'binary' else None, USER_CACHE_SIZE
+    )
 
-# === Thread Safety ===
-data_lock = threading.Lock()
-
-# === Data Persistence ===
-def load_data():
-    try:
-        with open(DATA_FILE, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        logger.info("Data file not found, creating new data structure")
-        return {
-            'users': {},
-            'duels': {},
-            'lottery': {
-                'bets': {},
-                'history': [],
-                'end_time': time.time() + LOTTERY_INTERVAL
-            }
-        }
-    except json.JSONDecodeError as e:
-        logger.error(f"Error loading data file: {e}")
-        return {
-            'users': {},
-            'duels': {},
-            'lottery': {
-                'bets': {},
-                'history': [],
-                'end_time': time.time() + LOTTERY_INTERVAL
-            }
-        }
-
-data = load_data()
+# Opened by startup(), so importing this module never reads the data files
+store = None
+ledger = None
+
+def startup():
+    """Load the game state; run once before the handlers take updates"""
+    global store, ledger
+    if store is None:
+        started = time.perf_counter()
+        store = open_storage()
+        logger.info(f"Storage {STORAGE_BACKEND} aperto in {time.perf_counter() - started:.2f}s, "
+                    f"{store.user_count()} utenti")
+    if LEDGER_FILE and ledger is None:
+        ledger = Ledger(LEDGER_FILE, LEDGER_FLUSH_INTERVAL)
+        logger.info(f"Ledger {LEDGER_FILE}: {len(ledger.rollups)} utenti")
+    return store
 
 # === Utility Functions ===
 def save_data():
-    try:
-        with data_lock:
-            with open(DATA_FILE, 'w') as f:
-                json.dump(data, f, indent=2)
-    except Exception as e:
-        logger.error(f"Error saving data: {e}")
+    """Ask the storage backend to persist the changes made so far"""
+    store.save()
 
 def get_user(user_id):
-    user_id = str(user_id)
-    if user_id not in data['users']:
-        data['users'][user_id] = {
-            "length": 20,
-            "last_daily": 0,
-            "last_hourly": 0,
-            "stats": {
-                "daily_used": 0,
-                "hourly_used": 0,
-                "daily_collected": 0,
-                "begs": 0,
-                "won": 0,           # Added for coinflip and duels
-                "lost": 0,
-                "length_won": 0,
-                "length_lost": 0, # Added for coinflip and duels
-                "bet_total": 0,
-            },
-        }
-    return data['users'][user_id]
+    return store.get_user(user_id)
+
+def update_user(user_id, deltas=None, values=None, min_length=None):
+    """Apply counter deltas and field values to a user ('stats.won' style keys)"""
+    return store.apply_delta(user_id, deltas, values, min_length)
+
+def current_length(user_id):
+    return store.get_user(user_id).length
+
+def book(user_id, game, kind, amount, chat_id=0, counterparty=0, round_id=0):
+    """Write a balance change to the ledger; call it right after the change,
+    under the same locks, so a first entry can open the user's account"""
+    if ledger is not None:
+        ledger.record(user_id, game, kind, amount, chat_id, counterparty, round_id, current_length)
+
+def book_payout(user_id, game, stake, gain, chat_id=0, counterparty=0, round_id=0):
+    """book() for a win that returns a held stake: the stake back, then the net gain"""
+    if ledger is not None:
+        ledger.record_payout(user_id, game, stake, gain, chat_id, counterparty, round_id, current_length)
+
+def challenge_round(challenge_id):
+    """Ledger round id of a challenge: 'c12' -> 12 (older ids are user ids)"""
+    return int(str(challenge_id).lstrip('c'))
 
 
 def now():
@@ -111,20 +282,24 @@ def get_username(user):
     else:
         return f"User {user.id}"
 
+name_cache = NameCache(get_username, NAME_CACHE_SIZE, NAME_CACHE_TTL)
+
+throttle = Throttle(THROTTLE_USER_RATE, THROTTLE_USER_BURST, THROTTLE_CHAT_RATE, THROTTLE_CHAT_BURST,
+                    THROTTLE_NOTICE_INTERVAL)
+
+update_recorder = None
+# With workers the router records, before routing
+if CAPTURE_FILE and (WORKERS == 1 or WORKER_INDEX is None):
+    update_recorder = UpdateRecorder(CAPTURE_FILE, CAPTURE_MAX_BYTES, CAPTURE_BACKUPS, CAPTURE_ANONYMIZE_KEY)
+
 # === Command Handlers ===
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command handler"""
     user = get_user(update.effective_user.id)
-    chat_id = update.effective_chat.id
-    msg_text = update.message.text
 
-    logger.info(f"Group ID: {chat_id}")
-    logger.info(f"Message length: {len(msg_text)}")
-    logger.debug(f"Message content:\n{msg_text}")
-    
     await update.message.reply_text(
         f"Benvenuto al bot della ludopatia! 🎰\n"
-        f"Il tuo cazzone è lungo: {user['length']}cm\n\n"
+        f"Il tuo cazzone è lungo: {user.length}cm\n\n"
         f"Comandi disponibili:\n"
         f"/classifica - Visualizza la classifica\n"
         f"/razione_giornaliera - Ottieni la tua razione giornaliera\n"
@@ -136,118 +311,194 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"/tessera_del_pane - Vedi quanto sei ludopatico\n"
     )
 
+async def render_leaderboard(bot, chat_id, user_id, page):
+    """Build the text and page buttons for one leaderboard page"""
+    total = store.user_count()
+    pages = max(1, -(-total // LEADERBOARD_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * LEADERBOARD_PAGE_SIZE
+    entries = store.range(start, start + LEADERBOARD_PAGE_SIZE)
+
+    # Show the caller and their neighbours when they are not on this page
+    own_rank = store.rank(user_id)
+    neighbours = []
+    if own_rank is not None and not start < own_rank <= start + LEADERBOARD_PAGE_SIZE:
+        neighbours = store.around(user_id)
+
+    names = await name_cache.resolve_many(
+        bot, chat_id,
+        [uid for uid, _ in entries] + [uid for _, uid, _ in neighbours],
+        NAME_LOOKUP_CONCURRENCY, NAME_LOOKUP_DEADLINE
+    )
+
+    msg = "🎰 Classifica Ludopatici 🎰\n\n"
+    for i, (uid, length) in enumerate(entries, start + 1):
+        msg += f"{i}. {names[uid]}: {length}cm\n"
+    if neighbours:
+        msg += "\nLa tua posizione:\n"
+        for rank, uid, length in neighbours:
+            msg += f"{rank}. {names[uid]}: {length}cm\n"
+    msg += f"\nPagina {page + 1}/{pages}"
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"classifica:{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"classifica:{page + 1}"))
+    return msg, InlineKeyboardMarkup([buttons]) if buttons else None
+
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display leaderboard"""
     try:
-        with data_lock:
-            leaderboard_sorted = sorted(
-                data['users'].items(), 
-                key=lambda x: x[1]['length'], 
-                reverse=True
-            )[:10]
-        
-        if not leaderboard_sorted:
+        if not store.user_count():
             await update.message.reply_text("Nessun utente nella classifica!")
             return
-            
-        msg = "🎰 Classifica Ludopatici 🎰\n\n"
-        for i, (uid, user_data) in enumerate(leaderboard_sorted, 1):
-            try:
-                # Try to get user info from Telegram
-                user_obj = await context.bot.get_chat_member(update.effective_chat.id, int(uid))
-                username = get_username(user_obj.user)
-            except:
-                username = f"User {uid}"
-            
-            msg += f"{i}. {username}: {user_data['length']}cm\n"
-        
-        await update.message.reply_text(msg)
+
+        msg, markup = await render_leaderboard(
+            context.bot, update.effective_chat.id, update.effective_user.id, 0
+        )
+        await update.message.reply_text(msg, reply_markup=markup)
     except Exception as e:
         logger.error(f"Error in leaderboard: {e}")
         await update.message.reply_text("Errore nel recuperare la classifica.")
 
+async def handle_leaderboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Switch leaderboard page"""
+    query = update.callback_query
+    await query.answer()
+
+    try:
+        page = int(query.data.split(':')[1])
+        msg, markup = await render_leaderboard(
+            context.bot, update.effective_chat.id, query.from_user.id, page
+        )
+        await query.edit_message_text(msg, reply_markup=markup)
+    except Exception as e:
+        logger.error(f"Error in leaderboard callback: {e}")
+
+def daily_cooldown_text(remaining):
+    hours = int(remaining // 3600)
+    minutes = int((remaining % 3600) // 60)
+    return (
+        f"Hai già ritirato la tua razione oggi! 🤬\n"
+        f"Prossima razione disponibile tra: {hours} ore {minutes} minuti"
+    )
+
+def hourly_cooldown_text(remaining):
+    minutes = int(remaining // 60)
+    return (
+        f"Hai già chiesto l'elemosina ritardato! 🤡\n"
+        f"Riprova tra: {minutes} minuti se hai le palle"
+    )
+
+COOLDOWN_TEXTS = {
+    'razione_giornaliera': daily_cooldown_text,
+    'elemosina': hourly_cooldown_text,
+}
+
 async def razione_giornaliera(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Daily ration command"""
-    user = get_user(update.effective_user.id)
-    current_time = now()
+    user_id = update.effective_user.id
+    async with user_locks.hold(user_id):
+        user = get_user(user_id)
+        current_time = now()
+        remaining = DAILY_COOLDOWN - (current_time - user.last_daily)
+        if remaining <= 0:
+            bonus = random.randint(5, 15)
+            user = update_user(user_id, {'length': bonus, 'stats.daily_used': 1}, {'last_daily': current_time})
+            book(user_id, DAILY, BONUS, bonus, update.effective_chat.id)
+            save_data()
+    # Later requests within the cooldown are answered by the throttle
+    throttle.set_cooldown(user_id, 'razione_giornaliera', user.last_daily + DAILY_COOLDOWN)
     
     # Check if user already used daily ration today (24 hours)
-    if current_time - user['last_daily'] < 24 * 60 * 60:
-        remaining = 24 * 60 * 60 - (current_time - user['last_daily'])
-        hours = int(remaining // 3600)
-        minutes = int((remaining % 3600) // 60)
-        await update.message.reply_text(
-            f"Hai già ritirato la tua razione oggi! 🤬\n"
-            f"Prossima razione disponibile tra: {hours} ore {minutes} minuti"
-        )
+    if remaining > 0:
+        await update.message.reply_text(daily_cooldown_text(remaining))
         return
     
-    # Give daily ration
-    bonus = random.randint(5, 15)
-    user['length'] += bonus
-    user['last_daily'] = current_time
-    user['stats']['daily_used'] += 1
-    save_data()
-    
     await update.message.reply_text(
         f"Hai ritirato la tua razione giornaliera! 🎲\n"
         f"Hai ottenuto: +{bonus}cm\n"
-        f"Nerchia attuale: {user['length']}cm"
+        f"Nerchia attuale: {user.length}cm"
     )
 
 async def elemosina(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Donation request command"""
-    user = get_user(update.effective_user.id)
-    current_time = now()
+    user_id = update.effective_user.id
+    async with user_locks.hold(user_id):
+        user = get_user(user_id)
+        current_time = now()
+        remaining = HOURLY_COOLDOWN - (current_time - user.last_hourly)
+        if remaining <= 0:
+            # Random chance of getting donation
+            bonus = random.randint(3, 9)
+            user = update_user(user_id, {'length': bonus, 'stats.hourly_used': 1}, {'last_hourly': current_time})
+            book(user_id, HOURLY, BONUS, bonus, update.effective_chat.id)
+            save_data()
+    throttle.set_cooldown(user_id, 'elemosina', user.last_hourly + HOURLY_COOLDOWN)
     
     # Check if user already used elemosina in the last hour
-    if current_time - user['last_hourly'] < 60 * 60:
-        remaining = 60 * 60 - (current_time - user['last_hourly'])
-        minutes = int(remaining // 60)
-        await update.message.reply_text(
-            f"Hai già chiesto l'elemosina ritardato! 🤡\n"
-            f"Riprova tra: {minutes} minuti se hai le palle"
-        )
+    if remaining > 0:
+        await update.message.reply_text(hourly_cooldown_text(remaining))
         return
-    
-    # Random chance of getting donation
-    bonus = random.randint(3, 9)
-    user['length'] += bonus
-    user['last_hourly'] = current_time
-    user['stats']['hourly_used'] += 1
-    save_data()
 
     await update.message.reply_text(
         f"Il duce ti ha dato l'elemosina! 🙋🏻‍♂\n"
         f"Ottieni +{bonus}cm\n"
-        f"Minchia attuale: {user['length']}cm"
+        f"Minchia attuale: {user.length}cm"
     )
 
 
-async def coinflip(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = get_user(update.effective_user.id)
+async def open_challenge(update, kind, bet, matchmaking=False):
+    """Escrow the stake and store a challenge: (challenge_id, user), or
+    (None, user) if the user cannot afford it, or (None, None) at the cap"""
     user_id = str(update.effective_user.id)
+    chat_id = update.effective_chat.id
+    async with user_locks.hold(user_id):
+        if pending_challenges.count(user_id) >= MAX_PENDING_CHALLENGES:
+            return None, None
+        user = update_user(user_id, {'length': -bet}, min_length=bet)
+        if user is None:
+            return None, get_user(user_id)
+        record = new_challenge(kind, user_id, bet, now(), CHALLENGE_TTL)
+        if matchmaking:
+            record['matchmaking'] = True
+        challenge_id = store.add_challenge(chat_id, record)
+        book(user_id, kind, STAKE, -bet, chat_id, round_id=challenge_round(challenge_id))
+        pending_challenges.add(chat_id, challenge_id, user_id, record['expires'])
+        if matchmaking:
+            matchmaker.add(chat_id, challenge_id, user_id, bet)
+        save_data()
+    return challenge_id, user
 
+async def coinflip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or not context.args[0].isdigit():
         await update.message.reply_text("Brutto ritardato, scrivi: /coinflip [puntata]")
         return
 
     bet = int(context.args[0])
-    if bet <= 0 or bet > user['length']:
-        await update.message.reply_text(f"Puntata non valida. Hai solo {user['length']}cm sfigato.")
+    if bet <= 0:
+        user = get_user(update.effective_user.id)
+        await update.message.reply_text(f"Puntata non valida. Hai solo {user.length}cm sfigato.")
         return
 
-    data['duels'][user_id] = {'bet': bet, 'type': 'coinflip'}
-    save_data()
+    challenge_id, user = await open_challenge(update, COINFLIP, bet)
+    if user is None:
+        await update.message.reply_text(f"Hai già {MAX_PENDING_CHALLENGES} sfide aperte, giocale prima di lanciarne altre.")
+        return
+    if challenge_id is None:
+        await update.message.reply_text(f"Puntata non valida. Hai solo {user.length}cm sfigato.")
+        return
 
     keyboard = [
-        [InlineKeyboardButton("🚬 Cannetta", callback_data=f"coinflip:{user_id}:cannetta")],
-        [InlineKeyboardButton("💣 Cannone", callback_data=f"coinflip:{user_id}:cannone")]
+        [InlineKeyboardButton("🚬 Cannetta", callback_data=f"coinflip:{challenge_id}:cannetta")],
+        [InlineKeyboardButton("💣 Cannone", callback_data=f"coinflip:{challenge_id}:cannone")]
     ]
-    await update.message.reply_text(
+    message = await update.message.reply_text(
         f"Stai per giocare al coinflip {bet}cm!\nScegli:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
+    store.set_challenge_message(update.effective_chat.id, challenge_id, message.message_id)
 
 async def duello_pisello(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or not context.args[0].isdigit():
@@ -255,46 +506,110 @@ async def duello_pisello(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     bet = int(context.args[0])
-    user_id = str(update.effective_user.id)
-    user = get_user(user_id)
+    if bet <= 0:
+        user = get_user(update.effective_user.id)
+        await update.message.reply_text(f"Puntata invalida, come te. Hai {user.length}cm.")
+        return
 
-    if bet <= 0 or bet > user['length']:
-        await update.message.reply_text(f"Puntata invalida, come te. Hai {user['length']}cm.")
+    if MATCHMAKING:
+        await match_duel(update, bet)
         return
 
-    data['duels'][user_id] = {'bet': bet}
-    save_data()
+    challenge_id, user = await open_challenge(update, DUEL, bet)
+    if user is None:
+        await update.message.reply_text(f"Hai già {MAX_PENDING_CHALLENGES} sfide aperte, giocale prima di lanciarne altre.")
+        return
+    if challenge_id is None:
+        await update.message.reply_text(f"Puntata invalida, come te. Hai {user.length}cm.")
+        return
 
-    keyboard = [[InlineKeyboardButton("Duello per l'onore ⚔️", callback_data=f"duel:accept:{user_id}")]]
-    await update.message.reply_text(
+    keyboard = [[InlineKeyboardButton("Duello per l'onore ⚔️", callback_data=f"duel:accept:{challenge_id}")]]
+    message = await update.message.reply_text(
         f"⚔️ {get_username(update.effective_user)} ha lanciato un duello da {bet}cm!\n"
         f"Vincere, e vinceremo!",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
+    store.set_challenge_message(update.effective_chat.id, challenge_id, message.message_id)
+
+async def match_duel(update, bet):
+    """Pair a duel with the open order of the closest stake in its band that
+    the user can pay, or leave it in the order book; either way it shows up
+    in the chat's next summary"""
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    low, high = stake_band(bet, MATCHMAKING_TOLERANCE)
+    while True:
+        # Every retry follows a claimed order or a lower balance, so this ends
+        order = matchmaker.book(chat_id).match(user_id, low, min(high, current_length(user_id)), bet)
+        if order is None:
+            break
+        challenge_id = order[0]
+        challenger_id = int(matchmaker.book(chat_id).owner(challenge_id))
+        stake, paid, winner_id, _ = await play_duel(chat_id, challenge_id, challenger_id, user_id)
+        if stake is None:
+            matchmaker.remove(chat_id, challenge_id)
+        elif paid:
+            loser_id = user_id if winner_id == challenger_id else challenger_id
+            matchmaker.report(chat_id, MATCHED, winner_id, loser_id, stake)
+            return
+
+    challenge_id, user = await open_challenge(update, DUEL, bet, matchmaking=True)
+    if user is None:
+        await update.message.reply_text(f"Hai già {MAX_PENDING_CHALLENGES} sfide aperte, giocale prima di lanciarne altre.")
+    elif challenge_id is None:
+        await update.message.reply_text(f"Puntata invalida, come te. Hai {user.length}cm.")
+    else:
+        matchmaker.report(chat_id, QUEUED, user_id, bet)
+
+async def post_duel_summary(app, chat_id, events, order_book):
+    """One message with a chat's matchmaking results since the last summary"""
+    names = await name_cache.resolve_many(
+        app.bot, chat_id, [event[1] for event in events] + [event[2] for event in events if event[0] == MATCHED],
+        NAME_LOOKUP_CONCURRENCY, NAME_LOOKUP_DEADLINE
+    )
+    lines = []
+    for event in events:
+        if event[0] == MATCHED:
+            _, winner_id, loser_id, stake = event
+            lines.append(f"⚔️ {names[str(winner_id)]} batte {names[str(loser_id)]} e vince {2 * stake}cm")
+        elif event[0] == QUEUED:
+            lines.append(f"⏳ {names[str(event[1])]} cerca un duello da {event[2]}cm")
+        else:
+            lines.append(f"⌛ Il duello da {event[2]}cm di {names[str(event[1])]} è scaduto, puntata restituita")
+    msg = "⚔️ Duelli in piazza ⚔️\n\n" + "\n".join(lines[:MATCHMAKING_SUMMARY_LINES])
+    if len(lines) > MATCHMAKING_SUMMARY_LINES:
+        msg += f"\n...e altri {len(lines) - MATCHMAKING_SUMMARY_LINES}"
+    stakes = order_book.stakes()
+    if stakes is not None:
+        low, high = stakes
+        band = f"{low}cm" if low == high else f"da {low} a {high}cm"
+        waiting = "1 duello" if len(order_book) == 1 else f"{len(order_book)} duelli"
+        msg += f"\n\nIn attesa di avversario: {waiting}, {band}. Scrivi /duello_pisello [puntata] per sfidarli!"
+    await app.bot.send_message(chat_id=int(chat_id), text=msg, rate_limit_args=BROADCAST)
 
 async def superenalotto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
+    chat_id = update.effective_chat.id
     msg = "🎰 SCOMMESSE ATTUALI 🎰\n\n"
 
-    with data_lock:
-        active_bets = {}
-        for uid, b in data['lottery']['bets'].items():
-            num = b['number']
-            active_bets.setdefault(num, []).append((uid, b['amount']))
+    # Read-only and free of awaits, so it needs no lock
+    totals = store.bet_totals(chat_id)
+    for num, (total, count) in sorted(totals.items()):
+        msg += f"{num}: {total}cm da {count} fascisti\n"
 
-        for num, entries in active_bets.items():
-            total = sum(a for _, a in entries)
-            msg += f"{num}: {total}cm da {len(entries)} fascisti\n"
+    own = store.get_bet(chat_id, user_id)
+    if own:
+        msg += f"\nTe hai puntato {own['amount']}cm sul numero {own['number']}, io consiglierei di puntare di più"
 
-        if user_id in data['lottery']['bets']:
-            own = data['lottery']['bets'][user_id]
-            msg += f"\nTe hai puntato {own['amount']}cm sul numero {own['number']}, io consiglierei di puntare di più"
-
-        remaining_sec = int(data['lottery']['end_time'] - now())
+    if totals:
+        remaining_sec = max(0, int(store.lottery_end_time(chat_id) - now()))
         hours = remaining_sec // 3600
         minutes = (remaining_sec % 3600) // 60
         seconds = remaining_sec % 60
         msg += f"\n⏰ Prossima estrazione tra: {hours}h {minutes}m {seconds}s"
+    else:
+        # No bets means no armed deadline: the round starts with the first one
+        msg += "\n⏰ Il prossimo round parte con la prima schedina"
 
     await update.message.reply_text(msg)
 
@@ -313,154 +628,273 @@ async def schedina(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Non sai contare?")
         return
 
-    if not (1 <= number <= 10) or amount <= 0 or amount > user['length']:
+    if not (1 <= number <= 10) or amount <= 0 or amount > user.length:
         await update.message.reply_text("O non sai contare o lo hai troppo piccolo, scommessa rifiutata coglione!")
         return
 
-    user['length'] -= amount
-
-    with data_lock:
+    chat_id = update.effective_chat.id
+    async with user_locks.hold(user_id, lottery_lock(chat_id)):
         # Set end time if expired
-        if now() >= data['lottery'].get('end_time', 0):
-            data['lottery']['end_time'] = now() + LOTTERY_INTERVAL
+        if now() >= store.lottery_end_time(chat_id):
+            store.set_lottery_end_time(chat_id, now() + LOTTERY_INTERVAL)
 
-        current_bet = data['lottery']['bets'].get(user_id)
-        if current_bet:
-            if current_bet['number'] != number:
-                await update.message.reply_text("Hai già scommesso su un altro numero mongolo!")
-                return
-            current_bet['amount'] += amount
-        else:
-            data['lottery']['bets'][user_id] = {'number': number, 'amount': amount}
+        bet, error = store.place_bet(chat_id, user_id, number, amount)
+        if error is None:
+            # A round is told apart by its deadline
+            book(user_id, LOTTERY, STAKE, -amount, chat_id, round_id=int(store.lottery_end_time(chat_id)))
+            lottery_scheduler.arm(str(chat_id), store.lottery_end_time(chat_id))
 
+    if error == 'number':
+        await update.message.reply_text("Hai già scommesso su un altro numero mongolo!")
+        return
+    if error == 'length':
+        await update.message.reply_text("O non sai contare o lo hai troppo piccolo, scommessa rifiutata coglione!")
+        return
 
     save_data()
-    await update.message.reply_text(f"✅ Hai fatto bene a puntare di più! Totale: {data['lottery']['bets'][user_id]['amount']}cm sul numero {number}")
-
+    await update.message.reply_text(f"✅ Hai fatto bene a puntare di più! Totale: {bet['amount']}cm sul numero {number}")
+
+
+GAME_LABELS = {COINFLIP: "🪙 Coinflip", DUEL: "⚔️ Duelli", LOTTERY: "🎯 Lotteria"}
+
+def ledger_stats_text(user_id):
+    """Per-game results, streaks and biggest win from the ledger rollups"""
+    summary = ledger.summary(user_id) if ledger is not None else None
+    if summary is None:
+        return ""
+    msg = "\n"
+    for game, label in GAME_LABELS.items():
+        net, wins, losses = summary['games'][game]
+        if wins or losses or net:
+            msg += f"{label}: {wins} vinte, {losses} perse, netto {net:+d}cm\n"
+    gifts = sum(summary['games'][game][0] for game in (DAILY, HOURLY, THANKS))
+    if gifts:
+        msg += f"🍞 Regalati dal duce: {gifts}cm\n"
+    streak = summary['streak']
+    if streak > 0:
+        msg += f"🔥 Serie attuale: {streak} {'vittoria' if streak == 1 else 'vittorie'} di fila\n"
+    elif streak < 0:
+        msg += f"🥶 Serie attuale: {-streak} {'sconfitta' if streak == -1 else 'sconfitte'} di fila\n"
+    best = summary['best_streak']
+    if best:
+        msg += f"🏅 Serie migliore: {best} {'vittoria' if best == 1 else 'vittorie'} di fila\n"
+    if summary['biggest_win']:
+        msg += f"💎 Vincita più grande: {summary['biggest_win']}cm\n"
+    return msg
 
 async def tessera_del_pane(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = get_user(update.effective_user.id)
-    daily = user['stats'].get('daily_used', 0)
-    hourly = user['stats'].get('hourly_used', 0)
+    daily = user.daily_used
+    hourly = user.hourly_used
 
     await update.message.reply_text(
         f"💰 Tessera del Pane 💰\n"
         f"Razioni giornaliere ottenute: {daily} volte\n"
         f"Elemosine ricevute: {hourly} volte\n"
+        f"{ledger_stats_text(update.effective_user.id)}"
         f"Dovresti essere più ludopatico"
     )
 
 
 async def grazie_mosca(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Thank you command"""
-    user = get_user(update.effective_user.id)
-    
     # Small random bonus for being polite
     if random.random() < 0.1:  # 10% chance
         bonus = 1
-        user['length'] += bonus
-        save_data()
+        async with user_locks.hold(update.effective_user.id):
+            user = update_user(update.effective_user.id, {'length': bonus})
+            book(update.effective_user.id, THANKS, BONUS, bonus, update.effective_chat.id)
+            save_data()
         await update.message.reply_text(
             f"Grazie della cortesia! 🙏\n"
             f"Per la tua gentilezza: +{bonus}cm\n"
-            f"Zucchina attuale: {user['length']}cm"
+            f"Zucchina attuale: {user.length}cm"
         )
     else:
         await update.message.reply_text(
             "Prego! La cortesia è sempre apprezzata! 🙏"
         )
 
+async def diagnostica(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only diagnostics: /diagnostica profilo [secondi] | task | lag"""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Comando riservato agli admin.")
+        return
+
+    action = context.args[0] if context.args else 'lag'
+    if action == 'profilo':
+        try:
+            seconds = int(context.args[1]) if len(context.args) > 1 else DIAG_PROFILE_SECONDS
+        except ValueError:
+            await update.message.reply_text("Uso: /diagnostica profilo [secondi]")
+            return
+        seconds = max(1, min(seconds, DIAG_PROFILE_MAX_SECONDS))
+        await update.message.reply_text(f"Profilo dell'event loop per {seconds}s...")
+        path, samples = await run_profile(seconds)
+        top = "\n".join(f"{share:5.1%} {name}" for name, share in top_functions(samples, 8))
+        await update.message.reply_text(f"{sum(samples.values())} campioni in {path}\n\n{top}")
+    elif action == 'task':
+        path, text = await write_task_dump()
+        await update.message.reply_text(f"Salvato in {path}\n\n{text[:3500]}")
+    elif action == 'lag':
+        if lag_monitor is None:
+            await update.message.reply_text("Monitor del lag disattivato (LOOP_LAG_THRESHOLD=0).")
+        else:
+            await update.message.reply_text(lag_monitor.report())
+    else:
+        await update.message.reply_text("Uso: /diagnostica profilo [secondi] | task | lag")
+
 async def handle_coinflip_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
     try:
-        _, user_id, choice = query.data.split(":")
+        _, challenge_id, choice = query.data.split(":")
         actor_id = str(query.from_user.id)
+        chat_id = update.effective_chat.id
+
+        bet_data = store.get_challenge(chat_id, challenge_id)
+        if bet_data is None or challenge_type(bet_data) != COINFLIP:
+            await query.edit_message_text("Coinflip non valido o già completato.")
+            return
 
+        user_id = challenge_owner(bet_data, challenge_id)
         if actor_id != user_id:
             await query.answer("Non toccare porcodio, solo chi lo ha creato può giocare!", show_alert=True)
             return
 
-        bet_data = data['duels'].get(user_id)
-        if not bet_data or bet_data.get('type') != 'coinflip':
+        user = None
+        async with user_locks.hold(user_id):
+            bet_data = store.get_challenge(chat_id, challenge_id)
+            if bet_data and challenge_type(bet_data) == COINFLIP:
+                bet = bet_data['bet']
+                win = random.choice(["cannetta", "cannone"])
+                if bet_data.get('escrowed'):
+                    # The stake is already held: a win returns it twice
+                    if choice == win:
+                        user = update_user(user_id, {'length': 2 * bet, 'stats.won': 1, 'stats.bet_total': bet})
+                    else:
+                        user = update_user(user_id, {'stats.lost': 1, 'stats.bet_total': bet})
+                elif choice == win:
+                    user = update_user(user_id, {'length': bet, 'stats.won': 1, 'stats.bet_total': bet}, min_length=bet)
+                else:
+                    user = update_user(user_id, {'length': -bet, 'stats.lost': 1, 'stats.bet_total': bet}, min_length=bet)
+                if user is not None:
+                    round_id = challenge_round(challenge_id)
+                    if bet_data.get('escrowed') and choice == win:
+                        book_payout(user_id, COINFLIP, bet, bet, chat_id, round_id=round_id)
+                    elif bet_data.get('escrowed'):
+                        book(user_id, COINFLIP, LOSS, 0, chat_id, round_id=round_id)
+                    else:
+                        book(user_id, COINFLIP, WIN if choice == win else LOSS, bet if choice == win else -bet,
+                             chat_id, round_id=round_id)
+                    store.claim_challenge(chat_id, challenge_id)
+                    pending_challenges.remove(chat_id, challenge_id)
+                    save_data()
+
+        if not bet_data or challenge_type(bet_data) != COINFLIP:
             await query.edit_message_text("Coinflip non valido o già completato.")
             return
 
-        user = get_user(user_id)
-        bet = bet_data['bet']
-
-        if user['length'] < bet:
+        if user is None:
             await query.edit_message_text("Lo hai troppo piccolo per questo coinflip.")
             return
 
-        user['length'] -= bet
-        win = random.choice(["cannetta", "cannone"])
         msg = f"Hai scelto: {choice}\nÈ uscito: {win}\n"
-
         if choice == win:
-            user['length'] += bet * 2
-            user['stats']['won'] += 1
             msg += f"💰 HAI VINTO! Guadagni: +{bet}cm, viva il duce"
         else:
-            user['stats']['lost'] += 1
             msg += f"💸 Hai perso {bet}cm, sfigato."
 
-        user['stats']['bet_total'] += bet
-        del data['duels'][user_id]
-        save_data()
-
-        await query.edit_message_text(msg + f"\nOra il tuo cazzo è lungo {user['length']}cm")
+        await query.edit_message_text(msg + f"\nOra il tuo cazzo è lungo {user.length}cm")
 
     except Exception as e:
         logger.error(f"Errore nel coinflip callback: {e}")
         await query.edit_message_text("Errore nel coinflip!")
 
 
+async def play_duel(chat_id, challenge_id, challenger_id, defender_id):
+    """Settle a duel against an open challenge, both sides locked in stripe
+    order: (stake, paid, winner_id, defender). stake is None if the duel is
+    gone; paid is falsy if the defender could not pay, and the duel stays
+    open only if its stake is escrowed"""
+    paid = winner_id = None
+    async with user_locks.hold(challenger_id, defender_id):
+        defender = get_user(defender_id)
+        duel = store.get_challenge(chat_id, challenge_id)
+        challenger_bet = duel['bet'] if duel and challenge_type(duel) == DUEL else None
+        if challenger_bet is not None and defender.length >= challenger_bet:
+            winner_id, loser_id = random.choice([(challenger_id, defender_id), (defender_id, challenger_id)])
+            round_id = challenge_round(challenge_id)
+            if duel.get('escrowed'):
+                # The challenger's stake is held: the defender matches it, the winner takes both
+                paid = update_user(defender_id, {'length': -challenger_bet}, min_length=challenger_bet)
+                if paid is not None:
+                    book(defender_id, DUEL, STAKE, -challenger_bet, chat_id, challenger_id, round_id)
+                    pot, loss = 2 * challenger_bet, 0
+            else:
+                paid = store.transfer(loser_id, winner_id, challenger_bet)
+                loss = -challenger_bet
+            if paid:
+                # A transfer already moved the stake; an escrowed duel pays out the pot,
+                # booked as the winner's stake back plus the net gain
+                credit = {'length': pot} if duel.get('escrowed') else {}
+                update_user(winner_id, {**credit, 'stats.won': 1, 'stats.bet_total': challenger_bet})
+                update_user(loser_id, {'stats.lost': 1, 'stats.bet_total': challenger_bet})
+                if duel.get('escrowed'):
+                    book_payout(winner_id, DUEL, challenger_bet, challenger_bet, chat_id, loser_id, round_id)
+                else:
+                    book(winner_id, DUEL, WIN, challenger_bet, chat_id, loser_id, round_id)
+                book(loser_id, DUEL, LOSS, loss, chat_id, winner_id, round_id)
+            if paid or not duel.get('escrowed'):
+                store.claim_challenge(chat_id, challenge_id)
+                pending_challenges.remove(chat_id, challenge_id)
+                matchmaker.remove(chat_id, challenge_id)
+                save_data()
+            else:
+                # Spent meanwhile in a chat of another worker: the duel stays open
+                defender = get_user(defender_id)
+    return challenger_bet, paid, winner_id, defender
+
 async def handle_duel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle duel callback"""
     query = update.callback_query
     await query.answer()
     
     try:
-        action, challenger_id = query.data.split(':')[1:3]
-        challenger_id = int(challenger_id)
+        action, challenge_id = query.data.split(':')[1:3]
+        chat_id = update.effective_chat.id
+
+        duel = store.get_challenge(chat_id, challenge_id)
+        if duel is None or challenge_type(duel) != DUEL:
+            await query.edit_message_text("Il duello non è valido o è scaduto.")
+            return
+        challenger_id = int(challenge_owner(duel, challenge_id))
         
         if query.from_user.id == challenger_id:
             await query.edit_message_text("Non puoi accettare il tuo stesso duello ritardato!")
             return
         
-        challenger = get_user(challenger_id)
-        defender = get_user(query.from_user.id)
-        
         if action == "accept":
-            # Duel logic
-            challenger = get_user(challenger_id)
-            defender = get_user(query.from_user.id)
+            challenger_bet, paid, winner_id, defender = await play_duel(
+                chat_id, challenge_id, challenger_id, query.from_user.id
+            )
 
-            challenger_bet = data['duels'].get(str(challenger_id), {}).get('bet')
             if challenger_bet is None:
                 await query.edit_message_text("Il duello non è valido o è scaduto.")
                 return
 
-            if defender['length'] < challenger_bet:
+            if defender.length < challenger_bet:
                 await query.answer("Lo hai troppo piccolo per accettare il duello!", show_alert=True)
                 return
             
-            challenger['length'] -= challenger_bet
-            defender['length'] -= challenger_bet
             total_pot = challenger_bet + challenger_bet
-
-            winner = random.choice(['challenger', 'defender'])
-            if winner == 'challenger':
-                challenger['length'] += total_pot
+            if not paid:
+                result = "Lo sfidante non ha più abbastanza cm, duello annullato."
+            elif winner_id == challenger_id:
                 result = f"{get_username(update.effective_user)} ha corso un rischio ed è stato premiato!\nHa vinto {total_pot}cm!"
             else:
-                defender['length'] += total_pot
                 result = f"{get_username(query.from_user)} ha le palle, e sono esplose in faccia all'avversario!\nIn cambio vince {total_pot}cm!"
-
-            del data['duels'][str(challenger_id)]
-            save_data()
             await query.edit_message_text(result)
 
             
@@ -473,114 +907,337 @@ async def handle_donation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer("Funzione donazione non ancora implementata!")
 
-# === Background Lottery Thread ===
-async def lottery_draw_loop(app):
-    logger.info("lottery_draw_loop is running")
-    group_id = FIXED_GROUP_CHAT_ID
+# === Lottery Scheduler ===
+def settle_lottery_round(chat_id, bets, totals=None):
+    """Draw a number, pay out the chat's round and return the announcement
+    text; None if the round no longer matches totals (see Storage.settle_lottery)"""
+    started = time.perf_counter()
+    winning_number = random.randint(1, 10)
+
+    result = settle(*bet_columns(bets), winning_number, LOTTERY_TOP_WINNERS)
+    round_id = int(store.lottery_end_time(chat_id))
+    if not store.settle_lottery(chat_id, result.credits, None if result.refunded else winning_number, totals):
+        return None
+    book_round(chat_id, round_id, result)
+    logger.info(f"Chat {chat_id}: estratto {winning_number}, {len(bets)} schedine, montepremi {result.pot}cm")
+
+    message = f"🎯 Numero estratto: {winning_number}\n\n"
+    if result.refunded:
+        message += "😢 Nessun vincitore. Puntate rimborsate."
+    else:
+        # A summary and the biggest wins, never one line per bettor
+        message += f"🏆 {result.winners} vincitori si dividono {result.pot}cm:\n"
+        message += "\n".join(
+            f"- {name_cache.get(uid, allow_stale=True) or f'User {uid}'} ha vinto {share}cm"
+            for uid, share in result.top
+        )
+        if result.winners > len(result.top):
+            message += f"\n...e altri {result.winners - len(result.top)} vincitori"
+        losers = result.bettors - result.winners
+        if losers:
+            message += f"\n\n❌ {losers} perdenti hanno lasciato {result.lost}cm sul tavolo"
+
+    LOTTERY_SETTLE.observe(time.perf_counter() - started)
+    LOTTERY_BETS.observe(len(bets))
+    LOTTERY_POT.observe(result.pot)
+    return message
+
+def book_round(chat_id, round_id, result):
+    """Ledger entries of a settled round: refunds, or each winner's stake back
+    plus the rest of their share as the win, and each loss"""
+    if ledger is None:
+        return
+    if result.refunded:
+        user_ids, columns = result.credits[0]
+        ledger.record_many(user_ids, LOTTERY, REFUND, columns['length'], chat_id, round_id, current_length)
+        return
+    (winner_ids, won), (loser_ids, _) = result.credits
+    gains = [share - stake for share, stake in zip(won['length'], result.stakes)]
+    ledger.record_payouts(winner_ids, LOTTERY, result.stakes, gains, chat_id, round_id, current_length)
+    ledger.record_many(loser_ids, LOTTERY, LOSS, [0] * len(loser_ids), chat_id, round_id, current_length)
+
+async def draw_lottery(app, chat_id):
+    """Settle a chat's lottery round once its deadline has passed"""
+    if lottery_election is not None and not lottery_election.leader:
+        # Leadership moved meanwhile: the new leader draws it
+        return
+    # Lock only this chat's round and its bettors, so other chats keep
+    # playing; retry if someone new bet while the locks were taken, or in
+    # another worker before the round was settled
     while True:
-        try:
-            await asyncio.sleep(5)  # Check every 5 seconds
-            current_time = now()
-
-            with data_lock:
-                end_time = data['lottery'].get('end_time', 0)
-                if current_time < end_time:
-                    continue
-
-                bets = data['lottery']['bets'].copy()
-                data['lottery']['end_time'] = current_time + LOTTERY_INTERVAL
+        bettors = list(store.lottery_bets(chat_id))
+        async with user_locks.hold(lottery_lock(chat_id), *bettors):
+            # Read before the bets: unchanged totals at settlement mean unchanged bets
+            totals = store.bet_totals(chat_id)
+            bets = store.lottery_bets(chat_id)
+            if not bets.keys() <= set(bettors):
+                continue
 
+            end_time = store.lottery_end_time(chat_id)
+            if now() < end_time:
+                # Deadline moved meanwhile: wait for the new one
+                lottery_scheduler.arm(chat_id, end_time)
+                return
             if not bets:
-                logger.info("Nessuna scommessa attiva. Nuovo round iniziato.")
+                logger.info(f"Nessuna scommessa attiva nella chat {chat_id}, lotteria ferma.")
+                return
+
+            message = settle_lottery_round(chat_id, bets, totals)
+            if message is None:
                 continue
+            store.set_lottery_end_time(chat_id, now() + LOTTERY_INTERVAL)
+            break
+
+    save_data()
+    try:
+        await app.bot.send_message(chat_id=int(chat_id), text=message, rate_limit_args=BROADCAST)
+    except Exception:
+        logger.exception(f"❌ Errore durante invio messaggio lotteria alla chat {chat_id}")
+
+# One deadline per chat with an open round; schedina arms it, post_init
+# re-arms rounds restored from disk (past deadlines fire immediately)
+lottery_scheduler = DeadlineScheduler(callback=None)
+# In a worker process, only the holder of the 'lottery' lease runs the scheduler
+lottery_election = None
+
+def arm_open_rounds():
+    """Arm the deadline of every round with bets; returns how many"""
+    rounds = store.open_rounds()
+    for chat_id, end_time in rounds.items():
+        lottery_scheduler.arm(str(chat_id), end_time)
+    return len(rounds)
+
+async def lead_lottery():
+    lottery_scheduler.start()
+    logger.info(f"Leader della lotteria, {arm_open_rounds()} round aperti.")
+
+async def follow_lottery():
+    await lottery_scheduler.stop()
+
+async def poll_open_rounds():
+    # Rounds opened in other workers since the last renewal
+    arm_open_rounds()
+
+# === Challenge Expiry ===
+async def expire_challenge(app, key):
+    """Refund an unplayed challenge and mark its message as expired"""
+    chat_id, challenge_id = split_key(key)
+    record = store.get_challenge(chat_id, challenge_id)
+    if record is None:
+        pending_challenges.remove(chat_id, challenge_id)
+        return
+    async with user_locks.hold(challenge_owner(record, challenge_id)):
+        record = store.claim_challenge(chat_id, challenge_id)
+        pending_challenges.remove(chat_id, challenge_id)
+        if record is None:
+            return
+        if record.get('escrowed'):
+            owner = challenge_owner(record, challenge_id)
+            update_user(owner, {'length': record['bet']})
+            book(owner, challenge_type(record), REFUND, record['bet'], chat_id, round_id=challenge_round(challenge_id))
+        if matchmaker.remove(chat_id, challenge_id):
+            matchmaker.report(chat_id, EXPIRED, challenge_owner(record, challenge_id), record['bet'])
+        save_data()
 
-            # Draw time!
-            winning_number = random.randint(1, 10)
-            logger.info(f"Numero estratto: {winning_number}")
-
-            winning_bets = {
-                uid: b for uid, b in bets.items() if b['number'] == winning_number
-            }
-
-            total_pot = sum(b['amount'] for b in bets.values())
-            total_winning = sum(b['amount'] for b in winning_bets.values())
-
-            logger.info(f"Inviando messaggio al gruppo {group_id}")
-            logger.info(f"Inviando messaggio al gruppo {total_pot}")
-
-            group_id = FIXED_GROUP_CHAT_ID
-            message = f"🎯 Numero estratto: {winning_number}\n\n"
-
-            logger.info(f"Arrivo anche qua")
-
-            if winning_bets:
-                winners = []
-                losers = []
-                with data_lock:
-                    for uid, b in bets.items():
-                        user = get_user(uid)
-                        name = user.get('username', f'user_{uid}')
-                        logger.info(f"Qua si")
-                        if uid in winning_bets:
-                            share = int(total_pot * (b['amount'] / total_winning))
-                            user['length'] += share
-                            user['stats']['length_won'] += share
-                            winners.append(f"- @{name} ha vinto {share}cm")
-                            logger.info(f"Qua pure")
-                        else:
-                            user['stats']['length_lost'] += b['amount']
-                            losers.append(f"- @{name} ha perso {b['amount']}cm")
-                            logger.info(f"Qua anche")
-
-                    data['lottery']['bets'] = {}
-                    data['lottery']['history'].append(winning_number)
-                    data['lottery']['history'] = data['lottery']['history'][-5:]
-
-                message += "🏆 Vincitori:\n" + "\n".join(winners) + "\n\n"
-                message += "❌ Perdenti:\n" + "\n".join(losers)
-
-                logger.info(f"E anche qua")
+    if record.get('message_id') is None:
+        return
+    name = "Coinflip" if challenge_type(record) == COINFLIP else "Duello"
+    refund = " Puntata restituita." if record.get('escrowed') else ""
+    try:
+        await app.bot.edit_message_text(
+            f"⌛ {name} da {record['bet']}cm scaduto, nessuno l'ha giocato.{refund}",
+            chat_id=int(chat_id), message_id=record['message_id'], rate_limit_args=BROADCAST
+        )
+    except Exception as e:
+        logger.warning(f"Impossibile segnare come scaduta la sfida {key}: {e}")
+
+def restore_challenges():
+    """Arm the expiry of every challenge saved on disk; returns how many"""
+    challenges = {key: value for key, value in store.open_challenges().items() if owns_chat(key[0])}
+    for (chat_id, challenge_id), (owner, expires) in challenges.items():
+        # Challenges saved before expiries existed get a full TTL from now
+        pending_challenges.add(chat_id, challenge_id, owner, expires or now() + CHALLENGE_TTL)
+        if MATCHMAKING:
+            record = store.get_challenge(chat_id, challenge_id)
+            if record is not None and record.get('matchmaking'):
+                matchmaker.add(chat_id, challenge_id, owner, record['bet'])
+    return len(challenges)
+
+# Expiry deadline of every open coinflip and duel; post_init re-arms those
+# restored from disk
+pending_challenges = PendingChallenges()
+# Open matchmaking duels of every chat and the results of the next summaries
+matchmaker = Matchmaker(MATCHMAKING_SUMMARY_INTERVAL)
+
+metrics.gauge('zucchini_lottery_open_rounds', "Chats with a lottery round running", lambda: len(lottery_scheduler))
+metrics.gauge('zucchini_lottery_draws', "Lottery deadlines fired since start", lambda: lottery_scheduler.fired)
+metrics.gauge('zucchini_lottery_leader', "1 while this process draws the lotteries",
+              lambda: int(lottery_election is None or lottery_election.leader))
+metrics.gauge('zucchini_challenges_pending', "Coinflips and duels waiting to be played", lambda: len(pending_challenges))
+metrics.gauge('zucchini_challenges_expired', "Challenges expired since start", lambda: pending_challenges.expired)
+metrics.gauge('zucchini_matchmaking_orders', "Duels waiting in the matchmaking order books", lambda: len(matchmaker))
+metrics.gauge('zucchini_matchmaking_matched', "Duels paired by matchmaking since start", lambda: matchmaker.matched)
+metrics.gauge('zucchini_matchmaking_summaries', "Matchmaking summaries sent", lambda: matchmaker.summaries)
+metrics.gauge('zucchini_throttle_passed', "Commands let through by the throttle", lambda: throttle.passed)
+metrics.gauge('zucchini_throttle_dropped_cooldown', "Commands answered from the cooldown cache",
+              lambda: throttle.dropped['cooldown'])
+metrics.gauge('zucchini_throttle_dropped_user', "Commands over a user's rate limit", lambda: throttle.dropped['user'])
+metrics.gauge('zucchini_throttle_dropped_chat', "Commands over a chat's rate limit", lambda: throttle.dropped['chat'])
+metrics.gauge('zucchini_throttle_notices', "Rate limit notices sent", lambda: throttle.notices)
+metrics.gauge('zucchini_lock_contended', "Lock acquisitions that had to wait", lambda: user_locks.contended)
+def user_cache_stat(name):
+    """A counter of the binary snapshot's user cache, 0 with other storage"""
+    users = store.data['users'] if isinstance(store, JsonStorage) else None
+    return getattr(users, name, 0)
+
+metrics.gauge('zucchini_user_cache_size', "Users decoded in memory", lambda: user_cache_stat('decoded'))
+metrics.gauge('zucchini_user_cache_hits', "User lookups served from memory", lambda: user_cache_stat('hits'))
+metrics.gauge('zucchini_user_cache_misses', "Users read back from the snapshot or the cold store",
+              lambda: user_cache_stat('misses'))
+metrics.gauge('zucchini_user_cache_evictions', "Users evicted from memory", lambda: user_cache_stat('evictions'))
+metrics.gauge('zucchini_user_cache_writebacks', "Evicted users written to the cold store",
+              lambda: user_cache_stat('writebacks'))
+metrics.gauge('zucchini_ledger_entries', "Ledger entries recorded since start",
+              lambda: ledger.entries if ledger is not None else 0)
+metrics.gauge('zucchini_ledger_bytes', "Size of the ledger file", lambda: ledger.size if ledger is not None else 0)
+metrics.gauge('zucchini_ledger_users', "Users with ledger rollups", lambda: len(ledger.rollups) if ledger is not None else 0)
+metrics.gauge('zucchini_name_cache_hits', "Name cache hits", lambda: name_cache.hits)
+metrics.gauge('zucchini_name_cache_misses', "Name cache misses", lambda: name_cache.misses)
+
+
+# === Instrumentation ===
+def timed_handler(name, callback):
+    """Wrap a handler to record its latency and exceptions"""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """Bot API requests with per-method latency and error counts"""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception as e:
+            BOT_API_ERRORS.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - started, endpoint)
+        if code >= 400:
+            BOT_API_ERRORS.inc(endpoint, str(code))
+        return code, payload
 
-            else:
-                logger.info("Nessun vincitore - rimborso in corso")
-                with data_lock:
-                    for uid, b in bets.items():
-                        logger.info(f"Rimborsando utente {uid} con {b['amount']}cm")
-            
-                        user = get_user(uid)
-                        if not isinstance(user, dict):
-                            logger.warning(f"Utente {uid} è None o malformato: {user}")
-                            continue
+metrics_listener = None
 
-                        try:
-                            amount = int(b.get('amount', 0))
-                            user['length'] += amount
-                            logger.info(f"Nuova lunghezza per utente {uid}: {user['length']}")
-                        except Exception as e:
-                            logger.exception(f"Errore nel rimborso per utente {uid}")
+outbox = OutboundQueue(OUTBOX_GLOBAL_PER_SECOND, OUTBOX_CHAT_PER_SECOND, OUTBOX_GROUP_PER_MINUTE)
+metrics.gauge('zucchini_outbox_sent', "Bot API calls sent through the outbound queue", lambda: outbox.sent)
+metrics.gauge('zucchini_outbox_retried', "Calls retried after a 429", lambda: outbox.retried)
+metrics.gauge('zucchini_outbox_coalesced', "Edits merged into a later edit of the same message", lambda: outbox.coalesced)
+metrics.gauge('zucchini_outbox_split', "Messages split to fit 4096 characters", lambda: outbox.split)
 
-                    message += "😢 Nessun vincitore. Puntate rimborsate."
-                    logger.info("Rimborso completato")
-                    data['lottery']['bets'] = {}
 
+# === Diagnostics ===
+lag_monitor = LagMonitor(LOOP_LAG_THRESHOLD) if LOOP_LAG_THRESHOLD > 0 else None
 
+metrics.gauge(
+    'zucchini_loop_lag_max_seconds', "Largest event-loop lag seen by the heartbeat",
+    lambda: lag_monitor.max_lag if lag_monitor is not None else 0
+)
 
-            save_data()
-            logger.info("Inizio invio messaggio estrazione lotteria")
-            if group_id:
-                try:
-                    logger.info(f"Inviando messaggio al gruppo {group_id}")
-                    await app.bot.send_message(chat_id=group_id, text=message)
-                    logger.info("✅ Messaggio lotteria inviato con successo")
-                except Exception as e:
-                    logger.exception("❌ Errore durante invio messaggio lotteria")
-            else:
-                logger.warning("⚠️ Group chat ID non definito — messaggio non inviato.")
+def diag_path(kind, extension):
+    return os.path.join(DIAG_DIR, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+async def run_profile(seconds):
+    """Sample the event loop's thread from a worker thread; (path, samples)"""
+    samples = await asyncio.to_thread(sample_stacks, threading.get_ident(), seconds)
+    path = diag_path('profile', 'folded')
+    await asyncio.to_thread(write_collapsed, samples, path)
+    return path, samples
+
+async def write_task_dump():
+    """Dump every asyncio task plus the lag report; (path, text)"""
+    text = dump_tasks()
+    if lag_monitor is not None:
+        text = lag_monitor.report() + "\n\n" + text
+    path = diag_path('tasks', 'txt')
+
+    def write():
+        os.makedirs(DIAG_DIR, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text)
+    await asyncio.to_thread(write)
+    return path, text
+
+async def on_diag_signal(kind):
+    if kind == 'profile':
+        path, samples = await run_profile(DIAG_PROFILE_SECONDS)
+        logger.warning(f"Profilo salvato in {path} ({sum(samples.values())} campioni)")
+    else:
+        path, _ = await write_task_dump()
+        logger.warning(f"Task salvati in {path}")
 
+def install_diag_signals():
+    """SIGUSR1 profiles the loop for DIAG_PROFILE_SECONDS, SIGUSR2 dumps the tasks"""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    loop = asyncio.get_running_loop()
+    for sig, kind in ((signal.SIGUSR1, 'profile'), (signal.SIGUSR2, 'tasks')):
+        loop.add_signal_handler(sig, lambda kind=kind: asyncio.create_task(on_diag_signal(kind)))
+
+
+# === Update Hooks ===
+async def remember_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Feed the name cache from every incoming update"""
+    name_cache.remember(update.effective_user)
+
+def update_command(update):
+    """Command name, or button prefix like 'classifica:', that an update invokes"""
+    if update.callback_query is not None:
+        return (update.callback_query.data or '').split(':', 1)[0] + ':'
+    text = update.message.text if update.message is not None else None
+    if not text or not text.startswith('/'):
+        return None
+    return text.split()[0][1:].split('@')[0]
+
+async def throttle_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shed spam before the handlers run: cooldowns and rate limits are
+    answered at most once per notice interval, the rest dropped"""
+    command = update_command(update)
+    if command is None or update.effective_user is None:
+        return
+    chat_id = update.effective_chat.id if update.effective_chat is not None else None
+    rejection = throttle.check(update.effective_user.id, chat_id, command, now(), THROTTLE_COSTS.get(command, 1))
+    if rejection is None:
+        return
 
+    reason, remaining, notify = rejection
+    if notify:
+        if reason == COOLDOWN:
+            text = COOLDOWN_TEXTS[command](remaining)
+        else:
+            text = "Calma ritardato, stai spammando. Riprova tra qualche secondo."
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer(text)
+            else:
+                await update.message.reply_text(text)
         except Exception as e:
-            logger.error("Errore nel ciclo lotteria:\n" + traceback.format_exc())
-            await asyncio.sleep(10)
+            logger.warning(f"Avviso di rallentamento non inviato: {e}")
+    raise ApplicationHandlerStop
+
+async def capture_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Record the update, stamped when the bot starts processing it"""
+    update_recorder.record(update.to_dict())
 
 
 # === Error Handler ===
@@ -590,40 +1247,255 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def post_init(app):
-    asyncio.create_task(lottery_draw_loop(app))
-    logger.info("Background lottery loop started.")
+    global metrics_listener, lottery_election
+    lottery_scheduler.callback = functools.partial(draw_lottery, app)
+    if WORKER_INDEX is None:
+        lottery_scheduler.start()
+        logger.info(f"Lottery scheduler started, {arm_open_rounds()} round aperti.")
+    else:
+        lottery_election = LeaderElection(
+            store, 'lottery', f"worker-{WORKER_INDEX}:{os.getpid()}", LEADER_LEASE_TTL,
+            on_elected=lead_lottery, on_deposed=follow_lottery, on_tick=poll_open_rounds
+        )
+        lottery_election.start()
+    pending_challenges.set_callback(functools.partial(expire_challenge, app))
+    pending_challenges.start()
+    logger.info(f"{restore_challenges()} sfide in attesa.")
+    if MATCHMAKING:
+        matchmaker.callback = functools.partial(post_duel_summary, app)
+        matchmaker.start()
+    store.start()
+    logger.info("Storage background tasks started.")
+    if ledger is not None:
+        ledger.start()
+    if update_recorder is not None:
+        update_recorder.start()
+        logger.info(f"Registrazione update attiva su {CAPTURE_FILE}")
+    if METRICS_PORT:
+        metrics_listener = await serve_metrics(METRICS_LISTEN, int(METRICS_PORT))
+    if lag_monitor is not None:
+        lag_monitor.start()
+    install_diag_signals()
+
+async def post_shutdown(app):
+    if metrics_listener is not None:
+        metrics_listener.close()
+    if lag_monitor is not None:
+        await lag_monitor.stop()
+    if lottery_election is not None:
+        await lottery_election.stop()
+    await lottery_scheduler.stop()
+    await pending_challenges.stop()
+    await matchmaker.stop()
+    if ledger is not None:
+        await ledger.close()
+    await store.close()
+    if update_recorder is not None:
+        await update_recorder.close()
+    logger.info("Dati salvati, storage chiuso.")
 
 # === Bot Setup ===
-def main():
-    """Main function to run the bot"""
-    
-    # Build application
-    app = ApplicationBuilder().token(TOKEN).post_init(post_init).build()
+# Handler table shared by main() and the offline benchmarks
+COMMANDS = {
+    'start': start,
+    'razione_giornaliera': razione_giornaliera,
+    'elemosina': elemosina,
+    'coinflip': coinflip,
+    'duello_pisello': duello_pisello,
+    'superenalotto': superenalotto,
+    'schedina': schedina,
+    'tessera_del_pane': tessera_del_pane,
+    'grazie_mosca': grazie_mosca,
+    'classifica': leaderboard,
+    'diagnostica': diagnostica,
+}
+# Commands on chat-wide state (the lottery round, the duel order book):
+# run in arrival order within each chat
+CHAT_COMMANDS = {'schedina', 'superenalotto'} | ({'duello_pisello'} if MATCHMAKING else set())
+CALLBACKS = {
+    '^duel:': handle_duel_callback,
+    '^donate:': handle_donation,
+    '^coinflip:': handle_coinflip_callback,
+    '^classifica:': handle_leaderboard_callback,
+}
+
+def register_handlers(app):
+    # Run before the command handlers for every update, one group each
+    # since a group only runs its first matching handler
+    if update_recorder is not None:
+        app.add_handler(TypeHandler(Update, capture_update), group=-3)
+    app.add_handler(TypeHandler(Update, remember_user), group=-2)
+    app.add_handler(TypeHandler(Update, throttle_update), group=-1)
 
-    group_id = FIXED_GROUP_CHAT_ID
-    logger.info(f"Stored group_chat_id: {group_id}")
-    
     # Add handlers - REMOVED GROUP FILTERS
-    app.add_handler(CommandHandler('start', start))
-    app.add_handler(CommandHandler('razione_giornaliera', razione_giornaliera))
-    app.add_handler(CommandHandler('elemosina', elemosina))
-    app.add_handler(CommandHandler('coinflip', coinflip))
-    app.add_handler(CommandHandler('duello_pisello', duello_pisello))
-    app.add_handler(CommandHandler('superenalotto', superenalotto))
-    app.add_handler(CommandHandler('schedina', schedina))
-    app.add_handler(CommandHandler('tessera_del_pane', tessera_del_pane))
-    app.add_handler(CommandHandler('grazie_mosca', grazie_mosca))
-    app.add_handler(CommandHandler('classifica', leaderboard))
-    app.add_handler(CallbackQueryHandler(handle_duel_callback, pattern='^duel:'))
-    app.add_handler(CallbackQueryHandler(handle_donation, pattern='^donate:'))
-    app.add_handler(CallbackQueryHandler(handle_coinflip_callback, pattern='^coinflip:'))
+    for command, callback in COMMANDS.items():
+        if metrics.enabled:
+            callback = timed_handler(command, callback)
+        app.add_handler(CommandHandler(command, callback))
+    for pattern, callback in CALLBACKS.items():
+        if metrics.enabled:
+            callback = timed_handler(pattern.strip('^'), callback)
+        app.add_handler(CallbackQueryHandler(callback, pattern=pattern))
+
+async def run_webhook(app):
+    """Serve updates pushed by Telegram until SIGINT/SIGTERM, like run_polling"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def enqueue(data):
+        await app.update_queue.put(Update.de_json(data, app.bot))
+
+    server = WebhookServer(
+        enqueue, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, HEALTH_PATH,
+        health=lambda: {'queued': app.update_queue.qsize(), 'rounds': len(lottery_scheduler)}
+    )
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET non impostato: chiunque raggiunga la porta può inviare update")
+
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    await server.start()
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+    try:
+        await stop.wait()
+    finally:
+        # Stop taking updates first, then drain the queue and persist everything
+        await server.stop()
+        await app.stop()
+        await app.shutdown()
+        await post_shutdown(app)
+
+# === Workers ===
+async def run_worker(app):
+    """Handle the updates the router pipes in, until it closes stdin"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        # Ctrl-C and service stops reach the whole process group: the
+        # router closes our stdin once it stopped taking updates
+        loop.add_signal_handler(sig, lambda: None)
+
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    try:
+        async for data in read_updates():
+            await app.update_queue.put(Update.de_json(data, app.bot))
+    finally:
+        await app.stop()
+        await app.shutdown()
+        await post_shutdown(app)
+
+async def poll_updates(bot, on_update, stop):
+    """Long-poll getUpdates and pass each update as a dict to on_update, until stop is set"""
+    offset = None
+    stopping = asyncio.create_task(stop.wait())
+    while not stop.is_set():
+        polling = asyncio.create_task(bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES))
+        await asyncio.wait({polling, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        if not polling.done():
+            polling.cancel()
+            break
+        try:
+            updates = polling.result()
+        except Exception as e:
+            logger.warning(f"getUpdates fallito: {e}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            await on_update(update.to_dict())
+            offset = update.update_id + 1
+
+async def run_router():
+    """Receive updates and hand each chat's to its worker process"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    pool = WorkerPool(WORKERS, [sys.executable, os.path.abspath(__file__)])
+    await pool.start()
+    if update_recorder is not None:
+        update_recorder.start()
+
+    async def route(data):
+        if update_recorder is not None:
+            update_recorder.record(data)
+        await pool.dispatch(data)
+
+    bot = Bot(TOKEN, base_url=BOT_API_URL) if BOT_API_URL else Bot(TOKEN)
+    await bot.initialize()
+    try:
+        if UPDATE_MODE == 'webhook':
+            server = WebhookServer(
+                route, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_LISTEN, WEBHOOK_PORT, HEALTH_PATH,
+                health=lambda: {'workers': pool.alive(), 'routed': pool.routed}
+            )
+            await server.start()
+            if WEBHOOK_URL:
+                await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+            await stop.wait()
+            await server.stop()
+        else:
+            await poll_updates(bot, route, stop)
+    finally:
+        # Workers drain what they were sent, then persist and exit
+        await pool.stop()
+        await bot.shutdown()
+        if update_recorder is not None:
+            await update_recorder.close()
+
+def build_application():
+    """The PTB application handling updates in this process"""
+    builder = ApplicationBuilder().token(TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+    builder = builder.rate_limiter(outbox)
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(KeyedUpdateProcessor(
+            CONCURRENT_UPDATES, MAX_QUEUE_PER_KEY, functools.partial(update_keys, chat_commands=CHAT_COMMANDS)
+        ))
+    if BOT_API_URL:
+        builder = builder.base_url(BOT_API_URL)
+    if metrics.enabled:
+        # Same pool size PTB uses by default; getUpdates long-polls keep their own request
+        builder = builder.request(InstrumentedRequest(connection_pool_size=256))
+    if UPDATE_MODE == 'webhook' or WORKER_INDEX is not None:
+        builder = builder.updater(None)
+    app = builder.build()
+
+    register_handlers(app)
 
-    
     # Add error handler
     app.add_error_handler(error_handler)
-    
-    logger.info("Bot started successfully")
-    app.run_polling()
+    return app
+
+def main():
+    """Main function to run the bot"""
+    if not TOKEN:
+        raise ValueError("BOT_TOKEN environment variable is required")
+    if min(OUTBOX_GLOBAL_PER_SECOND, OUTBOX_CHAT_PER_SECOND, OUTBOX_GROUP_PER_MINUTE) <= 0:
+        raise ValueError("OUTBOX_GLOBAL_PER_SECOND, OUTBOX_CHAT_PER_SECOND e OUTBOX_GROUP_PER_MINUTE devono essere positivi")
+    if WORKERS > 1 and WORKER_INDEX is None:
+        if STORAGE_BACKEND != 'sqlite':
+            raise ValueError("WORKERS > 1 richiede STORAGE_BACKEND=sqlite")
+        logger.info(f"Router avviato ({UPDATE_MODE}, {WORKERS} worker)")
+        asyncio.run(run_router())
+        return
+
+    startup()
+    app = build_application()
+    if WORKER_INDEX is not None:
+        logger.info(f"Worker {WORKER_INDEX} avviato")
+        asyncio.run(run_worker(app))
+        return
+
+    logger.info(f"Bot started successfully ({UPDATE_MODE})")
+    if UPDATE_MODE == 'webhook':
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
 
 if __name__ == '__main__':
     main()
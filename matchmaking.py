@@ -0,0 +1,172 @@
+# Zucchini Telegram Bot - Duel matchmaking
+# With MATCHMAKING on, /duello_pisello posts no challenge message: the
+# escrowed stake rests in the chat's order book until a duel with a stake in
+# its tolerance band arrives and is paired with it. Orders are grouped in
+# stake levels kept in a sorted list, so the closest compatible stake is a
+# bisect away, and the results of each chat go out as one summary message
+# per interval.
+import asyncio
+import bisect
+import collections
+import logging
+import traceback
+
+logger = logging.getLogger(__name__)
+
+# Summary events
+MATCHED = 'matched'     # (MATCHED, winner_id, loser_id, stake)
+QUEUED = 'queued'       # (QUEUED, owner, stake)
+EXPIRED = 'expired'     # (EXPIRED, owner, stake)
+
+
+def stake_band(bet, tolerance):
+    """(low, high) stakes a duel of bet accepts; tolerance is a fraction of bet"""
+    spread = int(bet * tolerance)
+    return bet - spread, bet + spread
+
+
+class OrderBook:
+    """Open duel orders of one chat, by stake then arrival.
+
+    Each stake level is an insertion-ordered dict challenge_id -> owner, so
+    the oldest order at a stake is paired first and a claimed or expired
+    order leaves its level in O(1).
+    """
+
+    def __init__(self):
+        self._stakes = []     # sorted stakes with at least one order
+        self._levels = {}     # stake -> {challenge_id: owner}
+        self._orders = {}     # challenge_id -> stake
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, challenge_id):
+        return challenge_id in self._orders
+
+    def stakes(self):
+        """(lowest, highest) open stake, None if the book is empty"""
+        return (self._stakes[0], self._stakes[-1]) if self._stakes else None
+
+    def owner(self, challenge_id):
+        return self._levels[self._orders[challenge_id]][challenge_id]
+
+    def add(self, challenge_id, owner, stake):
+        level = self._levels.get(stake)
+        if level is None:
+            level = self._levels[stake] = {}
+            bisect.insort(self._stakes, stake)
+        level[challenge_id] = str(owner)
+        self._orders[challenge_id] = stake
+
+    def remove(self, challenge_id):
+        """Take an order out of the book; False if it was not in it"""
+        stake = self._orders.pop(challenge_id, None)
+        if stake is None:
+            return False
+        level = self._levels[stake]
+        del level[challenge_id]
+        if not level:
+            del self._levels[stake]
+            del self._stakes[bisect.bisect_left(self._stakes, stake)]
+        return True
+
+    def match(self, owner, low, high, target):
+        """(challenge_id, stake) of the oldest order of another user at the
+        stake in [low, high] closest to target (the lower one on a tie), or
+        None. The order stays in the book until the duel claims it.
+
+        A user holds at most a few orders, so skipping their own ones keeps
+        this at a bisect plus a handful of steps.
+        """
+        owner = str(owner)
+        stakes = self._stakes
+        first = bisect.bisect_left(stakes, low)
+        end = bisect.bisect_right(stakes, high, first)
+        right = bisect.bisect_left(stakes, target, first, end)
+        left = right - 1
+        while left >= first or right < end:
+            if right >= end or (left >= first and target - stakes[left] <= stakes[right] - target):
+                stake = stakes[left]
+                left -= 1
+            else:
+                stake = stakes[right]
+                right += 1
+            for challenge_id, order_owner in self._levels[stake].items():
+                if order_owner != owner:
+                    return challenge_id, stake
+        return None
+
+
+class Matchmaker:
+    """Order book of every chat plus the events of the next summaries.
+
+    Every interval, `await callback(chat_id, events, book)` runs for each
+    chat that had events since the last summary; events are the tuples
+    above, in the order they happened.
+    """
+
+    def __init__(self, interval=30.0, callback=None):
+        self.interval = interval
+        self.callback = callback
+        self.matched = 0
+        self.summaries = 0
+        self._books = collections.defaultdict(OrderBook)   # chat_id -> book
+        self._events = collections.defaultdict(list)       # chat_id -> events
+        self._task = None
+
+    def __len__(self):
+        return sum(len(book) for book in self._books.values())
+
+    def book(self, chat_id):
+        """The chat's order book; an empty one is not kept"""
+        return self._books.get(str(chat_id)) or OrderBook()
+
+    def add(self, chat_id, challenge_id, owner, stake):
+        self._books[str(chat_id)].add(challenge_id, owner, stake)
+
+    def remove(self, chat_id, challenge_id):
+        """Drop a claimed order; False if it was not in the chat's book"""
+        book = self._books.get(str(chat_id))
+        if book is None or not book.remove(challenge_id):
+            return False
+        if not book:
+            del self._books[str(chat_id)]
+        return True
+
+    def report(self, chat_id, *event):
+        if event[0] == MATCHED:
+            self.matched += 1
+        self._events[str(chat_id)].append(event)
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        events, self._events = self._events, collections.defaultdict(list)
+        await asyncio.gather(*(self._summarize(chat_id, chat_events) for chat_id, chat_events in events.items()))
+
+    async def _summarize(self, chat_id, events):
+        try:
+            await self.callback(chat_id, events, self.book(chat_id))
+            self.summaries += 1
+        except Exception:
+            logger.error(f"Errore nel riepilogo dei duelli della chat {chat_id}:\n" + traceback.format_exc())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        dropped = sum(len(events) for events in self._events.values())
+        if dropped:
+            logger.info(f"{dropped} eventi di matchmaking non riepilogati alla chiusura")
@@ -0,0 +1,82 @@
+# Zucchini Telegram Bot - Display name cache
+# Names are learned passively from every incoming update; only misses hit
+# get_chat_member, concurrently and under a deadline.
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class NameCache:
+    """LRU cache of display names keyed by user id, with a freshness TTL"""
+
+    def __init__(self, format_name, max_size=10000, ttl=3600):
+        self.format_name = format_name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # user_id -> (name, fetched_at)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, user_id, name):
+        user_id = str(user_id)
+        self._entries[user_id] = (name, time.monotonic())
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def remember(self, user):
+        """Store the name of a telegram User object"""
+        if user is not None:
+            self.put(user.id, self.format_name(user))
+
+    def get(self, user_id, allow_stale=False):
+        """Cached name, or None if missing (or expired unless allow_stale)"""
+        entry = self._entries.get(str(user_id))
+        if entry is None:
+            return None
+        name, fetched_at = entry
+        if not allow_stale and time.monotonic() - fetched_at > self.ttl:
+            return None
+        self._entries.move_to_end(str(user_id))
+        return name
+
+    async def resolve_many(self, bot, chat_id, user_ids, concurrency=5, deadline=2.0):
+        """Return {user_id: name}, fetching misses in parallel until the deadline"""
+        names = {}
+        missing = []
+        for user_id in dict.fromkeys(str(uid) for uid in user_ids):
+            name = self.get(user_id)
+            if name is None:
+                missing.append(user_id)
+            else:
+                names[user_id] = name
+        self.hits += len(names)
+        self.misses += len(missing)
+
+        if missing:
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def fetch(user_id):
+                async with semaphore:
+                    member = await bot.get_chat_member(chat_id, int(user_id))
+                self.remember(member.user)
+
+            tasks = [asyncio.ensure_future(fetch(uid)) for uid in missing]
+            done, pending = await asyncio.wait(tasks, timeout=deadline)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if task.exception() is not None:
+                    logger.debug(f"get_chat_member fallito: {task.exception()}")
+            if pending:
+                logger.info(f"Risoluzione nomi: {len(pending)} richieste oltre la scadenza")
+
+        for user_id in missing:
+            names[user_id] = self.get(user_id, allow_stale=True) or f"User {user_id}"
+        return names
@@ -0,0 +1,322 @@
+# Zucchini Telegram Bot - Outbound message queue
+# Every Bot API call passes through one rate limiter: per-chat and global
+# token buckets keep the bot under Telegram's flood limits, 429s are
+# retried after retry_after, edits to the same message are merged while
+# they wait, and interactive replies jump ahead of broadcasts.
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+# Slowest rate a gate is given, in calls per second
+MIN_RATE = 0.1
+
+# Lower runs first; pass BROADCAST as rate_limit_args for bulk announcements
+INTERACTIVE = 0
+REPLY = 1
+BROADCAST = 2
+INTERACTIVE_ENDPOINTS = {'answerCallbackQuery', 'editMessageText', 'editMessageReplyMarkup'}
+EDIT_ENDPOINTS = {'editMessageText', 'editMessageReplyMarkup'}
+
+
+def split_text(text, limit=MAX_MESSAGE_LENGTH):
+    """Chunks of at most limit characters, cut at line breaks where possible"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    chunks.append(text)
+    return chunks
+
+
+class PriorityGate:
+    """Token bucket whose waiters are served by priority, then arrival order.
+
+    A serial gate admits one caller at a time: the next token only starts
+    refilling once the holder calls mark_sent(), so sends stay spaced even
+    when the holder waited somewhere else after acquiring. The last
+    `reserve` tokens only go to INTERACTIVE callers.
+    """
+
+    def __init__(self, rate, burst, serial=False, reserve=0):
+        self.rate = rate
+        self.burst = burst
+        self.serial = serial
+        self.reserve = reserve
+        self.tokens = burst
+        self.paused_until = 0.0
+        self._held = False
+        self._updated = time.monotonic()
+        self._waiters = []   # (priority, seq, future)
+        self._seq = itertools.count()
+        self._timer = None
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self, now):
+        self.tokens -= 1
+
+    def _wait_time(self, now, need):
+        """Seconds until need tokens are available"""
+        return (need - self.tokens) / self.rate
+
+    def _need(self, priority):
+        return 1 + (self.reserve if priority > INTERACTIVE else 0)
+
+    def idle(self):
+        self._refill(time.monotonic())
+        return not self._waiters and self.tokens >= self.burst
+
+    async def acquire(self, priority):
+        now = time.monotonic()
+        self._refill(now)
+        if not self._waiters and not self._held and now >= self.paused_until and self.tokens >= self._need(priority):
+            self._take(now)
+            self._held = self.serial
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._timer is not None and self._waiters[0][2] is future:
+            # The timer was set for a waiter that may need more tokens
+            self._timer.cancel()
+            self._timer = None
+        self._schedule()
+        await future
+
+    def mark_sent(self):
+        """Release a serial gate, refilling its next token from now"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 0)
+        self._held = False
+        self._schedule()
+
+    def pause(self, seconds):
+        """Hold every waiter for seconds, e.g. after a 429"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._schedule()
+
+    def _schedule(self):
+        if self._timer is not None or not self._waiters or self._held:
+            return
+        now = time.monotonic()
+        self._refill(now)
+        wait = self._wait_time(now, self._need(self._waiters[0][0]))
+        if wait is None:
+            return
+        delay = max(self.paused_until - now, wait, 0)
+        self._timer = asyncio.get_running_loop().call_later(delay, self._release)
+
+    def _release(self):
+        self._timer = None
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters and now >= self.paused_until and not self._held:
+            priority, _, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)   # waiter was cancelled
+                continue
+            if self.tokens < self._need(priority):
+                break
+            heapq.heappop(self._waiters)
+            self._take(now)
+            self._held = self.serial
+            future.set_result(None)
+        self._schedule()
+
+
+class WindowGate(PriorityGate):
+    """PriorityGate that admits at most limit sends in any window seconds.
+
+    Telegram counts a group's messages per minute, so a quiet group can take
+    a burst right away instead of one message every few seconds. Callers
+    are not serialized: a send counts from its grant as pending, and from
+    mark_sent() on as sent at that moment, so a grant that waited at the
+    global gate never lets the window hold more than limit real sends.
+    """
+
+    def __init__(self, limit, window, reserve=0):
+        super().__init__(limit / window, limit, reserve=reserve)
+        self.window = window
+        self._sent = collections.deque()   # monotonic send times in the window
+        self._pending = 0                  # granted, not sent yet
+
+    def _refill(self, now):
+        while self._sent and self._sent[0] <= now - self.window:
+            self._sent.popleft()
+        self.tokens = self.burst - len(self._sent) - self._pending
+        self._updated = now
+
+    def _take(self, now):
+        self._pending += 1
+        self.tokens -= 1
+
+    def _wait_time(self, now, need):
+        # Until enough of the oldest sends have left the window; sends still
+        # pending free nothing until mark_sent() reschedules
+        missing = need - self.tokens
+        if missing <= 0:
+            return 0
+        if missing > len(self._sent):
+            return None
+        return self._sent[missing - 1] + self.window - now
+
+    def mark_sent(self):
+        self._pending -= 1
+        self._sent.append(time.monotonic())
+        self._schedule()
+
+
+class _Edit:
+    """An edit still waiting for its turn; later edits overwrite its data"""
+
+    def __init__(self, data):
+        self.data = data
+        self.sent = False
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class OutboundQueue(BaseRateLimiter):
+    """python-telegram-bot rate limiter shaping all outgoing requests.
+
+    Requests to one chat share a bucket (per second for private chats, per
+    minute for groups), and all requests share a global bucket. The
+    per-second buckets hold a single token so no one-second window ever
+    sees more than Telegram's limit; a group admits up to its per-minute
+    limit in any minute, and keeps interactive_reserve of those sends for
+    button-press edits. A 429 pauses the chat (or everything, for
+    chat-less calls) for retry_after and retries up to max_retries times.
+    sendMessage texts over 4096 characters go out as several messages.
+    """
+
+    def __init__(self, global_per_second=30, chat_per_second=1, group_per_minute=20, max_retries=3,
+                 interactive_reserve=3):
+        # A margin under each limit, but never a rate of zero or less: with
+        # many workers sharing the token each one's share can be tiny
+        self.global_gate = PriorityGate(max(global_per_second * 0.95, MIN_RATE), 1)
+        self.chat_limits = (max(chat_per_second * 0.95, MIN_RATE), 1)
+        self.group_limit = max(1, int(group_per_minute) - 1)
+        self.interactive_reserve = min(interactive_reserve, self.group_limit - 1)
+        self.max_retries = max_retries
+        self.sent = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.split = 0
+        self._chats = {}
+        self._edits = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_gate(self, chat_id):
+        gate = self._chats.get(chat_id)
+        if gate is None:
+            if len(self._chats) > 10_000:
+                self._chats = {key: g for key, g in self._chats.items() if not g.idle()}
+            if str(chat_id).startswith('-'):
+                gate = WindowGate(self.group_limit, 60, reserve=self.interactive_reserve)
+            else:
+                gate = PriorityGate(*self.chat_limits, serial=True)
+            self._chats[chat_id] = gate
+        return gate
+
+    async def _send(self, callback, endpoint, data, kwargs, priority, edit=None):
+        chat_id = data.get('chat_id')
+        chat_gate = self._chat_gate(chat_id) if chat_id is not None else None
+        for attempt in range(self.max_retries + 1):
+            if chat_gate is not None:
+                await chat_gate.acquire(priority)
+            try:
+                await self.global_gate.acquire(priority)
+            finally:
+                if chat_gate is not None:
+                    # The global wait may have been long: space this chat's sends from now
+                    chat_gate.mark_sent()
+            if edit is not None:
+                # Tokens taken: edits arriving from now on queue behind this one
+                edit.sent = True
+                data = edit.data
+            try:
+                result = await callback(endpoint, data, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retried += 1
+                delay = e.retry_after
+                if hasattr(delay, 'total_seconds'):
+                    delay = delay.total_seconds()
+                logger.warning(f"{endpoint} limitato da Telegram, riprovo tra {delay}s")
+                (chat_gate or self.global_gate).pause(delay)
+
+    async def _send_edit(self, callback, endpoint, data, kwargs, priority):
+        key = (endpoint, data.get('chat_id'), data.get('message_id'), data.get('inline_message_id'))
+        pending = self._edits.get(key)
+        if pending is not None and not pending.sent:
+            # Still queued: the newest text wins, both callers get its result
+            pending.data = data
+            self.coalesced += 1
+            return await asyncio.shield(pending.future)
+
+        edit = self._edits[key] = _Edit(data)
+        try:
+            result = await self._send(callback, endpoint, data, kwargs, priority, edit)
+            edit.future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            edit.future.cancel()
+            raise
+        except Exception as e:
+            edit.future.set_exception(e)
+            # Mark it retrieved: usually nobody else is waiting on it
+            edit.future.exception()
+            raise
+        finally:
+            if self._edits.get(key) is edit:
+                del self._edits[key]
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else (
+            INTERACTIVE if endpoint in INTERACTIVE_ENDPOINTS else REPLY
+        )
+        if endpoint in EDIT_ENDPOINTS:
+            text = data.get('text')
+            if isinstance(text, str) and len(text) > MAX_MESSAGE_LENGTH:
+                data = {**data, 'text': text[:MAX_MESSAGE_LENGTH - 1] + '…'}
+            return await self._send_edit(callback, endpoint, data, kwargs, priority)
+
+        text = data.get('text')
+        if endpoint == 'sendMessage' and isinstance(text, str) and len(text) > MAX_MESSAGE_LENGTH:
+            chunks = split_text(text)
+            self.split += 1
+            result = None
+            for i, chunk in enumerate(chunks):
+                part = {**data, 'text': chunk}
+                if i:
+                    part.pop('reply_to_message_id', None)
+                    part.pop('reply_parameters', None)
+                if i < len(chunks) - 1:
+                    part.pop('reply_markup', None)
+                result = await self._send(callback, endpoint, part, kwargs, priority)
+            return result
+        return await self._send(callback, endpoint, data, kwargs, priority)
@@ -0,0 +1,121 @@
+# Zucchini Telegram Bot - Write-behind persistence
+# Handlers only mark the state dirty; a single background task coalesces
+# the marks and writes from a worker thread so the event loop never blocks
+# on disk I/O. With a journal it also writes the chat shards, each time
+# after the journal record that covers their changes, so a shard file is
+# never ahead of the journal and a crash cannot split a stake from its debit.
+import asyncio
+import logging
+import traceback
+
+from journal import dump_data, write_snapshot
+from metrics import BYTE_BUCKETS, metrics
+
+logger = logging.getLogger(__name__)
+
+SAVE_SECONDS = metrics.histogram('zucchini_save_seconds', "Duration of state writes", ('kind',))
+SAVE_BYTES = metrics.histogram('zucchini_save_bytes', "Bytes per state write", ('kind',), BYTE_BUCKETS)
+
+
+class WriteBehindPersister:
+    """Coalesces save requests within a window and writes them off the event loop"""
+
+    def __init__(self, data, path, journal=None, window=0.2, idle_timeout=30, dump=dump_data,
+                 on_snapshot=None, shards=None):
+        self.data = data
+        self.path = path
+        self.dump = dump
+        # Called on the loop once a new snapshot file is in place
+        self.on_snapshot = on_snapshot
+        self.journal = journal
+        # Chat shards (shards.ShardStore) whose changes go through the journal
+        self.shards = shards
+        self.window = window
+        self.idle_timeout = idle_timeout
+        self.writes = 0
+        self._dirty = False
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def mark_dirty(self):
+        self._dirty = True
+        self._wake.set()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.idle_timeout)
+                # Let the marks of a burst of updates pile up into one write
+                await asyncio.sleep(self.window)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.error("Errore nel salvataggio dei dati:\n" + traceback.format_exc())
+        await self.flush()
+
+    async def flush(self):
+        """Write the current state if dirty, compacting the journal when due"""
+        async with self._flush_lock:
+            if self._dirty:
+                self._dirty = False
+                # Serialize on the loop so the write sees a consistent state
+                if self.journal is not None:
+                    line = self.journal.seal()
+                    shard_files = self._collect_shards()
+                    if line:
+                        with SAVE_SECONDS.time('journal'):
+                            await asyncio.to_thread(self.journal.write, line)
+                        SAVE_BYTES.observe(len(line), 'journal')
+                    await self._write_shards(shard_files)
+                else:
+                    with SAVE_SECONDS.time('snapshot'):
+                        snapshot = self.dump(self.data)
+                        size = await asyncio.to_thread(write_snapshot, self.path, snapshot, True)
+                    SAVE_BYTES.observe(size, 'snapshot')
+                    self._snapshot_written()
+                self.writes += 1
+
+            if self.journal is not None and self.journal.should_compact():
+                with SAVE_SECONDS.time('compaction'):
+                    snapshot = self.journal.prepare_compaction(self.data)
+                    # The folded records may hold chat changes: their shards
+                    # go to disk before the segment with them is dropped
+                    await self._write_shards(self._collect_shards())
+                    size = await asyncio.to_thread(self.journal.finish_compaction, snapshot)
+                SAVE_BYTES.observe(size, 'compaction')
+                logger.info(f"Journal compattato (seq={self.journal.seq})")
+                self._snapshot_written()
+
+            if self.shards is not None:
+                self.shards.evict_idle()
+
+    def _collect_shards(self):
+        return self.shards.collect() if self.shards is not None else []
+
+    async def _write_shards(self, shard_files):
+        if shard_files:
+            await self.shards.write(shard_files)
+
+    def _snapshot_written(self):
+        if self.on_snapshot is not None:
+            self.on_snapshot()
+
+    async def stop(self):
+        """Flush everything still pending and stop the background task"""
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+        else:
+            await self.flush()
+        if self.journal is not None:
+            self.journal.close()
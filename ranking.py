@@ -0,0 +1,157 @@
+# Zucchini Telegram Bot - Leaderboard rank index
+# Order-statistics index over user lengths: a bucketed sorted list plus a
+# Fenwick tree over bucket sizes, so rank and top-N never sort all users.
+from bisect import bisect_left, insort
+
+
+class RankIndex:
+    """Users ordered by length (longest first) with O(log n) rank queries"""
+
+    LOAD = 512  # target bucket size, buckets split at twice this
+
+    def __init__(self):
+        self._buckets = []
+        self._maxes = []
+        self._tree = []
+        self._keys = {}
+
+    @classmethod
+    def build(cls, users):
+        """Build the index from a {user_id: User} mapping"""
+        return cls.from_lengths((uid, u.length) for uid, u in users.items())
+
+    @classmethod
+    def from_lengths(cls, lengths):
+        """Build the index from (user_id, length) pairs, fastest when already ranked"""
+        index = cls()
+        keys = sorted((-length, uid) for uid, length in lengths)
+        index._keys = {key[1]: key for key in keys}
+        index._buckets = [keys[i:i + cls.LOAD] for i in range(0, len(keys), cls.LOAD)]
+        index._maxes = [b[-1] for b in index._buckets]
+        index._rebuild_tree()
+        return index
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, user_id):
+        return str(user_id) in self._keys
+
+    # --- Fenwick tree over bucket sizes ---
+    def _rebuild_tree(self):
+        tree = [len(b) for b in self._buckets]
+        for i in range(len(tree)):
+            parent = i | (i + 1)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_add(self, i, delta):
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i |= i + 1
+
+    def _tree_prefix(self, i):
+        """Number of entries in buckets [0, i)"""
+        total = 0
+        while i > 0:
+            total += self._tree[i - 1]
+            i &= i - 1
+        return total
+
+    def _tree_find(self, pos):
+        """Return (bucket, offset) of the entry at position pos"""
+        bucket = 0
+        bit = 1 << len(self._tree).bit_length()
+        while bit:
+            nxt = bucket + bit
+            if nxt <= len(self._tree) and self._tree[nxt - 1] <= pos:
+                bucket = nxt
+                pos -= self._tree[nxt - 1]
+            bit >>= 1
+        return bucket, pos
+
+    # --- Updates ---
+    def update(self, user_id, length):
+        """Insert a user or move it to its new length"""
+        user_id = str(user_id)
+        key = (-length, user_id)
+        old = self._keys.get(user_id)
+        if old == key:
+            return
+        if old is not None:
+            self._discard(old)
+        self._keys[user_id] = key
+        self._insert(key)
+
+    def remove(self, user_id):
+        key = self._keys.pop(str(user_id), None)
+        if key is not None:
+            self._discard(key)
+
+    def _insert(self, key):
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._rebuild_tree()
+            return
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+            self._buckets[i].append(key)
+            self._maxes[i] = key
+        else:
+            insort(self._buckets[i], key)
+        self._tree_add(i, 1)
+
+        bucket = self._buckets[i]
+        if len(bucket) > 2 * self.LOAD:
+            self._buckets[i:i + 1] = [bucket[:self.LOAD], bucket[self.LOAD:]]
+            self._maxes[i:i + 1] = [bucket[self.LOAD - 1], bucket[-1]]
+            self._rebuild_tree()
+
+    def _discard(self, key):
+        i = bisect_left(self._maxes, key)
+        bucket = self._buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        if bucket:
+            self._maxes[i] = bucket[-1]
+            self._tree_add(i, -1)
+        else:
+            del self._buckets[i]
+            del self._maxes[i]
+            self._rebuild_tree()
+
+    # --- Queries ---
+    def rank(self, user_id):
+        """1-based position of a user, or None if unknown"""
+        key = self._keys.get(str(user_id))
+        if key is None:
+            return None
+        i = bisect_left(self._maxes, key)
+        return self._tree_prefix(i) + bisect_left(self._buckets[i], key) + 1
+
+    def range(self, start, stop):
+        """[(user_id, length)] for 0-based positions start..stop-1"""
+        stop = min(stop, len(self._keys))
+        if start >= stop:
+            return []
+        result = []
+        bucket, offset = self._tree_find(start)
+        while len(result) < stop - start:
+            for neg_length, uid in self._buckets[bucket][offset:offset + stop - start - len(result)]:
+                result.append((uid, -neg_length))
+            bucket, offset = bucket + 1, 0
+        return result
+
+    def top(self, n):
+        return self.range(0, n)
+
+    def around(self, user_id, radius=1):
+        """Entries within radius positions of a user as [(rank, user_id, length)]"""
+        rank = self.rank(user_id)
+        if rank is None:
+            return []
+        start = max(0, rank - 1 - radius)
+        return [(start + i + 1, uid, length)
+                for i, (uid, length) in enumerate(self.range(start, rank + radius))]
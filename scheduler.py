@@ -0,0 +1,119 @@
+# Zucchini Telegram Bot - Deadline scheduler
+# One timer heap for every pending deadline: the task sleeps exactly until
+# the earliest one and stays idle when nothing is armed. Each fired key runs
+# in its own task, so a callback stuck behind one chat's rate limit does not
+# hold back every other deadline.
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineScheduler:
+    """Calls `await callback(key)` once the wall-clock deadline of key passes.
+
+    Callbacks of different keys run concurrently; a key that fires again
+    while its previous callback still runs waits for it.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.fired = 0
+        self._heap = []         # (deadline, seq, key); stale entries are skipped
+        self._deadlines = {}    # key -> currently armed deadline
+        self._seq = itertools.count()
+        self._running = {}      # key -> task of its latest callback
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def deadline(self, key):
+        return self._deadlines.get(key)
+
+    def arm(self, key, deadline):
+        """(Re)schedule key; a past deadline fires right away"""
+        if self._deadlines.get(key) == deadline:
+            return
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._seq), key))
+        self._wake.set()
+
+    def disarm(self, key):
+        self._deadlines.pop(key, None)
+
+    def pop_due(self, now):
+        """Disarm and return every key due by now, for callers driving their own clock"""
+        due = []
+        self._pop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            due.append(key)
+            self._pop_stale()
+        return due
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        """Stop the timer and cancel the callbacks still running"""
+        tasks = list(self._running.values())
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            # wait() rather than await: only the tasks' own cancellation is
+            # expected here, one aimed at our caller must still reach it
+            await asyncio.wait(tasks)
+
+    def _pop_stale(self):
+        while self._heap:
+            deadline, _, key = self._heap[0]
+            if self._deadlines.get(key) == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            self._pop_stale()
+            if not self._heap:
+                await self._wake.wait()
+                continue
+
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                # An earlier deadline armed meanwhile wakes us up to recompute
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            self.fired += 1
+            task = asyncio.create_task(self._fire(key, self._running.get(key)))
+            self._running[key] = task
+            task.add_done_callback(functools.partial(self._finished, key))
+
+    async def _fire(self, key, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.callback(key)
+        except Exception:
+            logger.error(f"Errore nella scadenza {key}:\n" + traceback.format_exc())
+
+    def _finished(self, key, task):
+        if self._running.get(key) is task:
+            del self._running[key]
@@ -0,0 +1,129 @@
+# Zucchini Telegram Bot - Lottery settlement
+# A round is settled on column arrays (user ids, numbers, amounts): the
+# winners split the whole pot by largest remainder, so the integer payouts
+# always add up to it exactly. NumPy is used when installed; the pure
+# Python path produces the same payouts.
+import heapq
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# pot * amount must fit in int64 for the vectorized division
+_INT64_LIMIT = 2 ** 63 - 1
+
+
+def bet_columns(bets):
+    """(user_ids, numbers, amounts) of a {user_id: {'number', 'amount'}} round"""
+    user_ids = list(bets)
+    numbers = [b['number'] for b in bets.values()]
+    amounts = [b['amount'] for b in bets.values()]
+    if np is not None:
+        return user_ids, np.array(numbers, dtype=np.int64), np.array(amounts, dtype=np.int64)
+    return user_ids, numbers, amounts
+
+
+def largest_remainder(pot, weights):
+    """Integer shares of pot proportional to weights that sum to pot exactly.
+
+    Every share is floored, then the leftover units go one each to the
+    largest remainders; on equal remainders the earlier entry wins.
+    """
+    if np is not None and isinstance(weights, np.ndarray):
+        total = int(weights.sum())
+        if not len(weights) or not total:
+            return np.zeros(len(weights), dtype=np.int64)
+        if pot * int(weights.max()) <= _INT64_LIMIT:
+            shares, remainders = np.divmod(weights * pot, total)
+            leftover = pot - int(shares.sum())
+            if leftover:
+                shares[np.argsort(-remainders, kind='stable')[:leftover]] += 1
+            return shares
+        weights = weights.tolist()
+
+    total = sum(weights)
+    if not total:
+        return [0] * len(weights)
+    shares, remainders = [], []
+    for weight in weights:
+        share, remainder = divmod(pot * weight, total)
+        shares.append(share)
+        remainders.append(remainder)
+    leftover = pot - sum(shares)
+    for i in heapq.nlargest(leftover, range(len(weights)), key=remainders.__getitem__):
+        shares[i] += 1
+    return shares
+
+
+class Settlement:
+    """Outcome of a round: credit batches for Storage.settle_lottery plus
+    what the announcement needs"""
+
+    def __init__(self, winning_number, pot, bettors):
+        self.winning_number = winning_number
+        self.pot = pot
+        self.bettors = bettors
+        self.winners = 0
+        self.lost = 0
+        self.refunded = False
+        self.top = []       # [(user_id, share)], biggest first
+        self.credits = []   # [(user_ids, {field: amounts})]
+        self.stakes = []    # each winner's own bet, in credits order
+
+
+def settle(user_ids, numbers, amounts, winning_number, top=10):
+    """Settle one round given its bet columns (from bet_columns())"""
+    if np is not None and isinstance(amounts, np.ndarray):
+        return _settle_vectorized(user_ids, numbers, amounts, winning_number, top)
+
+    pot = sum(amounts)
+    result = Settlement(winning_number, pot, len(user_ids))
+    won = [i for i, number in enumerate(numbers) if number == winning_number]
+    if not won:
+        result.refunded = True
+        result.credits = [(list(user_ids), {'length': list(amounts)})]
+        return result
+
+    won_set = set(won)
+    lost = [i for i in range(len(user_ids)) if i not in won_set]
+    shares = largest_remainder(pot, [amounts[i] for i in won])
+    winner_ids = [user_ids[i] for i in won]
+    result.winners = len(won)
+    result.lost = sum(amounts[i] for i in lost)
+    result.stakes = [amounts[i] for i in won]
+    result.top = [(winner_ids[i], shares[i])
+                  for i in heapq.nlargest(top, range(len(won)), key=shares.__getitem__)]
+    result.credits = [
+        (winner_ids, {'length': shares, 'stats.length_won': shares}),
+        ([user_ids[i] for i in lost], {'stats.length_lost': [amounts[i] for i in lost]}),
+    ]
+    return result
+
+
+def _settle_vectorized(user_ids, numbers, amounts, winning_number, top):
+    pot = int(amounts.sum())
+    if len(amounts) and pot * int(amounts.max()) > _INT64_LIMIT:
+        return settle(user_ids, numbers.tolist(), amounts.tolist(), winning_number, top)
+    result = Settlement(winning_number, pot, len(user_ids))
+    won = numbers == winning_number
+    if not won.any():
+        result.refunded = True
+        result.credits = [(list(user_ids), {'length': amounts.tolist()})]
+        return result
+
+    won_index = np.flatnonzero(won)
+    lost_index = np.flatnonzero(~won)
+    shares = largest_remainder(pot, amounts[won_index])
+    winner_ids = [user_ids[i] for i in won_index.tolist()]
+    result.winners = len(won_index)
+    result.lost = int(amounts[lost_index].sum())
+    result.stakes = amounts[won_index].tolist()
+    best = np.argsort(-shares, kind='stable')[:top].tolist()
+    result.top = [(winner_ids[i], int(shares[i])) for i in best]
+    shares = shares.tolist()
+    result.credits = [
+        (winner_ids, {'length': shares, 'stats.length_won': shares}),
+        ([user_ids[i] for i in lost_index.tolist()], {'stats.length_lost': amounts[lost_index].tolist()}),
+    ]
+    return result
@@ -0,0 +1,187 @@
+# Zucchini Telegram Bot - Per-chat game state
+# Lottery rounds and pending duels live in one small JSON file per chat,
+# loaded on first use and dropped from memory once idle, so a busy group
+# never rewrites (or waits on) another group's state. With a journal, chat
+# changes are journaled as ops on ['chats', chat_id, ...] paths, in the same
+# record as the balance changes they go with, and the persister writes the
+# shard files only after that record (see persistence.py).
+import asyncio
+import json
+import logging
+import os
+import time
+import traceback
+
+from journal import apply_op, dump_data, write_snapshot
+from persistence import SAVE_BYTES, SAVE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def new_shard():
+    return {
+        'duels': {},
+        'lottery': {
+            'bets': {},
+            'history': [],
+            # 0 = no round running: the first bet starts one
+            'end_time': 0
+        }
+    }
+
+
+class ChatShard:
+    """Game state of one chat plus its derived per-number bet totals"""
+
+    def __init__(self, chat_id, data):
+        self.chat_id = chat_id
+        self.data = data
+        self.dirty = False
+        self.last_used = time.monotonic()
+        self.count_bets()
+
+    def count_bets(self):
+        self.bet_totals = {}
+        for b in self.data['lottery']['bets'].values():
+            total, count = self.bet_totals.get(b['number'], (0, 0))
+            self.bet_totals[b['number']] = (total + b['amount'], count + 1)
+
+
+class ShardStore:
+    """Lazily loaded chat shards, each written to its own file when dirty"""
+
+    def __init__(self, directory, window=0.2, idle_timeout=600):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.window = window
+        self.idle_timeout = idle_timeout
+        self.loads = 0
+        self.evictions = 0
+        self.writes = 0
+        self._shards = {}
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._shards)
+
+    def path(self, chat_id):
+        return os.path.join(self.directory, f"{chat_id}.json")
+
+    def get(self, chat_id):
+        """Shard of a chat, read from disk on first use"""
+        chat_id = str(chat_id)
+        shard = self._shards.get(chat_id)
+        if shard is None:
+            shard = self._shards[chat_id] = ChatShard(chat_id, self._load(chat_id))
+            self.loads += 1
+        shard.last_used = time.monotonic()
+        return shard
+
+    def _load(self, chat_id):
+        path = self.path(chat_id)
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return new_shard()
+        except json.JSONDecodeError as e:
+            logger.error(f"Error loading shard {path}: {e}")
+            raise RuntimeError(f"{path} is corrupted, refusing to load chat {chat_id}") from e
+
+    def mark_dirty(self, shard):
+        shard.dirty = True
+        self._wake.set()
+
+    def apply(self, op):
+        """Apply a journal op on a ['chats', chat_id, ...] path to its shard"""
+        path = op[1]
+        shard = self.get(path[1])
+        apply_op(shard.data, [op[0], path[2:]] + op[2:])
+        self.mark_dirty(shard)
+        return shard
+
+    def replay(self, journal, data):
+        """Replay journal into data, sending its chat ops to their shards.
+
+        Shard files are never written ahead of the journal, so replaying the
+        set/del ops again over a file that already has some of them is
+        harmless. Returns the shards that changed.
+        """
+        replayed = {}
+
+        def route(op):
+            if op[1][0] != 'chats':
+                return False
+            shard = self.apply(op)
+            replayed[shard.chat_id] = shard
+            return True
+
+        journal.replay(data, route)
+        for shard in replayed.values():
+            shard.count_bets()
+        return list(replayed.values())
+
+    def write_now(self, shard):
+        """Synchronous write, for startup migrations before the loop runs"""
+        write_snapshot(self.path(shard.chat_id), dump_data(shard.data), True)
+        shard.dirty = False
+
+    # --- Background persistence ---
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.idle_timeout)
+                await asyncio.sleep(self.window)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+                self.evict_idle()
+            except Exception:
+                logger.error("Errore nel salvataggio delle chat:\n" + traceback.format_exc())
+        await self.flush()
+
+    async def flush(self):
+        """Write every dirty shard, each to its own file"""
+        await self.write(self.collect())
+
+    def collect(self):
+        """Serialize every dirty shard for write(); runs on the loop so each
+        file sees a consistent shard"""
+        pending = []
+        for shard in self._shards.values():
+            if shard.dirty:
+                shard.dirty = False
+                pending.append((self.path(shard.chat_id), dump_data(shard.data)))
+        return pending
+
+    async def write(self, pending):
+        for path, text in pending:
+            with SAVE_SECONDS.time('shard'):
+                await asyncio.to_thread(write_snapshot, path, text, True)
+            SAVE_BYTES.observe(len(text), 'shard')
+        self.writes += len(pending)
+
+    def evict_idle(self):
+        """Drop clean shards unused for idle_timeout seconds"""
+        cutoff = time.monotonic() - self.idle_timeout
+        idle = [chat_id for chat_id, shard in self._shards.items()
+                if not shard.dirty and shard.last_used < cutoff]
+        for chat_id in idle:
+            del self._shards[chat_id]
+        self.evictions += len(idle)
+
+    async def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+        else:
+            await self.flush()
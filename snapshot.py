@@ -0,0 +1,416 @@
+# Zucchini Telegram Bot - Binary snapshot
+# Users are stored as fixed-size records behind a sorted index of ids, so a
+# restart maps the file and decodes a user only when it is first touched.
+# Decoded users can be capped: the least recently used ones are evicted,
+# written to a cold file first if they changed, and read back on demand.
+# The rest of the state (rounds, challenges, journal_seq) is a small JSON
+# block; zucchini_data.json stays the import/export format.
+#
+# Layout: header | ids (int64, ascending) | records | rank order | meta JSON
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+from collections import OrderedDict
+
+from users import STAT_FIELDS, User
+
+MAGIC = b'ZUCS'
+VERSION = 1
+# magic, version, record size, user count, then offsets of ids, records,
+# rank order and meta, and the meta length
+HEADER = struct.Struct('<4sHHQQQQQQ')
+RECORD = struct.Struct('<qdd' + 'q' * len(STAT_FIELDS))
+LENGTH = struct.Struct('<q')
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def _int_id(user_id):
+    """The int64 key of a user id, None if it cannot live in the index"""
+    try:
+        key = int(user_id)
+    except ValueError:
+        return None
+    if str(key) != user_id or not INT64_MIN <= key <= INT64_MAX:
+        return None
+    return key
+
+
+def _pack(user):
+    return RECORD.pack(user.length, user.last_daily, user.last_hourly,
+                       *(getattr(user, field) for field in STAT_FIELDS))
+
+
+def _unpack(buffer, offset):
+    length, last_daily, last_hourly, *stats = RECORD.unpack_from(buffer, offset)
+    user = User.__new__(User)
+    user.length = length
+    # Whole-second cooldowns come back as the ints they were
+    user.last_daily = int(last_daily) if last_daily.is_integer() else last_daily
+    user.last_hourly = int(last_hourly) if last_hourly.is_integer() else last_hourly
+    for field, value in zip(STAT_FIELDS, stats):
+        setattr(user, field, value)
+    return user
+
+
+class SnapshotFile:
+    """Read-only memory map of a snapshot; nothing is decoded up front"""
+
+    def __init__(self, path):
+        if sys.byteorder != 'little':
+            raise RuntimeError("Binary snapshots need a little-endian host, use SNAPSHOT_FORMAT=json")
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, record_size, self.count, ids_offset, self.records_offset,
+         ranks_offset, meta_offset, meta_length) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise RuntimeError(f"{path} is not a version {VERSION} zucchini snapshot")
+        view = memoryview(self._map)
+        self.ids = view[ids_offset:ids_offset + 8 * self.count].cast('q')
+        self.ranks = view[ranks_offset:ranks_offset + 4 * self.count].cast('I')
+        # Every record as int64 words; the length is the first word of each
+        self._words = view[self.records_offset:ranks_offset].cast('q')
+        self.meta = json.loads(bytes(view[meta_offset:meta_offset + meta_length]))
+
+    def find(self, user_id):
+        """Position of a user in the index, or -1"""
+        key = _int_id(user_id)
+        if key is None:
+            return -1
+        i = bisect.bisect_left(self.ids, key)
+        return i if i < self.count and self.ids[i] == key else -1
+
+    def record(self, i):
+        offset = self.records_offset + i * RECORD.size
+        return self._map[offset:offset + RECORD.size]
+
+    def user(self, i):
+        return _unpack(self._map, self.records_offset + i * RECORD.size)
+
+    def lengths(self):
+        """The length of every record, in id order"""
+        return self._words[::RECORD.size // 8].tolist()
+
+    def close(self):
+        self.ids.release()
+        self.ranks.release()
+        self._words.release()
+        self._map.close()
+        self._file.close()
+
+
+class ColdStore:
+    """Records of users evicted from memory since the snapshot was written.
+
+    An append-only file of packed records plus an {user_id: offset} index;
+    a user evicted twice gets a new record and the old one becomes garbage
+    until the next rebase. Not durable on its own: the snapshot and the
+    journal are, so the file starts empty on every run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}
+        self.size = 0
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, user_id):
+        return user_id in self.offsets
+
+    def put(self, user_id, record):
+        os.pwrite(self._fd, record, self.size)
+        self.offsets[user_id] = self.size
+        self.size += len(record)
+
+    def get(self, user_id):
+        """Packed record of a user, None if it was never evicted"""
+        offset = self.offsets.get(user_id)
+        return None if offset is None else self.read(offset)
+
+    def read(self, offset):
+        # Safe from another thread: records are never rewritten in place
+        return os.pread(self._fd, RECORD.size, offset)
+
+    def discard(self, user_id):
+        self.offsets.pop(user_id, None)
+
+    def rewrite(self, keep_from):
+        """Keep only the records written at or after offset keep_from"""
+        live = [(user_id, self.read(offset)) for user_id, offset in self.offsets.items() if offset >= keep_from]
+        os.ftruncate(self._fd, 0)
+        self.offsets, self.size = {}, 0
+        for user_id, record in live:
+            self.put(user_id, record)
+
+    def close(self):
+        os.close(self._fd)
+        os.remove(self.path)
+
+
+class LazyUsers:
+    """The data['users'] mapping over a SnapshotFile.
+
+    Behaves like the {user_id: User} dict the rest of the code expects;
+    a user is decoded from the map on first access and kept in memory,
+    so every change goes through the decoded record. With a capacity the
+    decoded users are an LRU cache: past it, the least recently used user
+    is dropped, and written to the cold store first if it changed since it
+    was read. rebase() moves onto a newer snapshot and empties the cold
+    store of what that snapshot already holds.
+    """
+
+    def __init__(self, snapshot, extra=None, capacity=0, cold_path=None):
+        self.snapshot = snapshot
+        self.capacity = capacity
+        self.cold = ColdStore(cold_path or snapshot.path + '.cold') if capacity else None
+        self._users = OrderedDict((uid, User.from_json(u)) for uid, u in (extra or {}).items())
+        self._deleted = set()
+        self._count = snapshot.count + len(self._users)
+        self._mark = 0
+        # Records packed by the last dump(), which rebase() will map next
+        self._dumped = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    @property
+    def decoded(self):
+        return len(self._users)
+
+    def __len__(self):
+        return self._count
+
+    def _source(self, user_id):
+        """The packed record a user was last read from, None for new users"""
+        if self.cold is not None and user_id in self.cold:
+            return self.cold.get(user_id)
+        i = self.snapshot.find(user_id)
+        return self.snapshot.record(i) if i >= 0 else None
+
+    def _peek(self, user_id):
+        """Decode a user that is not in memory without caching it"""
+        if user_id in self._deleted:
+            return None
+        record = self._source(user_id)
+        return None if record is None else _unpack(record, 0)
+
+    def _load(self, user_id):
+        user = self._peek(user_id)
+        if user is not None:
+            self.misses += 1
+            self._users[user_id] = user
+            self._evict()
+        return user
+
+    def _evict(self):
+        while self.capacity and len(self._users) > self.capacity:
+            user_id, user = self._users.popitem(last=False)
+            key = _int_id(user_id)
+            try:
+                record = _pack(user) if key is not None else None
+            except struct.error:
+                record = None
+            if record is None:
+                # Ids or values the fixed records cannot hold stay in memory
+                self._users[user_id] = user
+                return
+            # A snapshot being written may hold a value the mapped one does
+            # not: the user is clean only if it matches both
+            dumped = self._dumped.get(key, record)
+            if record != self._source(user_id) or record != dumped:
+                self.cold.put(user_id, record)
+                self.writebacks += 1
+            self.evictions += 1
+
+    def get(self, user_id, default=None):
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._load(user_id)
+        else:
+            self.hits += 1
+            self._users.move_to_end(user_id)
+        return default if user is None else user
+
+    def __getitem__(self, user_id):
+        user = self.get(user_id)
+        if user is None:
+            raise KeyError(user_id)
+        return user
+
+    def __contains__(self, user_id):
+        if user_id in self._users:
+            return True
+        if user_id in self._deleted:
+            return False
+        return (self.cold is not None and user_id in self.cold) or self.snapshot.find(user_id) >= 0
+
+    def __setitem__(self, user_id, user):
+        if isinstance(user, dict):
+            user = User.from_json(user)
+        if user_id not in self:
+            self._count += 1
+        self._deleted.discard(user_id)
+        self._users[user_id] = user
+        self._users.move_to_end(user_id)
+        self._evict()
+
+    def setdefault(self, user_id, default=None):
+        user = self.get(user_id)
+        if user is None:
+            self[user_id] = default
+            user = self._users[user_id]
+        return user
+
+    def pop(self, user_id, default=None):
+        user = self.get(user_id)
+        if user is None:
+            return default
+        del self._users[user_id]
+        if self.cold is not None:
+            self.cold.discard(user_id)
+        if self.snapshot.find(user_id) >= 0:
+            self._deleted.add(user_id)
+        self._count -= 1
+        return user
+
+    def _cold_ids(self):
+        """Evicted users that are not back in memory"""
+        if self.cold is None:
+            return []
+        return [user_id for user_id in self.cold.offsets if user_id not in self._users]
+
+    def __iter__(self):
+        cold = self.cold.offsets if self.cold is not None else {}
+        for key in self.snapshot.ids:
+            user_id = str(key)
+            if user_id not in self._users and user_id not in cold and user_id not in self._deleted:
+                yield user_id
+        yield from self._cold_ids()
+        yield from list(self._users)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        """Every (user_id, User), decoded without filling the cache: for tools and exports"""
+        for user_id in iter(self):
+            user = self._users.get(user_id)
+            yield user_id, user if user is not None else self._peek(user_id)
+
+    def lengths(self):
+        """(user_id, length) of every user, undecoded ones in the snapshot's
+        rank order, so sorting them for the leaderboard is nearly free"""
+        ids = self.snapshot.ids.tolist()
+        lengths = self.snapshot.lengths()
+        cold = self._cold_ids()
+        changed = self._users.keys() | self._deleted | set(cold)
+        for i in self.snapshot.ranks.tolist():
+            user_id = str(ids[i])
+            if user_id not in changed:
+                yield user_id, lengths[i]
+        for user_id in cold:
+            yield user_id, LENGTH.unpack_from(self.cold.get(user_id))[0]
+        for user_id, user in self._users.items():
+            yield user_id, user.length
+
+    def to_json(self):
+        # Lets journal.dump_data() export the whole table as JSON
+        return {user_id: user.to_json() for user_id, user in self.items()}
+
+    def rebase(self, snapshot):
+        """Switch to a snapshot written from the last dump() of this table"""
+        old, self.snapshot = self.snapshot, snapshot
+        if self.cold is not None:
+            # Records evicted before the dump are in the new snapshot
+            self.cold.rewrite(self._mark)
+        self._dumped = {}
+        self._deleted = {user_id for user_id in self._deleted if snapshot.find(user_id) >= 0}
+        old.close()
+
+    def close(self):
+        self.snapshot.close()
+        if self.cold is not None:
+            self.cold.close()
+
+
+def load(path, capacity=0):
+    """The data dict of a snapshot, with users mapped lazily and at most
+    capacity of them decoded at a time (0 = no limit)"""
+    snapshot = SnapshotFile(path)
+    data = dict(snapshot.meta)
+    data['users'] = LazyUsers(snapshot, data.pop('extra_users', {}), capacity)
+    return data
+
+
+def dump(data):
+    """Freeze data into a function that builds the snapshot bytes.
+
+    Must run on the thread that mutates data; only users decoded since the
+    last load are packed here. The returned function merges them with the
+    untouched records of the mapped file and is safe to call from a worker
+    thread.
+    """
+    users = data['users']
+    meta = {key: value for key, value in data.items() if key != 'users'}
+    packed, extra = {}, {}
+    lazy = isinstance(users, LazyUsers)
+    changed = users._users if lazy else users
+    for user_id, user in changed.items():
+        key = _int_id(user_id)
+        try:
+            if key is not None:
+                packed[key] = _pack(user)
+                continue
+        except struct.error:
+            pass
+        # Ids or values the fixed records cannot hold stay in the JSON block
+        extra[user_id] = user.to_json()
+    meta['extra_users'] = extra
+    meta_text = json.dumps(meta, separators=(',', ':')).encode()
+    base, deleted, cold, evicted = None, set(), None, []
+    if lazy:
+        base, deleted = users.snapshot, {_int_id(uid) for uid in users._deleted}
+        if users.cold is not None:
+            cold = users.cold
+            evicted = [(_int_id(uid), cold.offsets[uid]) for uid in users._cold_ids()]
+            # rebase() drops the records this snapshot will hold
+            users._mark = cold.size
+        users._dumped = packed
+
+    def encode():
+        rows = []
+        if base is not None:
+            skip = packed.keys() | deleted | {key for key, _ in evicted}
+            for i, key in enumerate(base.ids):
+                if key not in skip:
+                    rows.append((key, base.record(i)))
+        rows.extend((key, cold.read(offset)) for key, offset in evicted)
+        rows.extend(packed.items())
+        rows.sort(key=lambda row: row[0])
+        lengths = [LENGTH.unpack_from(record)[0] for _, record in rows]
+        # Leaderboard order: longest first, ties by id as text, like RankIndex
+        ranks = sorted(range(len(rows)), key=lambda i: (-lengths[i], str(rows[i][0])))
+
+        count = len(rows)
+        ids_offset = HEADER.size
+        records_offset = ids_offset + 8 * count
+        ranks_offset = records_offset + RECORD.size * count
+        meta_offset = ranks_offset + 4 * count
+        parts = [
+            HEADER.pack(MAGIC, VERSION, RECORD.size, count, ids_offset, records_offset,
+                        ranks_offset, meta_offset, len(meta_text)),
+            struct.pack(f'<{count}q', *(key for key, _ in rows)),
+            b''.join(record for _, record in rows),
+            struct.pack(f'<{count}I', *ranks),
+            meta_text,
+        ]
+        return b''.join(parts)
+
+    return encode
@@ -0,0 +1,1007 @@
+# Zucchini Telegram Bot - Storage backends
+# Handlers talk to a Storage object instead of the raw data dict, so the
+# game state can live either in the JSON file (in memory + journal) or in
+# an SQLite database in WAL mode. Lottery rounds and pending duels are
+# partitioned by chat id; user balances are shared by every chat. Several
+# worker processes can share one SQLite database: balance changes are
+# atomic updates, and a lease table elects the one that draws the lottery.
+#
+#   python storage.py migrate zucchini_data.json zucchini.db
+#   python storage.py check zucchini.db
+#   python storage.py export zucchini_data.snap zucchini_data.json
+#   python storage.py import zucchini_data.json zucchini_data.snap
+import argparse
+import json
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+
+import snapshot
+from journal import Journal, apply_op, dump_data, write_snapshot
+from persistence import SAVE_SECONDS, WriteBehindPersister
+from ranking import RankIndex
+from challenges import challenge_owner
+from shards import ShardStore
+from users import STAT_FIELDS, USER_FIELDS, User, user_hook
+
+logger = logging.getLogger(__name__)
+
+LOTTERY_HISTORY_SIZE = 5
+
+
+def load_data(path):
+    """Read the JSON data file, or a fresh structure if it does not exist"""
+    try:
+        with open(path, 'r') as f:
+            # Users become User records while parsing, never nested dicts
+            return json.load(f, object_hook=user_hook)
+    except FileNotFoundError:
+        logger.info("Data file not found, creating new data structure")
+        return {
+            'users': {},
+            # chat_id -> end_time of every round with bets, for restarts
+            'open_rounds': {},
+            # chat_id -> {challenge_id: [owner, expires]} of pending challenges
+            'open_challenges': {}
+        }
+    except json.JSONDecodeError as e:
+        # Never start from an empty dataset: the next save would wipe everyone
+        logger.error(f"Error loading data file: {e}")
+        raise RuntimeError(f"{path} is corrupted, refusing to start") from e
+
+
+def decode_replayed_users(users):
+    """Turn the plain dicts a replayed journal 'set' op leaves in a users
+    dict into User records"""
+    for user_id, user in users.items():
+        if isinstance(user, dict):
+            users[user_id] = User.from_json(user)
+
+
+class Storage:
+    """Game state repository shared by all backends.
+
+    User deltas use 'stats.won' style keys for stat counters. Methods that
+    spend length take min_length and return None when the user cannot
+    afford it, so checks and updates happen atomically. Duels and lottery
+    rounds are scoped to the chat they were started in.
+    """
+
+    # --- Users ---
+    def get_user(self, user_id):
+        """User record (users.User), created with default values if unknown"""
+        raise NotImplementedError
+
+    def apply_delta(self, user_id, deltas=None, values=None, min_length=None):
+        """Add deltas and assign values; None if length < min_length"""
+        raise NotImplementedError
+
+    def transfer(self, from_id, to_id, amount):
+        """Move amount between two users atomically; False if from_id cannot pay"""
+        raise NotImplementedError
+
+    # --- Leaderboard ---
+    def user_count(self):
+        raise NotImplementedError
+
+    def range(self, start, stop):
+        """[(user_id, length)] for 0-based leaderboard positions start..stop-1"""
+        raise NotImplementedError
+
+    def rank(self, user_id):
+        """1-based leaderboard position, or None if unknown"""
+        raise NotImplementedError
+
+    def around(self, user_id, radius=1):
+        """[(rank, user_id, length)] within radius positions of a user"""
+        rank = self.rank(user_id)
+        if rank is None:
+            return []
+        start = max(0, rank - 1 - radius)
+        return [(start + i + 1, uid, length)
+                for i, (uid, length) in enumerate(self.range(start, rank + radius))]
+
+    # --- Pending duels and coinflips ---
+    def get_challenge(self, chat_id, challenge_id):
+        raise NotImplementedError
+
+    def add_challenge(self, chat_id, record):
+        """Store a challenge record (see challenges.py) and return its new id.
+        Ids are never reused within a chat, so stale buttons cannot match."""
+        raise NotImplementedError
+
+    def set_challenge_message(self, chat_id, challenge_id, message_id):
+        """Remember the message carrying the buttons; no-op once claimed"""
+        raise NotImplementedError
+
+    def claim_challenge(self, chat_id, challenge_id):
+        """Remove and return a pending challenge, None if someone got there first"""
+        raise NotImplementedError
+
+    def open_challenges(self):
+        """{(chat_id, challenge_id): (owner, expires)} of every pending challenge;
+        records saved before expiries existed report expires 0"""
+        raise NotImplementedError
+
+    # --- Lottery ---
+    def lottery_end_time(self, chat_id):
+        raise NotImplementedError
+
+    def set_lottery_end_time(self, chat_id, end_time):
+        raise NotImplementedError
+
+    def lottery_history(self, chat_id):
+        raise NotImplementedError
+
+    def open_rounds(self):
+        """{chat_id: end_time} of every chat with bets in its round"""
+        raise NotImplementedError
+
+    def get_bet(self, chat_id, user_id):
+        raise NotImplementedError
+
+    def lottery_bets(self, chat_id):
+        """{user_id: {'number', 'amount'}} for the open round of a chat"""
+        raise NotImplementedError
+
+    def bet_totals(self, chat_id):
+        """{number: (total amount, bettor count)} for the open round, in O(numbers)"""
+        raise NotImplementedError
+
+    def check_lottery_aggregates(self, chat_id):
+        """Compare the running bet_totals() with a full scan of the raw bets"""
+        expected = {}
+        for b in self.lottery_bets(chat_id).values():
+            total, count = expected.get(b['number'], (0, 0))
+            expected[b['number']] = (total + b['amount'], count + 1)
+        actual = self.bet_totals(chat_id)
+        return [
+            f"chat {chat_id}, numero {number}: aggregato {actual.get(number)} != scommesse {expected.get(number)}"
+            for number in sorted(set(expected) | set(actual))
+            if actual.get(number) != expected.get(number)
+        ]
+
+    def place_bet(self, chat_id, user_id, number, amount):
+        """Move amount from the user into the chat's round: (bet, error) where
+        error is None, 'length' (cannot afford) or 'number' (bet elsewhere)"""
+        raise NotImplementedError
+
+    def settle_lottery(self, chat_id, credits, winning_number=None, totals=None):
+        """Apply credit batches [(user_ids, {field: amounts})] in one go, close
+        the chat's round and record the draw.
+
+        totals is the bet_totals() the credits were computed from: if a bet
+        came in since, nothing is applied and False is returned.
+        """
+        raise NotImplementedError
+
+    # --- Leases ---
+    def acquire_lease(self, name, owner, ttl, now):
+        """Take or renew lease name for owner until now + ttl; False while
+        another owner holds it unexpired"""
+        raise NotImplementedError
+
+    def release_lease(self, name, owner):
+        """Give up a lease early so another owner can take it"""
+
+    # --- Lifecycle ---
+    def save(self):
+        """Request persistence of changes made so far"""
+
+    def start(self):
+        """Start background work; called once the event loop runs"""
+
+    async def close(self):
+        """Flush and release resources"""
+
+
+# === JSON Backend ===
+class JsonStorage(Storage):
+    """Users in memory, persisted to a snapshot plus journal; chat state in
+    per-chat shard files (see shards.py).
+
+    With snapshot_path set, the snapshot is the binary file of snapshot.py:
+    users are decoded from it on first access and path is only imported
+    when the binary file does not exist yet. user_cache_size then caps how
+    many stay decoded (see snapshot.LazyUsers), 0 keeps every one.
+    """
+
+    def __init__(self, path, journal_path, mode='journal', compact_bytes=4 * 1024 * 1024,
+                 compact_interval=600, save_window=0.2, shard_dir='chats',
+                 shard_idle_timeout=600, legacy_chat_id=None, snapshot_path=None, user_cache_size=0):
+        imported = snapshot_path is not None and not os.path.exists(snapshot_path)
+        self.snapshot_path = snapshot_path
+        if snapshot_path is None or imported:
+            self.data = load_data(path)
+        else:
+            self.data = snapshot.load(snapshot_path, user_cache_size)
+        if snapshot_path is not None:
+            path, dump = snapshot_path, snapshot.dump
+        else:
+            dump = dump_data
+
+        # Replay in both modes so switching to 'snapshot' never drops journaled changes
+        journal = Journal(journal_path, path, compact_bytes, compact_interval, dump=dump)
+        self.shards = ShardStore(shard_dir, save_window, shard_idle_timeout)
+        self.shards.replay(journal, self.data)
+        users = self.data['users']
+        if isinstance(users, dict):
+            decode_replayed_users(users)
+        if imported:
+            self.data['journal_seq'] = journal.seq
+            write_snapshot(snapshot_path, dump(self.data), fsync=True)
+            logger.info(f"{len(users)} utenti importati in {snapshot_path}")
+            # Run from the mapped file like every later start
+            self.data = snapshot.load(snapshot_path, user_cache_size)
+        if mode == 'journal':
+            journal.open()
+        else:
+            self.data['journal_seq'] = journal.seq
+            journal = None
+        self.journal = journal
+        self.persister = WriteBehindPersister(
+            self.data, path, journal, save_window, dump=dump,
+            on_snapshot=self._rebase if snapshot_path is not None else None,
+            shards=self.shards if journal is not None else None
+        )
+        # Built on the first leaderboard query, then kept in sync by _apply()
+        self._rank_index = None
+        self.data.setdefault('open_rounds', {})
+        if 'lottery' in self.data or 'duels' in self.data:
+            self._migrate_legacy(legacy_chat_id)
+        if 'open_challenges' not in self.data:
+            self._index_challenges()
+
+    @property
+    def rank_index(self):
+        if self._rank_index is None:
+            users = self.data['users']
+            if isinstance(users, snapshot.LazyUsers):
+                self._rank_index = RankIndex.from_lengths(users.lengths())
+            else:
+                self._rank_index = RankIndex.build(users)
+        return self._rank_index
+
+    def _rebase(self):
+        """Map the snapshot just written, so evicted users come from it"""
+        self.data['users'].rebase(snapshot.SnapshotFile(self.snapshot_path))
+
+    def _migrate_legacy(self, chat_id):
+        """Move the pre-sharding global round and duels into chat_id's shard"""
+        if chat_id is None:
+            raise RuntimeError("Legacy lottery/duel data found but no chat to move it to")
+        shard = self.shards.get(chat_id)
+        lottery = self.data.get('lottery', {})
+        shard.data['duels'] = self.data.get('duels', {})
+        shard.data['lottery'] = {
+            'bets': lottery.get('bets', {}),
+            'history': lottery.get('history', []),
+            'end_time': lottery.get('end_time', 0),
+        }
+        self.shards.write_now(shard)
+
+        # Only drop the old keys once the shard is safely on disk
+        if shard.data['lottery']['bets']:
+            self.set_field(['open_rounds', shard.chat_id], shard.data['lottery']['end_time'])
+        self.del_field(['lottery'])
+        self.del_field(['duels'])
+        self.save()
+        logger.info(f"Lotteria e duelli esistenti spostati nella chat {chat_id}")
+
+    def _apply(self, op):
+        path = op[1]
+        if path[0] == 'chats':
+            # Chat state lives in its shard, journaled with the rest
+            self.shards.apply(op)
+        else:
+            apply_op(self.data, op)
+        if self.journal is not None:
+            self.journal.record(op)
+        if path[0] == 'users' and (len(path) == 2 or path[2] == 'length'):
+            user_id = path[1]
+            users = self.data['users']
+            if len(path) == 2 and op[0] == 'set':
+                users[user_id] = User.from_json(op[2])
+            if self._rank_index is None:
+                return
+            if user_id in users:
+                self.rank_index.update(user_id, users[user_id].length)
+            else:
+                self.rank_index.remove(user_id)
+
+    def set_field(self, path, value):
+        self._apply(['set', path, value])
+
+    def incr_field(self, path, amount):
+        self._apply(['inc', path, amount])
+
+    def del_field(self, path):
+        self._apply(['del', path])
+
+    # --- Users ---
+    def get_user(self, user_id):
+        user_id = str(user_id)
+        if user_id not in self.data['users']:
+            self.set_field(['users', user_id], User().to_json())
+        return self.data['users'][user_id]
+
+    def apply_delta(self, user_id, deltas=None, values=None, min_length=None):
+        user_id = str(user_id)
+        user = self.get_user(user_id)
+        if min_length is not None and user.length < min_length:
+            return None
+        for field, amount in (deltas or {}).items():
+            self.incr_field(['users', user_id] + field.split('.'), amount)
+        for field, value in (values or {}).items():
+            self.set_field(['users', user_id] + field.split('.'), value)
+        return user
+
+    def transfer(self, from_id, to_id, amount):
+        if self.apply_delta(from_id, {'length': -amount}, min_length=amount) is None:
+            return False
+        self.apply_delta(to_id, {'length': amount})
+        return True
+
+    # --- Leaderboard ---
+    def user_count(self):
+        return len(self.data['users'])
+
+    def range(self, start, stop):
+        return self.rank_index.range(start, stop)
+
+    def rank(self, user_id):
+        return self.rank_index.rank(user_id)
+
+    # --- Pending duels and coinflips ---
+    def _index_challenges(self):
+        """Build the open_challenges index from the shard files, once"""
+        index = {}
+        for name in os.listdir(self.shards.directory):
+            if not name.endswith('.json'):
+                continue
+            shard = self.shards.get(name[:-len('.json')])
+            challenges = {
+                challenge_id: [challenge_owner(record, challenge_id), record.get('expires', 0)]
+                for challenge_id, record in shard.data['duels'].items()
+            }
+            if challenges:
+                index[shard.chat_id] = challenges
+        self.set_field(['open_challenges'], index)
+        self.save()
+
+    def get_challenge(self, chat_id, challenge_id):
+        return self.shards.get(chat_id).data['duels'].get(str(challenge_id))
+
+    def add_challenge(self, chat_id, record):
+        shard = self.shards.get(chat_id)
+        number = shard.data.get('next_challenge', 1)
+        self.set_field(['chats', shard.chat_id, 'next_challenge'], number + 1)
+        # The prefix keeps new ids apart from the user ids older records used
+        challenge_id = f"c{number}"
+        self.set_field(['chats', shard.chat_id, 'duels', challenge_id], record)
+        self.set_field(['open_challenges', shard.chat_id, challenge_id], [record['owner'], record['expires']])
+        return challenge_id
+
+    def set_challenge_message(self, chat_id, challenge_id, message_id):
+        shard = self.shards.get(chat_id)
+        challenge_id = str(challenge_id)
+        if challenge_id in shard.data['duels']:
+            self.set_field(['chats', shard.chat_id, 'duels', challenge_id, 'message_id'], message_id)
+
+    def claim_challenge(self, chat_id, challenge_id):
+        shard = self.shards.get(chat_id)
+        challenge_id = str(challenge_id)
+        record = shard.data['duels'].get(challenge_id)
+        if record is not None:
+            self.del_field(['chats', shard.chat_id, 'duels', challenge_id])
+        chat_index = self.data['open_challenges'].get(shard.chat_id, {})
+        if challenge_id in chat_index:
+            if len(chat_index) == 1:
+                self.del_field(['open_challenges', shard.chat_id])
+            else:
+                self.del_field(['open_challenges', shard.chat_id, challenge_id])
+        return record
+
+    def open_challenges(self):
+        return {
+            (chat_id, challenge_id): tuple(entry)
+            for chat_id, challenges in self.data['open_challenges'].items()
+            for challenge_id, entry in challenges.items()
+        }
+
+    # --- Lottery ---
+    def lottery_end_time(self, chat_id):
+        return self.shards.get(chat_id).data['lottery'].get('end_time', 0)
+
+    def set_lottery_end_time(self, chat_id, end_time):
+        shard = self.shards.get(chat_id)
+        self.set_field(['chats', shard.chat_id, 'lottery', 'end_time'], end_time)
+        if shard.chat_id in self.data['open_rounds']:
+            self.set_field(['open_rounds', shard.chat_id], end_time)
+
+    def lottery_history(self, chat_id):
+        return list(self.shards.get(chat_id).data['lottery']['history'])
+
+    def open_rounds(self):
+        return dict(self.data['open_rounds'])
+
+    def get_bet(self, chat_id, user_id):
+        return self.shards.get(chat_id).data['lottery']['bets'].get(str(user_id))
+
+    def lottery_bets(self, chat_id):
+        return dict(self.shards.get(chat_id).data['lottery']['bets'])
+
+    def bet_totals(self, chat_id):
+        return dict(self.shards.get(chat_id).bet_totals)
+
+    def place_bet(self, chat_id, user_id, number, amount):
+        user_id = str(user_id)
+        shard = self.shards.get(chat_id)
+        bets = shard.data['lottery']['bets']
+        current_bet = bets.get(user_id)
+        if current_bet and current_bet['number'] != number:
+            return current_bet, 'number'
+        if self.apply_delta(user_id, {'length': -amount}, min_length=amount) is None:
+            return current_bet, 'length'
+        total, count = shard.bet_totals.get(number, (0, 0))
+        if current_bet:
+            shard.bet_totals[number] = (total + amount, count)
+            amount += current_bet['amount']
+        else:
+            shard.bet_totals[number] = (total + amount, count + 1)
+        # Journaled with the debit above, so a crash keeps both or neither
+        self.set_field(['chats', shard.chat_id, 'lottery', 'bets', user_id], {'number': number, 'amount': amount})
+        if shard.chat_id not in self.data['open_rounds']:
+            self.set_field(['open_rounds', shard.chat_id], shard.data['lottery']['end_time'])
+        return bets[user_id], None
+
+    def settle_lottery(self, chat_id, credits, winning_number=None, totals=None):
+        shard = self.shards.get(chat_id)
+        if totals is not None and shard.bet_totals != totals:
+            return False
+        users = self.data['users']
+        for user_ids, columns in credits:
+            for user_id in user_ids:
+                if user_id not in users:
+                    self.get_user(user_id)
+            for field, amounts in columns.items():
+                path = field.split('.')
+                for user_id, amount in zip(user_ids, amounts):
+                    if amount:
+                        self.incr_field(['users', user_id] + path, amount)
+        self.set_field(['chats', shard.chat_id, 'lottery', 'bets'], {})
+        shard.bet_totals = {}
+        if winning_number is not None:
+            history = shard.data['lottery']['history'] + [winning_number]
+            self.set_field(['chats', shard.chat_id, 'lottery', 'history'], history[-LOTTERY_HISTORY_SIZE:])
+        self.del_field(['open_rounds', shard.chat_id])
+        return True
+
+    # --- Leases ---
+    def acquire_lease(self, name, owner, ttl, now):
+        # The data file belongs to a single process, which always leads
+        return True
+
+    # --- Lifecycle ---
+    def save(self):
+        self.persister.mark_dirty()
+
+    def start(self):
+        self.persister.start()
+        if self.journal is None:
+            self.shards.start()
+
+    async def close(self):
+        if self.journal is None:
+            await self.shards.stop()
+        await self.persister.stop()
+        if isinstance(self.data['users'], snapshot.LazyUsers):
+            self.data['users'].close()
+
+
+# === SQLite Backend ===
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT PRIMARY KEY,
+    length INTEGER NOT NULL DEFAULT 20,
+    last_daily REAL NOT NULL DEFAULT 0,
+    last_hourly REAL NOT NULL DEFAULT 0,
+    {', '.join(f'{field} INTEGER NOT NULL DEFAULT 0' for field in STAT_FIELDS)}
+);
+CREATE INDEX IF NOT EXISTS users_by_length ON users (length DESC, id);
+CREATE TABLE IF NOT EXISTS chat_duels (
+    chat_id TEXT NOT NULL,
+    id TEXT NOT NULL,
+    record TEXT NOT NULL,
+    PRIMARY KEY (chat_id, id)
+);
+CREATE TABLE IF NOT EXISTS chat_rounds (
+    chat_id TEXT PRIMARY KEY,
+    end_time REAL NOT NULL DEFAULT 0,
+    history TEXT NOT NULL DEFAULT '[]',
+    next_challenge INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS chat_bets (
+    chat_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS chat_bet_totals (
+    chat_id TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    total INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, number)
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+USER_COLUMNS = USER_FIELDS + STAT_FIELDS
+
+
+class SqliteStorage(Storage):
+    """State kept in an SQLite database (WAL mode), one transaction per operation"""
+
+    def __init__(self, path, legacy_chat_id=None):
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        if 'next_challenge' not in self._columns('chat_rounds'):
+            self.conn.execute("ALTER TABLE chat_rounds ADD COLUMN next_challenge INTEGER NOT NULL DEFAULT 1")
+        if self._table_exists('lottery_bets'):
+            self._migrate_legacy(legacy_chat_id)
+
+    @contextmanager
+    def _transaction(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        with SAVE_SECONDS.time('sqlite'):
+            self.conn.execute("COMMIT")
+
+    def _table_exists(self, name):
+        return self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+        ).fetchone() is not None
+
+    def _columns(self, table):
+        return {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+
+    def _migrate_legacy(self, chat_id):
+        """Move the pre-sharding global round and duels into chat_id"""
+        if chat_id is None:
+            raise RuntimeError("Legacy lottery/duel tables found but no chat to move them to")
+        chat_id = str(chat_id)
+        with self._transaction() as conn:
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_rounds (chat_id, end_time, history) VALUES (?, ?, ?)",
+                (chat_id, json.loads(meta.get('end_time', '0')), meta.get('history', '[]'))
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_duels (chat_id, id, record) SELECT ?, id, record FROM duels",
+                (chat_id,)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_bets (chat_id, user_id, number, amount) "
+                "SELECT ?, user_id, number, amount FROM lottery_bets", (chat_id,)
+            )
+            self._rebuild_bet_totals(chat_id)
+            for table in ('duels', 'lottery_bets', 'lottery_totals', 'meta'):
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+        logger.info(f"Lotteria e duelli esistenti spostati nella chat {chat_id}")
+
+    @staticmethod
+    def _row_to_user(row):
+        return User(*row[:len(USER_FIELDS)], **dict(zip(STAT_FIELDS, row[len(USER_FIELDS):])))
+
+    @staticmethod
+    def _column(field):
+        column = field.split('.')[-1]
+        if column not in USER_COLUMNS:
+            raise KeyError(f"Unknown user field: {field}")
+        return column
+
+    # --- Users ---
+    def get_user(self, user_id):
+        user_id = str(user_id)
+        self.conn.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (user_id,))
+        row = self.conn.execute(
+            f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE id = ?", (user_id,)
+        ).fetchone()
+        return self._row_to_user(row)
+
+    def _update_user(self, user_id, deltas=None, values=None, min_length=None):
+        """UPDATE inside the caller's transaction; False if the guard failed"""
+        assignments, params = [], []
+        for field, amount in (deltas or {}).items():
+            column = self._column(field)
+            assignments.append(f"{column} = {column} + ?")
+            params.append(amount)
+        for field, value in (values or {}).items():
+            assignments.append(f"{self._column(field)} = ?")
+            params.append(value)
+        self.conn.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (user_id,))
+        if not assignments:
+            return True
+        sql = f"UPDATE users SET {', '.join(assignments)} WHERE id = ?"
+        params.append(user_id)
+        if min_length is not None:
+            sql += " AND length >= ?"
+            params.append(min_length)
+        return self.conn.execute(sql, params).rowcount == 1
+
+    def apply_delta(self, user_id, deltas=None, values=None, min_length=None):
+        user_id = str(user_id)
+        with self._transaction():
+            if not self._update_user(user_id, deltas, values, min_length):
+                return None
+        return self.get_user(user_id)
+
+    def transfer(self, from_id, to_id, amount):
+        with self._transaction():
+            if not self._update_user(str(from_id), {'length': -amount}, min_length=amount):
+                return False
+            self._update_user(str(to_id), {'length': amount})
+        return True
+
+    # --- Leaderboard ---
+    def user_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def range(self, start, stop):
+        if start >= stop:
+            return []
+        return self.conn.execute(
+            "SELECT id, length FROM users ORDER BY length DESC, id LIMIT ? OFFSET ?",
+            (stop - start, start)
+        ).fetchall()
+
+    def rank(self, user_id):
+        row = self.conn.execute("SELECT length FROM users WHERE id = ?", (str(user_id),)).fetchone()
+        if row is None:
+            return None
+        ahead = self.conn.execute(
+            "SELECT COUNT(*) FROM users WHERE length > ? OR (length = ? AND id < ?)",
+            (row[0], row[0], str(user_id))
+        ).fetchone()[0]
+        return ahead + 1
+
+    # --- Pending duels and coinflips ---
+    def get_challenge(self, chat_id, challenge_id):
+        row = self.conn.execute(
+            "SELECT record FROM chat_duels WHERE chat_id = ? AND id = ?", (str(chat_id), str(challenge_id))
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_challenge(self, chat_id, record):
+        chat_id = str(chat_id)
+        with self._transaction():
+            self.conn.execute(
+                "INSERT INTO chat_rounds (chat_id, next_challenge) VALUES (?, 2) "
+                "ON CONFLICT (chat_id) DO UPDATE SET next_challenge = next_challenge + 1",
+                (chat_id,)
+            )
+            number = self.conn.execute(
+                "SELECT next_challenge - 1 FROM chat_rounds WHERE chat_id = ?", (chat_id,)
+            ).fetchone()[0]
+            challenge_id = f"c{number}"
+            self.conn.execute(
+                "INSERT INTO chat_duels (chat_id, id, record) VALUES (?, ?, ?)",
+                (chat_id, challenge_id, json.dumps(record))
+            )
+        return challenge_id
+
+    def set_challenge_message(self, chat_id, challenge_id, message_id):
+        self.conn.execute(
+            "UPDATE chat_duels SET record = json_set(record, '$.message_id', ?) WHERE chat_id = ? AND id = ?",
+            (message_id, str(chat_id), str(challenge_id))
+        )
+
+    def claim_challenge(self, chat_id, challenge_id):
+        with self._transaction():
+            record = self.get_challenge(chat_id, challenge_id)
+            if record is not None:
+                self.conn.execute(
+                    "DELETE FROM chat_duels WHERE chat_id = ? AND id = ?", (str(chat_id), str(challenge_id))
+                )
+        return record
+
+    def open_challenges(self):
+        challenges = {}
+        for chat_id, challenge_id, record in self.conn.execute("SELECT chat_id, id, record FROM chat_duels"):
+            record = json.loads(record)
+            challenges[chat_id, challenge_id] = (challenge_owner(record, challenge_id), record.get('expires', 0))
+        return challenges
+
+    # --- Lottery ---
+    def _round(self, chat_id):
+        row = self.conn.execute(
+            "SELECT end_time, history FROM chat_rounds WHERE chat_id = ?", (str(chat_id),)
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else (0, [])
+
+    def lottery_end_time(self, chat_id):
+        return self._round(chat_id)[0]
+
+    def set_lottery_end_time(self, chat_id, end_time):
+        self.conn.execute(
+            "INSERT INTO chat_rounds (chat_id, end_time) VALUES (?, ?) "
+            "ON CONFLICT (chat_id) DO UPDATE SET end_time = excluded.end_time",
+            (str(chat_id), end_time)
+        )
+
+    def lottery_history(self, chat_id):
+        return self._round(chat_id)[1]
+
+    def open_rounds(self):
+        return dict(self.conn.execute(
+            "SELECT chat_id, end_time FROM chat_rounds "
+            "WHERE chat_id IN (SELECT DISTINCT chat_id FROM chat_bet_totals)"
+        ))
+
+    def get_bet(self, chat_id, user_id):
+        row = self.conn.execute(
+            "SELECT number, amount FROM chat_bets WHERE chat_id = ? AND user_id = ?",
+            (str(chat_id), str(user_id))
+        ).fetchone()
+        return {'number': row[0], 'amount': row[1]} if row else None
+
+    def lottery_bets(self, chat_id):
+        return {
+            uid: {'number': number, 'amount': amount}
+            for uid, number, amount in self.conn.execute(
+                "SELECT user_id, number, amount FROM chat_bets WHERE chat_id = ?", (str(chat_id),)
+            )
+        }
+
+    def _rebuild_bet_totals(self, chat_id):
+        self.conn.execute("DELETE FROM chat_bet_totals WHERE chat_id = ?", (chat_id,))
+        self.conn.execute(
+            "INSERT INTO chat_bet_totals (chat_id, number, total, count) "
+            "SELECT chat_id, number, SUM(amount), COUNT(*) FROM chat_bets "
+            "WHERE chat_id = ? GROUP BY number", (chat_id,)
+        )
+
+    def bet_totals(self, chat_id):
+        return {
+            number: (total, count)
+            for number, total, count in self.conn.execute(
+                "SELECT number, total, count FROM chat_bet_totals WHERE chat_id = ?", (str(chat_id),)
+            )
+        }
+
+    def place_bet(self, chat_id, user_id, number, amount):
+        chat_id, user_id = str(chat_id), str(user_id)
+        with self._transaction():
+            current_bet = self.get_bet(chat_id, user_id)
+            if current_bet and current_bet['number'] != number:
+                return current_bet, 'number'
+            if not self._update_user(user_id, {'length': -amount}, min_length=amount):
+                return current_bet, 'length'
+            self.conn.execute(
+                "INSERT INTO chat_bets (chat_id, user_id, number, amount) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (chat_id, user_id) DO UPDATE SET amount = amount + excluded.amount",
+                (chat_id, user_id, number, amount)
+            )
+            self.conn.execute(
+                "INSERT INTO chat_bet_totals (chat_id, number, total, count) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT (chat_id, number) DO UPDATE "
+                "SET total = total + excluded.total, count = count + ?",
+                (chat_id, number, amount, 0 if current_bet else 1)
+            )
+        return self.get_bet(chat_id, user_id), None
+
+    def settle_lottery(self, chat_id, credits, winning_number=None, totals=None):
+        chat_id = str(chat_id)
+        with self._transaction():
+            # Another process may have taken a bet since the credits were computed
+            if totals is not None and self.bet_totals(chat_id) != totals:
+                return False
+            for user_ids, columns in credits:
+                user_ids = [str(uid) for uid in user_ids]
+                self.conn.executemany("INSERT OR IGNORE INTO users (id) VALUES (?)", ((uid,) for uid in user_ids))
+                fields = list(columns)
+                assignments = ', '.join(f"{self._column(f)} = {self._column(f)} + ?" for f in fields)
+                self.conn.executemany(
+                    f"UPDATE users SET {assignments} WHERE id = ?",
+                    zip(*(columns[f] for f in fields), user_ids)
+                )
+            self.conn.execute("DELETE FROM chat_bets WHERE chat_id = ?", (chat_id,))
+            self.conn.execute("DELETE FROM chat_bet_totals WHERE chat_id = ?", (chat_id,))
+            if winning_number is not None:
+                history = (self.lottery_history(chat_id) + [winning_number])[-LOTTERY_HISTORY_SIZE:]
+                self.conn.execute(
+                    "INSERT INTO chat_rounds (chat_id, history) VALUES (?, ?) "
+                    "ON CONFLICT (chat_id) DO UPDATE SET history = excluded.history",
+                    (chat_id, json.dumps(history))
+                )
+        return True
+
+    # --- Leases ---
+    def acquire_lease(self, name, owner, ttl, now):
+        with self._transaction():
+            self.conn.execute(
+                "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE leases.owner = excluded.owner OR leases.expires < ?",
+                (name, owner, now + ttl, now)
+            )
+            holder = self.conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()[0]
+        return holder == owner
+
+    def release_lease(self, name, owner):
+        self.conn.execute("UPDATE leases SET expires = 0 WHERE name = ? AND owner = ?", (name, owner))
+
+    # --- Maintenance ---
+    def check_integrity(self):
+        """List of problems found in the database (empty when healthy)"""
+        problems = []
+        result = self.conn.execute("PRAGMA integrity_check").fetchone()[0]
+        if result != 'ok':
+            problems.append(f"integrity_check: {result}")
+        negative = self.conn.execute("SELECT COUNT(*) FROM users WHERE length < 0").fetchone()[0]
+        if negative:
+            problems.append(f"{negative} utenti con lunghezza negativa")
+        orphans = self.conn.execute(
+            "SELECT COUNT(*) FROM chat_bets WHERE user_id NOT IN (SELECT id FROM users)"
+        ).fetchone()[0]
+        if orphans:
+            problems.append(f"{orphans} scommesse di utenti inesistenti")
+        for (chat_id,) in self.conn.execute("SELECT DISTINCT chat_id FROM chat_bets").fetchall():
+            problems.extend(self.check_lottery_aggregates(chat_id))
+        return problems
+
+    async def close(self):
+        self.conn.close()
+
+
+def migrate_json_to_sqlite(json_path, db_path, shard_dir='chats', legacy_chat_id=None):
+    """One-shot import of a JSON data file (with its journal and chat shards) into SQLite"""
+    data = load_data(json_path)
+    journal_path = os.path.splitext(json_path)[0] + '.journal'
+    shard_store = ShardStore(shard_dir)
+    replayed = shard_store.replay(Journal(journal_path, json_path), data)
+    decode_replayed_users(data['users'])
+
+    chats = {shard.chat_id: shard.data for shard in replayed}
+    for name in os.listdir(shard_dir):
+        if name.endswith('.json'):
+            chat_id = name[:-len('.json')]
+            chats[chat_id] = shard_store.get(chat_id).data
+    if 'lottery' in data or 'duels' in data:
+        if legacy_chat_id is None:
+            raise RuntimeError("Legacy lottery/duel data found: pass --legacy-chat")
+        chats[str(legacy_chat_id)] = {'duels': data.get('duels', {}), 'lottery': data.get('lottery', {})}
+
+    store = SqliteStorage(db_path)
+    with store._transaction() as conn:
+        conn.executemany(
+            f"INSERT OR REPLACE INTO users (id, {', '.join(USER_COLUMNS)}) "
+            f"VALUES (?{', ?' * len(USER_COLUMNS)})",
+            (
+                (uid,) + tuple(getattr(u, field) for field in USER_COLUMNS)
+                for uid, u in data['users'].items()
+            )
+        )
+        for chat_id, chat in chats.items():
+            lottery = chat.get('lottery', {})
+            conn.executemany(
+                "INSERT OR REPLACE INTO chat_duels (chat_id, id, record) VALUES (?, ?, ?)",
+                ((chat_id, duel_id, json.dumps(record)) for duel_id, record in chat.get('duels', {}).items())
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO chat_bets (chat_id, user_id, number, amount) VALUES (?, ?, ?, ?)",
+                ((chat_id, uid, b['number'], b['amount']) for uid, b in lottery.get('bets', {}).items())
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_rounds (chat_id, end_time, history, next_challenge) VALUES (?, ?, ?, ?)",
+                (chat_id, lottery.get('end_time', 0), json.dumps(lottery.get('history', [])),
+                 chat.get('next_challenge', 1))
+            )
+            store._rebuild_bet_totals(chat_id)
+    return store
+
+
+def replay_into_shards(journal, data, shard_dir):
+    """Replay journal into data, writing the chat shards it changes at once:
+    the written snapshot folds the journal, so they must not wait for it"""
+    shard_store = ShardStore(shard_dir)
+    for shard in shard_store.replay(journal, data):
+        shard_store.write_now(shard)
+
+
+def export_snapshot(snapshot_path, json_path, shard_dir='chats'):
+    """Write the binary snapshot plus its journal out as a JSON data file"""
+    data = snapshot.load(snapshot_path)
+    journal = Journal(os.path.splitext(snapshot_path)[0] + '.journal', snapshot_path)
+    replay_into_shards(journal, data, shard_dir)
+    data['journal_seq'] = journal.seq
+    write_snapshot(json_path, dump_data(data), fsync=True)
+    return len(data['users'])
+
+
+def import_snapshot(json_path, snapshot_path, shard_dir='chats'):
+    """Replace the binary snapshot with a JSON data file plus its journal"""
+    data = load_data(json_path)
+    journal = Journal(os.path.splitext(json_path)[0] + '.journal', json_path)
+    replay_into_shards(journal, data, shard_dir)
+    decode_replayed_users(data['users'])
+    data['journal_seq'] = journal.seq
+    write_snapshot(snapshot_path, snapshot.dump(data), fsync=True)
+    return len(data['users'])
+
+
+def read_balances(path):
+    """{user_id: length} saved in a binary snapshot, JSON data file or SQLite
+    database, journal included; for offline checks with the bot stopped"""
+    with open(path, 'rb') as f:
+        magic = f.read(16)
+    if magic.startswith(b'SQLite format 3'):
+        conn = sqlite3.connect(path)
+        try:
+            return dict(conn.execute("SELECT id, length FROM users"))
+        finally:
+            conn.close()
+    journal = Journal(os.path.splitext(path)[0] + '.journal', path)
+
+    def skip_chats(op):
+        return op[1][0] == 'chats'
+
+    if magic.startswith(snapshot.MAGIC):
+        data = snapshot.load(path)
+        journal.replay(data, skip_chats)
+        return dict(data['users'].lengths())
+    data = load_data(path)
+    journal.replay(data, skip_chats)
+    decode_replayed_users(data['users'])
+    return {user_id: user.length for user_id, user in data['users'].items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Zucchini storage maintenance")
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate = commands.add_parser('migrate', help="import a JSON data file into SQLite")
+    migrate.add_argument('json_path')
+    migrate.add_argument('db_path')
+    migrate.add_argument('--shards', default='chats', help="directory of the per-chat JSON files")
+    migrate.add_argument('--legacy-chat', help="chat that receives a pre-sharding lottery and duels")
+    check = commands.add_parser('check', help="run integrity checks on an SQLite database")
+    check.add_argument('db_path')
+    check.add_argument('--legacy-chat', help="chat that receives a pre-sharding lottery and duels")
+    export = commands.add_parser('export', help="write a binary snapshot out as a JSON data file")
+    export.add_argument('snapshot_path')
+    export.add_argument('json_path')
+    export.add_argument('--shards', default='chats', help="directory of the per-chat JSON files")
+    load = commands.add_parser('import', help="rebuild the binary snapshot from a JSON data file")
+    load.add_argument('json_path')
+    load.add_argument('snapshot_path')
+    load.add_argument('--shards', default='chats', help="directory of the per-chat JSON files")
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        store = migrate_json_to_sqlite(args.json_path, args.db_path, args.shards, args.legacy_chat)
+        print(f"Migrati {store.user_count()} utenti in {args.db_path}")
+    elif args.command == 'export':
+        print(f"Esportati {export_snapshot(args.snapshot_path, args.json_path, args.shards)} utenti in {args.json_path}")
+    elif args.command == 'import':
+        print(f"Importati {import_snapshot(args.json_path, args.snapshot_path, args.shards)} utenti in {args.snapshot_path}")
+    else:
+        problems = SqliteStorage(args.db_path, args.legacy_chat).check_integrity()
+        print("\n".join(problems) if problems else "ok")
+        raise SystemExit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Zucchini Telegram Bot - Pre-dispatch throttle
+# Spam is shed before any handler runs: token buckets per user and per
+# chat, plus a cache of the daily/hourly cooldowns, answer every update in
+# O(1) without touching storage. Rejected users get at most one notice
+# per interval; the rest of a burst is dropped silently.
+from collections import OrderedDict
+
+# Rejection reasons, also the keys of Throttle.dropped
+COOLDOWN = 'cooldown'
+USER = 'user'
+CHAT = 'chat'
+
+
+def _touch(entries, key, value, max_keys):
+    entries[key] = value
+    entries.move_to_end(key)
+    if len(entries) > max_keys:
+        entries.popitem(last=False)
+
+
+class Throttle:
+    """Per-user and per-chat token buckets and a command cooldown cache.
+
+    check() returns None to let an update through, or (reason, remaining,
+    notify): remaining is the cooldown left in seconds (0 for rate limits)
+    and notify is true for the one rejection per notice_interval that
+    deserves a reply. A rate of 0 disables that bucket. Every table is an
+    LRU capped at max_keys, so memory stays bounded under a flood.
+    """
+
+    def __init__(self, user_rate=1.0, user_burst=5, chat_rate=5.0, chat_burst=30,
+                 notice_interval=30.0, max_keys=100_000):
+        self.user_limits = (user_rate, user_burst)
+        self.chat_limits = (chat_rate, chat_burst)
+        self.notice_interval = notice_interval
+        self.max_keys = max_keys
+        self.passed = 0
+        self.notices = 0
+        self.dropped = {COOLDOWN: 0, USER: 0, CHAT: 0}
+        self._users = OrderedDict()       # user_id -> (tokens, updated)
+        self._chats = OrderedDict()       # chat_id -> (tokens, updated)
+        self._cooldowns = OrderedDict()   # (user_id, command) -> until
+        self._noticed = OrderedDict()     # user_id -> last notice time
+
+    def set_cooldown(self, user_id, command, until):
+        """Mirror a cooldown the handler just checked, e.g. last_daily + 24h"""
+        _touch(self._cooldowns, (str(user_id), command), until, self.max_keys)
+
+    def _take(self, buckets, key, limits, cost, now):
+        rate, burst = limits
+        if not rate:
+            return True
+        tokens, updated = buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        allowed = tokens >= cost
+        _touch(buckets, key, (tokens - cost if allowed else tokens, now), self.max_keys)
+        return allowed
+
+    def _notify(self, user_id, now):
+        last = self._noticed.get(user_id)
+        if last is not None and now - last < self.notice_interval:
+            return False
+        _touch(self._noticed, user_id, now, self.max_keys)
+        self.notices += 1
+        return True
+
+    def check(self, user_id, chat_id, command, now, cost=1):
+        user_id = str(user_id)
+        until = self._cooldowns.get((user_id, command))
+        if until is not None:
+            if now < until:
+                self.dropped[COOLDOWN] += 1
+                return COOLDOWN, until - now, self._notify(user_id, now)
+            del self._cooldowns[user_id, command]
+
+        if not self._take(self._users, user_id, self.user_limits, cost, now):
+            self.dropped[USER] += 1
+            return USER, 0, self._notify(user_id, now)
+        if chat_id is not None and not self._take(self._chats, str(chat_id), self.chat_limits, cost, now):
+            self.dropped[CHAT] += 1
+            return CHAT, 0, self._notify(user_id, now)
+        self.passed += 1
+        return None
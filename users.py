@@ -0,0 +1,77 @@
+# Zucchini Telegram Bot - Compact user records
+# One __slots__ object per user instead of a dict plus a nested stats dict;
+# the JSON file keeps its {"length", ..., "stats": {...}} layout.
+USER_FIELDS = ('length', 'last_daily', 'last_hourly')
+STAT_FIELDS = (
+    'daily_used', 'hourly_used', 'daily_collected', 'begs',
+    'won', 'lost', 'length_won', 'length_lost', 'bet_total',
+)
+
+
+class User:
+    """A user's balance, cooldowns and stat counters"""
+
+    __slots__ = USER_FIELDS + STAT_FIELDS
+
+    def __init__(self, length=20, last_daily=0, last_hourly=0, **stats):
+        self.length = length
+        self.last_daily = last_daily
+        self.last_hourly = last_hourly
+        for field in STAT_FIELDS:
+            setattr(self, field, stats.get(field, 0))
+
+    @classmethod
+    def from_json(cls, data):
+        """Build from the JSON layout, ignoring unknown keys"""
+        # Hot path when loading the data file: skip __init__ and its kwargs
+        user = cls.__new__(cls)
+        user.length = data.get('length', 20)
+        user.last_daily = data.get('last_daily', 0)
+        user.last_hourly = data.get('last_hourly', 0)
+        stats = data.get('stats', {})
+        for field in STAT_FIELDS:
+            setattr(user, field, stats.get(field, 0))
+        return user
+
+    def to_json(self):
+        return {
+            'length': self.length,
+            'last_daily': self.last_daily,
+            'last_hourly': self.last_hourly,
+            'stats': {field: getattr(self, field) for field in STAT_FIELDS},
+        }
+
+    def stat(self, field):
+        return getattr(self, field)
+
+    def __repr__(self):
+        return f"User({self.to_json()!r})"
+
+    # --- Journal paths ---
+    # apply_op() walks ['users', id, 'stats', 'won'] as nested dicts; stats
+    # live on the record itself, so 'stats' resolves to the record
+    def setdefault(self, key, default=None):
+        if key != 'stats':
+            raise KeyError(key)
+        return self
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+
+def user_hook(obj):
+    """json object_hook: decode user entries straight into User records"""
+    if 'stats' in obj and 'length' in obj:
+        return User.from_json(obj)
+    return obj
+
@@ -0,0 +1,137 @@
+# Zucchini Telegram Bot - Webhook server
+# Telegram POSTs each update to us instead of the bot long-polling
+# getUpdates. A minimal HTTP/1.1 server on asyncio streams, so webhook mode
+# needs no extra dependencies.
+import asyncio
+import hmac
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+MAX_BODY_SIZE = 1024 * 1024
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+           405: 'Method Not Allowed'}
+
+
+# === HTTP ===
+async def read_request(reader):
+    """(method, path, headers, body) of the next request, None once the client is gone"""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    method, target, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_SIZE:
+        raise ValueError(f"body of {length} bytes")
+    body = await reader.readexactly(length) if length else b''
+    return method, target, headers, body
+
+
+def format_response(status, payload=None, keep_alive=True):
+    body = json.dumps(payload if payload is not None else {}).encode()
+    head = (
+        f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode('latin-1') + body
+
+
+# === Server ===
+class WebhookServer:
+    """Receives Telegram updates on path and hands them to `await on_update(dict)`.
+
+    Requests must carry secret_token in the X-Telegram-Bot-Api-Secret-Token
+    header when one is configured. GET health_path answers with the dict
+    returned by health(), for load balancers and probes.
+    """
+
+    def __init__(self, on_update, path='/telegram', secret_token=None, host='127.0.0.1',
+                 port=8443, health_path='/healthz', health=None):
+        self.on_update = on_update
+        self.path = path
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.health_path = health_path
+        self.health = health or (lambda: {})
+        self.received = 0
+        self.rejected = 0
+        self._server = None
+        self._idle = set()   # connections waiting for their next request
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        # port=0 picks a free port
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Webhook in ascolto su {self.host}:{self.port}{self.path}")
+
+    async def stop(self):
+        """Stop accepting, let in-flight requests finish, then drop idle connections"""
+        if self._server is None:
+            return
+        server, self._server = self._server, None
+        server.close()
+        for writer in list(self._idle):
+            writer.close()
+        await server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            while self._server is not None:
+                self._idle.add(writer)
+                try:
+                    request = await read_request(reader)
+                except ValueError:
+                    # Malformed request line or oversized body
+                    writer.write(format_response(400, {'ok': False}, keep_alive=False))
+                    break
+                finally:
+                    self._idle.discard(writer)
+                if request is None:
+                    break
+                status, payload = await self._handle(*request)
+                keep_alive = (request[2].get('connection', '').lower() != 'close'
+                              and self._server is not None)
+                writer.write(format_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, method, target, headers, body):
+        path = target.split('?', 1)[0]
+        if path == self.health_path:
+            return 200, {'ok': True, 'received': self.received, 'rejected': self.rejected, **self.health()}
+        if path != self.path:
+            return 404, {'ok': False}
+        if method != 'POST':
+            return 405, {'ok': False}
+        if self.secret_token and not hmac.compare_digest(
+                headers.get(SECRET_HEADER, '').encode(), self.secret_token.encode()):
+            self.rejected += 1
+            logger.warning("Webhook: secret token non valido, richiesta rifiutata")
+            return 403, {'ok': False}
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError:
+            self.rejected += 1
+            return 400, {'ok': False}
+
+        # Only enqueue: Telegram waits for our answer before sending more
+        await self.on_update(data)
+        self.received += 1
+        return 200, {'ok': True}
@@ -0,0 +1,169 @@
+# Zucchini Telegram Bot - Worker processes
+# With WORKERS > 1 the bot runs as one router plus N worker processes on
+# the same machine. The router takes updates from Telegram and pipes each
+# one, as a JSON line, to the worker that owns its chat; the workers share
+# the game state through SQLite in WAL mode. A lease row in the database
+# makes one worker at a time the leader that draws the lottery rounds.
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Update fields that carry the message or chat an update belongs to
+_MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post',
+                   'my_chat_member', 'chat_member', 'chat_join_request')
+
+
+def update_chat_id(data):
+    """Chat id of a raw update dict, the sender's id if it has no chat, else 0"""
+    for field in _MESSAGE_FIELDS:
+        if field in data:
+            return data[field]['chat']['id']
+    query = data.get('callback_query')
+    if query is not None:
+        message = query.get('message')
+        return message['chat']['id'] if message else query['from']['id']
+    for value in data.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return 0
+
+
+def worker_for(chat_id, workers):
+    """Index of the worker that owns a chat; stable across restarts"""
+    return zlib.crc32(str(chat_id).encode()) % workers
+
+
+# === Router side ===
+class WorkerPool:
+    """Starts the worker processes and routes updates to them.
+
+    Each worker runs argv with WORKER_INDEX set and reads updates from its
+    stdin, so all updates of a chat are handled by one process in arrival
+    order. Closing stdin asks a worker to flush and exit.
+    """
+
+    def __init__(self, workers, argv, env=None):
+        self.workers = workers
+        self.argv = argv
+        self.env = env or os.environ
+        self.routed = [0] * workers
+        self._processes = []
+
+    async def start(self):
+        for index in range(self.workers):
+            env = dict(self.env, WORKER_INDEX=str(index))
+            process = await asyncio.create_subprocess_exec(*self.argv, stdin=asyncio.subprocess.PIPE, env=env)
+            self._processes.append(process)
+        logger.info(f"Avviati {self.workers} worker")
+
+    def alive(self):
+        return sum(process.returncode is None for process in self._processes)
+
+    async def dispatch(self, data):
+        index = worker_for(update_chat_id(data), self.workers)
+        process = self._processes[index]
+        if process.returncode is not None:
+            logger.error(f"Worker {index} terminato (codice {process.returncode}), update {data.get('update_id')} perso")
+            return
+        process.stdin.write(json.dumps(data, separators=(',', ':')).encode() + b'\n')
+        self.routed[index] += 1
+        # Backpressure: a slow worker slows the router instead of buffering forever
+        await process.stdin.drain()
+
+    async def stop(self):
+        for process in self._processes:
+            if process.returncode is None:
+                process.stdin.close()
+        for index, process in enumerate(self._processes):
+            code = await process.wait()
+            if code:
+                logger.warning(f"Worker {index} uscito con codice {code}")
+
+
+# === Worker side ===
+async def read_updates():
+    """Raw update dicts piped in by the router, until stdin closes"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=2 ** 20)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        yield json.loads(line)
+
+
+class LeaderElection:
+    """Lease-based leadership over a Storage's lease table.
+
+    Every worker tries to take or renew the lease every ttl / 3 seconds.
+    The holder calls `await on_elected()` when it gets the lease and
+    `await on_deposed()` when it loses it, and `await on_tick()` on every
+    renewal while it leads. A worker that stops renewing (crash, stall)
+    loses the lease after ttl, and another one takes over.
+    """
+
+    def __init__(self, store, name, owner, ttl=15.0, on_elected=None, on_deposed=None, on_tick=None):
+        self.store = store
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+        self.on_elected = on_elected
+        self.on_deposed = on_deposed
+        self.on_tick = on_tick
+        self.leader = False
+        self.elections = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def run(self):
+        while True:
+            try:
+                await self.renew()
+            except Exception:
+                logger.error(f"Errore nel rinnovo del lease {self.name}:\n" + traceback.format_exc())
+            await asyncio.sleep(self.ttl / 3)
+
+    async def renew(self):
+        held = self.store.acquire_lease(self.name, self.owner, self.ttl, time.time())
+        if held and not self.leader:
+            self.leader = True
+            self.elections += 1
+            logger.info(f"{self.owner} è il leader di {self.name}")
+            if self.on_elected is not None:
+                await self.on_elected()
+        elif not held and self.leader:
+            self.leader = False
+            logger.warning(f"{self.owner} ha perso il lease {self.name}")
+            if self.on_deposed is not None:
+                await self.on_deposed()
+        if self.leader and self.on_tick is not None:
+            await self.on_tick()
+
+    async def stop_renewing(self):
+        """Stop the renewal task but keep the current role"""
+        if self._task is not None:
+            self._task.cancel()
+            # wait() rather than await: only the task's own cancellation is
+            # expected here, one aimed at our caller must still reach it
+            await asyncio.wait([self._task])
+            self._task = None
+
+    async def stop(self):
+        await self.stop_renewing()
+        if self.leader:
+            self.leader = False
+            if self.on_deposed is not None:
+                await self.on_deposed()
+            # Let the next worker take over now instead of after ttl
+            self.store.release_lease(self.name, self.owner)